@@ -1,23 +1,79 @@
-from flask import Flask, send_from_directory, request
-from flask_socketio import SocketIO
+from flask import Flask, Response, send_from_directory, request
+from flask_socketio import SocketIO, disconnect, join_room, leave_room
 import random
 import time
 import uuid
 import math
-import json, os, time
-from threading import Lock
+import json, os, re, sys, time
+import base64
+import copy
+import glob
+import gzip
+import hashlib
+import mmap
+import shutil
+import signal
+import struct
+import tempfile
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Sequence
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial, wraps
+from threading import Lock, Thread
 from pathlib import Path
 
+try:
+    import brotli  # optional: assets are also precompressed as br when present
+except ImportError:
+    brotli = None
+
 MAP_FILE = "map_objects.json"
-map_lock = Lock()
 
-# Background task guard to ensure mine loop starts exactly once
-mine_loop_started = False
-mine_loop_lock = Lock()
+# Startup phase timings (ms), reported once the module is ready and in /loadz
+STARTUP_T0 = time.perf_counter()
+startup_timings = {}
+_startup_last = [STARTUP_T0]
+
+
+def startup_mark(phase):
+    now = time.perf_counter()
+    booting = current_world.get()
+    if booting is not None and booting.id != DEFAULT_WORLD:
+        phase = f"{booting.id}/{phase}"
+    startup_timings[phase] = round((now - _startup_last[0]) * 1000, 1)
+    _startup_last[0] = now
+
+# Background task guard to ensure the world scheduler starts exactly once
+scheduler_started = False
+scheduler_lock = Lock()
+
+
+class TickMonitor:
+    """EWMA of how far a background loop runs behind its intended interval."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.last = None
+        self.lag = 0.0
+        self.max_lag = 0.0
 
-# NPC background task guard
-npc_loop_started = False
-npc_loop_lock = Lock()
+    def tick(self):
+        now = time.time()
+        if self.last is not None:
+            lag = max(0.0, now - self.last - self.interval)
+            self.lag += 0.1 * (lag - self.lag)
+            self.max_lag = max(self.max_lag, lag)
+        self.last = now
+
+    def report(self):
+        return {"interval": self.interval, "lag": round(self.lag, 4), "max_lag": round(self.max_lag, 4),
+                "last_tick_age": round(time.time() - self.last, 3) if self.last else None}
+
+
+tick_monitors = {"npc": TickMonitor(0.016), "feed": TickMonitor(1 / 30), "mine": TickMonitor(1.0)}
 
 # Cost constants
 TOWN_CENTER_COST = 5
@@ -38,16 +94,2133 @@ BUILD_COLLISION_PADDING = -50
 GROUND_ITEM_COLLISION_PAD = 8
 
 GROUND_FILE = "ground_items.json"
-ground_lock = Lock()
-
 RES_FILE = "resources.json"
-resources_lock = Lock()
 
-# resources: list of {id, x, y, type}
-resources = []
+# Optional SQLite world store: WORLD_STORE=sqlite keeps every collection in
+# WORLD_DB and persists only the rows that changed instead of rewriting the
+# JSON files. An empty database is seeded from the JSON files on first start.
+WORLD_STORE = os.environ.get("WORLD_STORE", "json")
+WORLD_DB = os.environ.get("WORLD_DB", "world.db")
+WORLD_DB_RECONCILE_INTERVAL = 30.0  # seconds between full diff passes
+
+# With the JSON store, changed rows are appended to WORLD_JOURNAL (one group
+# commit + fsync per persist tick) and the JSON files are only rewritten when
+# the journal is compacted. Set WORLD_JOURNAL= (empty) to rewrite the files
+# on every save as before.
+WORLD_JOURNAL = os.environ.get("WORLD_JOURNAL", "world.journal")
+JOURNAL_COMPACT_BYTES = 4 * 1024 * 1024
+JOURNAL_COMPACT_INTERVAL = 300.0
+
+# WORLD_SNAPSHOT=world.snap makes journal compaction write one binary
+# snapshot (see pack_world_snapshot) instead of the three JSON files, and
+# startup load from it. Requires the journal.
+WORLD_SNAPSHOT = os.environ.get("WORLD_SNAPSHOT", "")
+
+# WORLD_STORE=chunks pages map objects in and out of one file per static
+# chunk under WORLD_CHUNKS_DIR: chunks around online players' units stay in
+# memory, the rest are evicted least recently used beyond WORLD_PAGE_BUDGET.
+# Ground items, resources and trees stay resident in their JSON files. An
+# empty directory is seeded from map_objects.json on first start.
+WORLD_CHUNKS_DIR = os.environ.get("WORLD_CHUNKS_DIR", "world_chunks")
+WORLD_PAGE_BUDGET = int(os.environ.get("WORLD_PAGE_BUDGET", "64"))  # resident chunks
+PAGE_PIN_RADIUS = 1  # chunks kept around each unit (1 -> 3x3)
+PAGE_PREFETCH_AHEAD = 768  # px looked ahead along a moving unit's heading
+PAGE_INTERVAL = 1.0
+
+# Ground tiles (roads, earth patches) live in a terrain layer instead of the
+# map objects: a grid of TERRAIN_CELL px cells holding palette ids, kept
+# run-length encoded per TERRAIN_CHUNK x TERRAIN_CHUNK chunk in TERRAIN_FILE
+# (whatever the WORLD_STORE), painted with "paint_terrain" and served as
+# content-addressed chunks. Entity loops never see it.
+TERRAIN_FILE = os.environ.get("TERRAIN_FILE", "terrain.json")
+TERRAIN_CELL = 64
+TERRAIN_CHUNK = 32  # cells per side; 32 * 64 px lines up with STATIC_CHUNK_SIZE
+TERRAIN_MAX_BRUSH = 16  # cells per side of one paint
+TERRAIN_VERSION = 1
+
+# ===== WORLDS =====
+# Everything a match owns lives on a World: map, players, feeds, locks,
+# stores and file paths. WORLDS=main,duel1,duel2 runs several isolated
+# worlds in one process; a socket joins one at login ({"world": id}) and a
+# single scheduler ticks all of them. The first world keeps the top-level
+# files above; the others keep theirs under WORLDS_DIR/<id>/. Code reads the
+# world it runs for through `world`, which resolves to the world bound to
+# the current greenlet (World.bound) and to the first world otherwise.
+WORLDS = [w.strip() for w in os.environ.get("WORLDS", "default").split(",") if w.strip()]
+WORLDS_DIR = os.environ.get("WORLDS_DIR", "worlds")
+DEFAULT_WORLD = WORLDS[0]
+
+worlds = {}  # id -> World, in WORLDS order
+current_world = ContextVar("current_world", default=None)
+
+
+class World:
+    def __init__(self, world_id):
+        self.id = world_id
+        self.room = f"world:{world_id}"
+        self.root = "" if world_id == DEFAULT_WORLD else os.path.join(WORLDS_DIR, world_id)
+        if self.root:
+            os.makedirs(self.root, exist_ok=True)
+        self.map_file = self.path(MAP_FILE)
+        self.ground_file = self.path(GROUND_FILE)
+        self.res_file = self.path(RES_FILE)
+        self.db_path = self.path(WORLD_DB)
+        self.journal_path = self.path(WORLD_JOURNAL)
+        self.snapshot_path = self.path(WORLD_SNAPSHOT)
+        self.chunks_dir = self.path(WORLD_CHUNKS_DIR)
+        self.suspend_file = self.path(SUSPEND_FILE)
+        self.terrain_file = self.path(TERRAIN_FILE)
+        self.seed = WORLD_SEED if not self.root else zlib.crc32(f"{WORLD_SEED}:{world_id}".encode())
+        # Seqs restart with the process; clients send the epoch back so a version
+        # from a previous server run is never mistaken for a current one.
+        self.epoch = uuid.uuid4().hex
+
+        self.map_lock = Lock()
+        self.ground_lock = Lock()
+        self.resources_lock = Lock()
+        self.terrain_lock = Lock()
+        self.db = None
+        self.journal = None
+        self.snapshot = None
+        self.pager = None
+        self.schema = WORLD_SCHEMA_VERSION  # version the store had when loaded
+
+        self.map_objects = []  # {id, type, kind, x, y, owner, rot, meta}
+        self.learned_archetypes = {}  # kind -> archetype learned from editor-placed tiles
+        self.ground_items = []  # [{id, name, x, y}]
+        self.resources = []  # [{id, x, y, type}]
+        self.trees = []
+        self.terrain = TerrainLayer()
+        # id -> object lookups kept in step with the lists above
+        self.map_index = {}
+        self.ground_index = {}
+        self.resource_index = {}
+        self.collision_index = CollisionIndex()
+
+        self.players = {}  # player_id -> {x, y, color, units, resources}
+        self.buildings = []  # list of {x, y, owner}
+        self.sid_to_player = {}  # active socket sid -> player_id
+        self.player_to_sid = {}  # player_id -> last seen sid
+
+        self.feeds = {
+            "map_objects": ChangeFeed("map_objects", self.map_index.get, compact_map_object),
+            "ground_items": ChangeFeed("ground_items", self.ground_index.get),
+            "resources": ChangeFeed("resources", self.resource_index.get),
+        }
+        self.map_feed = self.feeds["map_objects"]
+        self.ground_feed = self.feeds["ground_items"]
+        self.resources_feed = self.feeds["resources"]
+        self.motion_dirty = set()  # map object ids whose NPC motion changed since the last drain
+        self.dirty_collections = set()
+        self.static_manifest_cache = {"version": None, "manifest": None}
+
+        # per-world loop state (see world_scheduler)
+        self.mine_ticks = 0
+        self.mines_logged = False
+        self.npc_ticks = 0
+        self.npc_moving_ticks = 0
+
+    def path(self, name):
+        """*name* for the default world, WORLDS_DIR/<id>/<basename> for the others ("" stays off)."""
+        if not name or not self.root:
+            return name
+        return os.path.join(self.root, os.path.basename(name))
+
+    @contextmanager
+    def bound(self):
+        token = current_world.set(self)
+        try:
+            yield self
+        finally:
+            current_world.reset(token)
+
+
+def bound_world():
+    """The World this greenlet runs for (the first world when none is bound)."""
+    return current_world.get() or worlds[DEFAULT_WORLD]
+
+
+class CurrentWorld:
+    """`world`: attribute access forwarded to the World bound to this greenlet."""
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        return getattr(bound_world(), name)
+
+    def __setattr__(self, name, value):
+        setattr(bound_world(), name, value)
+
+
+world = CurrentWorld()
+
+# Archetypes: shared per-kind defaults for map objects. In memory every object
+# carries its fully resolved meta; on disk and on the wire only the fields that
+# differ from the archetype are kept. Clients receive the table once at login.
+BUILTIN_ARCHETYPES = {
+    "spider": {"type": "tile", "meta": {
+        "entity": True, "title": "Spider",
+        "bio": "A hostile spider that patrols waypoints and attacks nearby players",
+        "actions": [], "collides": False, "w": 100, "h": 100, "z": 0,
+        "anim": "walk", "dir": "000", "currentWaypointIndex": 0, "chasing": False
+    }},
+    "npc": {"type": "tile", "meta": {
+        "entity": True, "title": "NPC", "bio": "An NPC that walks between waypoints",
+        "actions": [], "collides": False, "w": 64, "h": 64, "z": 0,
+        "anim": "walk", "dir": "000", "currentWaypointIndex": 0, "chasing": False
+    }},
+    "town_center": {"type": "tile", "meta": {
+        "entity": True, "title": "Town Center", "bio": "", "actions": [],
+        "collides": True, "cw": BUILD_W, "ch": BUILD_H, "cx": 0, "cy": 0,
+        "w": BUILD_W, "h": BUILD_H, "z": 0
+    }},
+    "mine": {"type": "tile", "meta": {
+        "entity": True, "title": "Mine", "bio": "", "actions": [],
+        "collides": True, "cw": 256, "ch": 256, "cx": 0, "cy": 0,
+        "w": 256, "h": 256, "z": 0, "interval": 30
+    }},
+    "blacksmith": {"type": "tile", "meta": {
+        "entity": True, "title": "Blacksmith", "bio": "", "actions": [],
+        "collides": True, "cw": 256, "ch": 256, "cx": 0, "cy": 0,
+        "w": 256, "h": 256, "z": 0
+    }},
+    "field": {"type": "tile", "meta": {
+        "entity": False, "title": "Field", "bio": "", "actions": [],
+        "collides": False, "cx": 0, "cy": 0
+    }},
+    "item": {"type": "tile", "meta": {
+        "entity": True, "title": "Item", "bio": "An item that can be picked up",
+        "actions": [], "collides": False, "w": 64, "h": 64
+    }},
+}
+
+# Fields copied from the first placed object of an unknown tile kind
+ARCHETYPE_LAYOUT_FIELDS = ("collides", "cx", "cy", "cw", "ch", "w", "h", "z")
+
+def get_archetype(kind):
+    return BUILTIN_ARCHETYPES.get(kind) or world.learned_archetypes.get(kind)
+
+
+def archetype_table():
+    """Full archetype table as sent to clients."""
+    return {**world.learned_archetypes, **BUILTIN_ARCHETYPES}
+
+
+def register_archetype(obj):
+    """Learn an archetype for an unknown tile kind. Returns True if a new one was added."""
+    kind = obj.get("kind")
+    if not kind or get_archetype(kind) or obj.get("type") != "tile":
+        return False
+    meta = obj.get("meta") or {}
+    shared = {k: meta[k] for k in ARCHETYPE_LAYOUT_FIELDS if k in meta}
+    if not shared:
+        return False
+    world.learned_archetypes[kind] = {"type": obj.get("type"), "meta": shared}
+    return True
+
+
+def expand_map_object(obj):
+    """Resolve a stored/compact map object against its archetype (in place)."""
+    arch = get_archetype(obj.get("kind"))
+    if not arch:
+        obj.setdefault("meta", {})
+        return obj
+    if "type" not in obj:
+        obj["type"] = arch.get("type")
+    overrides = obj.get("meta") or {}
+    meta = copy.deepcopy(arch.get("meta") or {})
+    meta.update(overrides)
+    # archetype fields this object never had (see compact_map_object)
+    for k in obj.pop("unset", None) or ():
+        meta.pop(k, None)
+    obj["meta"] = meta
+    return obj
+
+
+def compact_map_object(obj):
+    """Return a copy of *obj* holding only the fields that differ from its archetype."""
+    arch = get_archetype(obj.get("kind"))
+    if not arch:
+        return obj
+    out = dict(obj)
+    if out.get("type") == arch.get("type"):
+        out.pop("type", None)
+    defaults = arch.get("meta") or {}
+    meta = obj.get("meta") or {}
+    out["meta"] = {k: v for k, v in meta.items() if k not in defaults or defaults[k] != v}
+    # A learned archetype comes from the first object of its kind; later ones
+    # may lack some of its fields (no collision box, say). List those so
+    # expansion does not backfill them.
+    unset = [k for k in defaults if k not in meta]
+    if unset:
+        out["unset"] = unset
+    return out
+
+
+def compact_map_objects(objs=None):
+    return [compact_map_object(o) for o in (world.map_objects if objs is None else objs)]
+
+
+def reindex_map():
+    world.map_index.clear()
+    world.map_index.update((o.get("id"), o) for o in world.map_objects)
+
+
+def reindex_ground():
+    world.ground_index.clear()
+    world.ground_index.update((g.get("id"), g) for g in world.ground_items)
+
+
+def find_map_object(oid):
+    return world.map_index.get(oid)
+
+
+def add_map_object(obj):
+    world.map_objects.append(obj)
+    world.map_index[obj.get("id")] = obj
+    return obj
+
+
+def remove_map_object(oid):
+    """Remove a map object by id; returns the removed object or None."""
+    obj = world.map_index.pop(oid, None)
+    if obj is None:
+        return None
+    for i, o in enumerate(world.map_objects):
+        if o is obj:
+            del world.map_objects[i]
+            break
+    return obj
+
+
+def add_ground_item(gi):
+    world.ground_items.append(gi)
+    world.ground_index[gi.get("id")] = gi
+    return gi
+
+
+def remove_ground_item(gid):
+    gi = world.ground_index.pop(gid, None)
+    if gi is None:
+        return None
+    for i, g in enumerate(world.ground_items):
+        if g is gi:
+            del world.ground_items[i]
+            break
+    return gi
+
+
+# Wire codecs: hot events (NPC motion deltas, unit movement batches) can go
+# out as one packed binary "bin" frame instead of JSON. Clients offer the
+# codecs they understand at login; anything else (and every client that
+# offers none) keeps plain JSON events.
+WIRE_CODECS = ("bin1", "json")  # server preference order
+COORD_SCALE = 16  # fixed point: 1/16 px
+ANIM_CODES = ("idle", "walk", "attack")
+DIR_CODES = ("000", "022", "045", "067", "090", "112", "135", "157",
+             "180", "202", "225", "247", "270", "292", "315", "337")
+ENUM_RAW = 255  # code followed by the string itself
+FRAME_MAP_DELTA = 1
+FRAME_UNITS = 2
+FRAME_MOTION = 3
+NPC_BIN_META_KEYS = {"targetWaypoint", "currentWaypointIndex", "anim", "dir", "chasing"}
+
+sid_codecs = {}  # sid -> negotiated codec (absent = json)
+
+
+class WireWriter:
+    def __init__(self):
+        self.parts = []
+
+    def pack(self, fmt, *values):
+        self.parts.append(struct.pack("<" + fmt, *values))
+
+    def text(self, value):
+        raw = str(value).encode("utf-8")
+        if len(raw) > 255:
+            # cut on a character boundary, never inside a multi-byte sequence
+            raw = raw[:255].decode("utf-8", "ignore").encode("utf-8")
+        self.pack("B", len(raw))
+        self.parts.append(raw)
+
+    def ident(self, value):
+        """uuid ids as 16 raw bytes (length 0), anything else as short text."""
+        try:
+            u = uuid.UUID(value)
+            if str(u) == value:
+                self.pack("B", 0)
+                self.parts.append(u.bytes)
+                return
+        except (TypeError, ValueError, AttributeError):
+            pass
+        self.text(value)
+
+    def coord(self, value):
+        self.pack("i", int(round(float(value) * COORD_SCALE)))
+
+    def enum(self, table, value):
+        if value in table:
+            self.pack("B", table.index(value))
+        else:
+            self.pack("B", ENUM_RAW)
+            self.text(value)
+
+    def json_tail(self, value):
+        raw = json.dumps(value, separators=(",", ":")).encode("utf-8")
+        self.pack("I", len(raw))
+        self.parts.append(raw)
+
+    def getvalue(self):
+        return b"".join(self.parts)
+
+
+def _is_num(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _npc_patch_packable(entry):
+    if set(entry) - {"id", "x", "y", "meta"} or not isinstance(entry.get("id"), str):
+        return False
+    if ("x" in entry) != ("y" in entry) or ("x" in entry and not (_is_num(entry["x"]) and _is_num(entry["y"]))):
+        return False
+    meta = entry.get("meta") or {}
+    if set(meta) - NPC_BIN_META_KEYS:
+        return False
+    if "targetWaypoint" in meta:
+        tw = meta["targetWaypoint"]
+        if not isinstance(tw, dict) or not _is_num(tw.get("x")) or not _is_num(tw.get("y")):
+            return False
+    if "currentWaypointIndex" in meta:
+        cwi = meta["currentWaypointIndex"]
+        if not isinstance(cwi, int) or isinstance(cwi, bool) or not 0 <= cwi <= 0xFFFF:
+            return False
+    if "chasing" in meta and not isinstance(meta["chasing"], bool):
+        return False
+    return all(isinstance(meta[k], str) for k in ("anim", "dir") if k in meta)
+
+
+def _pack_npc_patch(w, p):
+    """Patch record: id, u8 field mask, then present fields in mask order
+    (bit0 x/y, bit1 targetWaypoint, bit2 waypoint index, bit3 anim, bit4 dir,
+    bit5 chasing with the value in bit6)."""
+    meta = p.get("meta") or {}
+    mask = (("x" in p) * 1 | ("targetWaypoint" in meta) * 2 | ("currentWaypointIndex" in meta) * 4
+            | ("anim" in meta) * 8 | ("dir" in meta) * 16 | ("chasing" in meta) * 32
+            | bool(meta.get("chasing")) * 64)
+    w.ident(p["id"])
+    w.pack("B", mask)
+    if mask & 1:
+        w.coord(p["x"])
+        w.coord(p["y"])
+    if mask & 2:
+        w.coord(meta["targetWaypoint"]["x"])
+        w.coord(meta["targetWaypoint"]["y"])
+    if mask & 4:
+        w.pack("H", meta["currentWaypointIndex"])
+    if mask & 8:
+        w.enum(ANIM_CODES, meta["anim"])
+    if mask & 16:
+        w.enum(DIR_CODES, meta["dir"])
+
+
+def encode_map_delta_bin(delta):
+    """map_objects_delta: NPC-shaped patches packed, everything else as JSON tail."""
+    packed = [p for p in delta["patch"] if _npc_patch_packable(p)]
+    rest = [p for p in delta["patch"] if not _npc_patch_packable(p)]
+    w = WireWriter()
+    w.pack("BIIH", FRAME_MAP_DELTA, delta.get("base", delta["seq"] - 1), delta["seq"], len(packed))
+    for p in packed:
+        _pack_npc_patch(w, p)
+    w.json_tail({"upsert": delta["upsert"], "patch": rest, "remove": delta["remove"]})
+    return w.getvalue()
+
+
+def encode_motion_bin(payload):
+    """map_objects_motion: packed NPC patches only (None falls back to JSON)."""
+    patches = payload["patch"]
+    if not all(_npc_patch_packable(p) for p in patches):
+        return None
+    w = WireWriter()
+    w.pack("BH", FRAME_MOTION, len(patches))
+    for p in patches:
+        _pack_npc_patch(w, p)
+    return w.getvalue()
+
+
+def encode_units_bin(payload):
+    """update_units movement batch: position/target/hp/anim/dir per unit."""
+    units = [u for u in payload.get("units") or [] if isinstance(u, dict) and u.get("id")]
+    w = WireWriter()
+    w.pack("B", FRAME_UNITS)
+    w.text(payload.get("sid", ""))
+    w.pack("H", len(units))
+    for u in units:
+        x = float(u.get("x", 0) or 0)
+        y = float(u.get("y", 0) or 0)
+        w.ident(u["id"])
+        w.coord(x)
+        w.coord(y)
+        w.coord(u.get("tx", x) or 0)
+        w.coord(u.get("ty", y) or 0)
+        w.pack("ff", float(u.get("hp", 0) or 0), float(u.get("maxHp", 0) or 0))
+        w.enum(ANIM_CODES, u.get("anim", "idle"))
+        w.enum(DIR_CODES, str(u.get("dir", "000")).zfill(3))
+    return w.getvalue()
+
+
+WIRE_ENCODERS = {
+    "bin1": {
+        "map_objects_delta": encode_map_delta_bin,
+        "map_objects_motion": encode_motion_bin,
+        "update_units": encode_units_bin,
+    },
+}
+
+
+def negotiate_codec(sid, offered):
+    """Pick the first server-preferred codec the client offered (json otherwise)."""
+    offered = offered if isinstance(offered, list) else []
+    codec = next((c for c in WIRE_CODECS if c in offered), "json")
+    sid_codecs.pop(sid, None)
+    if codec != "json":
+        sid_codecs[sid] = codec
+    return codec
+
+
+def encode_frame(codec, event, payload):
+    """(wire event, data) for one client codec."""
+    encoder = WIRE_ENCODERS.get(codec, {}).get(event)
+    data = encoder(payload) if encoder else None
+    if data is not None:
+        return "bin", data
+    return event, payload
+
+
+# Outbound queues: broadcast hot events are queued per client and drained
+# by the feed job within an ack window, so a slow link backs up in its own
+# queue instead of the socket buffers. Queued frames of the same stream
+# are superseded (state, unit batches) or merged (feed deltas) rather
+# than appended.
+OUTBOX_WINDOW_BYTES = 256 * 1024  # unacked bytes in flight per client
+OUTBOX_MAX_BYTES = 1024 * 1024  # queued bytes before feed deltas collapse into a resync
+OUTBOX_MAX_AGE = 2.0  # a frame queued longer than this marks the client slow
+OUTBOX_ACK_TIMEOUT = 5.0  # unacked frames are written off after this
+SLOW_PUBLISH_INTERVAL = 0.25  # slow clients are drained at most this often
+SLOW_RECOVER_AFTER = 5.0  # seconds without backlog before a slow client recovers
+
+# Per-client scheduling: each drain a client gets CLIENT_TICK_BUDGET bytes.
+# Queued frames go out by stream priority; the rest of the budget goes to
+# NPC motion, ranked by distance to the client's units, ownership and how
+# long the update has been waiting, so far-away movement thins out first
+# and nothing starves indefinitely.
+CLIENT_TICK_BUDGET = 16 * 1024
+STREAM_PRIORITY = {"delta": 3.0, "update_units": 2.0, "state": 1.0}
+PRIORITY_DISTANCE = 600.0  # px at which distance halves an update's priority
+PRIORITY_OWNED_BOOST = 4.0
+PRIORITY_STARVATION = 0.5  # seconds of waiting that doubles priority
+MOTION_PATCH_BYTES = {"bin1": 40, "json": 220}  # per-patch estimates for budgeting
+
+def mark_motion(oid):
+    """Lossy latest-wins NPC movement, scheduled per client (not in the feed log)."""
+    w = bound_world()
+    w.motion_dirty.add(oid)
+    note_row_change("map_objects", oid, w)
+
+
+def stream_priority(entry, now):
+    event = entry["event"]
+    if event.endswith("_delta") or event == "resync":
+        base = STREAM_PRIORITY["delta"]
+    else:
+        base = STREAM_PRIORITY.get(event, 1.0)
+    return base * (1.0 + (now - entry["t"]) / PRIORITY_STARVATION)
+
+
+def motion_priority(obj, anchors, pid, waited):
+    x = float(obj.get("x", 0))
+    y = float(obj.get("y", 0))
+    if anchors:
+        dist = min(math.hypot(x - ax, y - ay) for ax, ay in anchors)
+        score = 1.0 / (1.0 + dist / PRIORITY_DISTANCE)
+    else:
+        score = 0.1
+    if pid and obj.get("owner") == pid:
+        score *= PRIORITY_OWNED_BOOST
+    return score * (1.0 + waited / PRIORITY_STARVATION)
+
+
+def outbox_stream(event, payload):
+    """(stream key, mode) for a broadcast event; mode is "replace" or "merge"."""
+    if event == "update_units":
+        return f"update_units:{payload.get('sid')}", "replace"
+    if event.endswith("_delta"):
+        return event, "merge"
+    return event, "replace"
+
+
+def _merge_patch(base, patch):
+    out = dict(base)
+    for k, v in patch.items():
+        if k == "meta":
+            out["meta"] = {**(base.get("meta") or {}), **(v or {})}
+        else:
+            out[k] = v
+    return out
+
+
+def merge_feed_deltas(first, second):
+    """Fold two consecutive feed deltas into one covering base..second.seq."""
+    ops = {}
+    for delta in (first, second):
+        for oid in delta["remove"]:
+            ops[oid] = ("remove", None)
+        for obj in delta["upsert"]:
+            ops[obj["id"]] = ("upsert", obj)
+        for p in delta["patch"]:
+            kind, current = ops.get(p["id"], (None, None))
+            if kind in ("upsert", "patch"):
+                ops[p["id"]] = (kind, _merge_patch(current, p))
+            elif kind is None:
+                ops[p["id"]] = ("patch", p)
+    merged = {"base": first.get("base", first["seq"] - 1), "seq": second["seq"],
+              "upsert": [], "patch": [], "remove": []}
+    for oid, (kind, value) in ops.items():
+        merged[kind].append(oid if kind == "remove" else value)
+    return merged
+
+
+class ClientOutbox:
+    def __init__(self, sid):
+        self.sid = sid
+        self.world = bound_world()  # moved to the chosen world at login
+        self.queue = OrderedDict()  # stream key -> entry
+        self.queued_bytes = 0
+        self.inflight = {}  # token -> (bytes, sent_at)
+        self.inflight_bytes = 0
+        self.next_token = 0
+        self.slow = False
+        self.last_send = 0.0
+        self.last_backlog = 0.0
+        self.motion = {}  # map object id -> time its motion update became pending
+        self.direct = []  # (event, data) emitted to this client since the last drain
+        self.send_lock = Lock()  # keeps a reply flush and the tick's bundle in emit order
+        self.stats = {"sent": 0, "replaced": 0, "merged": 0, "resyncs": 0, "ack_timeouts": 0, "motion": 0,
+                      "bundles": 0, "messages": 0}
+
+    def push(self, stream, mode, event, payload, frame, size):
+        now = time.time()
+        queued_at = now
+        old = self.queue.pop(stream, None)
+        if old is not None:
+            self.queued_bytes -= old["size"]
+            queued_at = old["t"]
+            if mode == "merge" and old["event"] == "resync":
+                # the pending snapshot will include this change as well
+                self.queue[stream] = old
+                self.queued_bytes += old["size"]
+                return
+            if mode == "merge":
+                payload = merge_feed_deltas(old["payload"], payload)
+                frame = None  # merged payload is encoded at send time
+                size += old["size"]
+                self.stats["merged"] += 1
+            else:
+                self.stats["replaced"] += 1
+        self.queue[stream] = {"event": event, "payload": payload, "frame": frame, "size": size, "t": queued_at}
+        self.queued_bytes += size
+        if self.queued_bytes > OUTBOX_MAX_BYTES:
+            self.collapse()
+
+    def collapse(self):
+        """Over the byte budget: queued feed deltas become full resyncs."""
+        for stream, entry in self.queue.items():
+            if entry["event"].endswith("_delta"):
+                name = entry["event"][:-len("_delta")]
+                self.queue[stream] = {"event": "resync", "payload": name, "frame": None, "size": 0, "t": entry["t"]}
+                self.stats["resyncs"] += 1
+        self.queued_bytes = sum(e["size"] for e in self.queue.values())
+        self.set_slow(True, "byte budget exceeded")
+
+    def ack(self, token):
+        size, _ = self.inflight.pop(token, (0, 0))
+        self.inflight_bytes -= size
+
+    def claim(self, entry, now):
+        """Account a frame as in flight and return its ack token."""
+        self.next_token += 1
+        self.inflight[self.next_token] = (entry["size"], now)
+        self.inflight_bytes += entry["size"]
+        return self.next_token
+
+    def take(self, now):
+        """Pop queued frames by priority within this tick's byte budget and
+        the ack window. Returns ([(token, entry)], budget left for motion)."""
+        for token, (_, sent_at) in list(self.inflight.items()):
+            if now - sent_at > OUTBOX_ACK_TIMEOUT:
+                self.ack(token)
+                self.stats["ack_timeouts"] += 1
+        if self.queue:
+            oldest = min(e["t"] for e in self.queue.values())
+            if now - oldest > OUTBOX_MAX_AGE:
+                self.set_slow(True, f"oldest frame {now - oldest:.1f}s")
+        frames = []
+        if self.slow and now - self.last_send < SLOW_PUBLISH_INTERVAL:
+            return frames, 0
+        budget = CLIENT_TICK_BUDGET
+        ranked = sorted(self.queue.items(), key=lambda kv: stream_priority(kv[1], now), reverse=True)
+        for stream, entry in ranked:
+            if self.inflight_bytes >= OUTBOX_WINDOW_BYTES:
+                break
+            # a frame bigger than the whole budget still goes first, alone
+            if frames and entry["size"] > budget:
+                continue
+            del self.queue[stream]
+            self.queued_bytes -= entry["size"]
+            budget -= entry["size"]
+            frames.append((self.claim(entry, now), entry))
+        if frames:
+            self.last_send = now
+        if self.queue:
+            self.last_backlog = now
+        elif self.slow and now - self.last_backlog > SLOW_RECOVER_AFTER:
+            self.set_slow(False, "backlog cleared")
+        if self.inflight_bytes >= OUTBOX_WINDOW_BYTES:
+            budget = 0
+        return frames, max(0, budget)
+
+    def take_motion(self, budget, now):
+        """Highest-priority pending NPC motion that fits in budget, as one frame."""
+        if not self.motion or budget <= 0:
+            return None
+        pid = world.sid_to_player.get(self.sid)
+        units = (world.players.get(pid) or {}).get("units") or []
+        anchors = [(float(u.get("x", 0)), float(u.get("y", 0))) for u in units if u.get("hp", 1) > 0]
+        ranked = []
+        for oid, since in list(self.motion.items()):
+            obj = world.map_index.get(oid)
+            if obj is None:
+                del self.motion[oid]
+                continue
+            ranked.append((motion_priority(obj, anchors, pid, now - since), oid, obj))
+        if not ranked:
+            return None
+        ranked.sort(key=lambda r: r[0], reverse=True)
+        per_patch = MOTION_PATCH_BYTES.get(sid_codecs.get(self.sid, "json"), MOTION_PATCH_BYTES["json"])
+        patches = []
+        for _, oid, obj in ranked[:max(1, int(budget // per_patch))]:
+            patches.append(patch_entry(obj, NPC_PATCH_KEYS, NPC_PATCH_META_KEYS))
+            del self.motion[oid]
+        self.stats["motion"] += len(patches)
+        entry = {"event": "map_objects_motion", "payload": {"patch": patches}, "frame": None,
+                 "size": len(patches) * per_patch, "t": now}
+        return self.claim(entry, now), entry
+
+    def set_slow(self, slow, reason):
+        if slow != self.slow:
+            self.slow = slow
+            self.last_backlog = time.time()
+            state = "slow" if slow else "recovered"
+            print(f"[OUTBOX] sid={self.sid} player={self.world.sid_to_player.get(self.sid)} {state}: {reason} "
+                  f"(queued={self.queued_bytes}B inflight={self.inflight_bytes}B)", flush=True)
+
+
+outboxes = {}  # sid -> ClientOutbox
+outbox_lock = Lock()
+
+
+def sid_world(sid):
+    """The world a socket plays in (the first world until it logs in)."""
+    box = outboxes.get(sid)
+    return box.world if box is not None else worlds[DEFAULT_WORLD]
+
+
+def players_online():
+    return sum(len(w.sid_to_player) for w in worlds.values())
+
+
+def world_event(event):
+    """socketio.on(event), running the handler bound to the sender's world."""
+    def decorate(fn):
+        @wraps(fn)
+        def handler(*args):
+            with sid_world(request.sid).bound():
+                return fn(*args)
+        return socketio.on(event)(handler)
+    return decorate
+
+
+def outbox_ack(sid, tokens, *args):
+    with outbox_lock:
+        box = outboxes.get(sid)
+        if box:
+            for token in tokens:
+                box.ack(token)
+
+
+def queue_emit(event, data=None, to=None, skip_sid=None):
+    """socketio.emit, never budgeted or dropped and delivered in emit order.
+
+    Broadcasts reach the clients of the bound world and are collected into
+    each recipient's per-tick bundle, ahead of its queued stream frames.
+    A message to one client is a reply (acks, rejections, snapshots) and is
+    flushed right away, together with anything still pending for that
+    client. Targets without an outbox (rooms, unknown ids) get a plain emit.
+    """
+    with outbox_lock:
+        if to is None:
+            w = bound_world()
+            for sid, box in outboxes.items():
+                if sid != skip_sid and box.world is w:
+                    box.direct.append((event, data))
+            return
+        box = outboxes.get(to)
+        if box is not None:
+            box.direct.append((event, data))
+    if box is not None:
+        flush_direct(box)
+        return
+    socketio.emit(event, data, to=to)
+
+
+def send_bundle(box, direct, frames=()):
+    """Emit one "bundle": direct messages first, then the claimed frames.
+    The caller holds box.send_lock."""
+    messages = [[event, data] for event, data in direct]
+    tokens = []
+    for token, entry in frames:
+        tokens.append(token)
+        if entry["event"] == "resync":
+            with box.world.bound():
+                messages.append(["feed_snapshot", collection_snapshot(entry["payload"])])
+        else:
+            event, data = entry["frame"] or encode_frame(sid_codecs.get(box.sid), entry["event"], entry["payload"])
+            messages.append([event, data])
+        box.stats["sent"] += 1
+    if not messages:
+        return
+    box.stats["bundles"] += 1
+    box.stats["messages"] += len(messages)
+    if tokens:
+        socketio.emit("bundle", messages, to=box.sid, callback=partial(outbox_ack, box.sid, tokens))
+    else:
+        socketio.emit("bundle", messages, to=box.sid)
+
+
+def flush_direct(box):
+    """Send a client's pending direct messages now instead of on the next tick."""
+    with box.send_lock:
+        with outbox_lock:
+            direct, box.direct = box.direct, []
+        send_bundle(box, direct)
+
+
+def drain_outboxes():
+    """Send each client one "bundle" per tick: its pending broadcast messages,
+    then the queued frames its budget and window allow. Replies flushed by
+    queue_emit take the same send_lock, so a client's messages always
+    arrive in order."""
+    now = time.time()
+    touched = {}
+    for w in worlds.values():
+        touched[w.id] = list(w.motion_dirty)
+        w.motion_dirty.clear()
+    with outbox_lock:
+        batches = []
+        for box in outboxes.values():
+            for oid in touched.get(box.world.id, ()):
+                box.motion.setdefault(oid, now)
+            frames, budget = box.take(now)
+            with box.world.bound():
+                motion = box.take_motion(budget, now)
+            if motion:
+                frames.append(motion)
+            batches.append((box, frames))
+    for box, frames in batches:
+        with box.send_lock:
+            with outbox_lock:
+                direct, box.direct = box.direct, []
+            send_bundle(box, direct, frames)
+
+
+def seed_motion(sid):
+    now = time.time()
+    with outbox_lock:
+        box = outboxes.get(sid)
+        if box:
+            for o in world.map_objects:
+                if o.get("kind") in ("npc", "spider"):
+                    box.motion.setdefault(o.get("id"), now)
+
+
+def outbox_stats():
+    with outbox_lock:
+        boxes = list(outboxes.values())
+    totals = {k: sum(b.stats[k] for b in boxes)
+              for k in ("sent", "replaced", "merged", "resyncs", "ack_timeouts", "motion", "bundles", "messages")}
+    return {
+        "clients": len(boxes),
+        "queued_bytes": sum(b.queued_bytes for b in boxes),
+        "inflight_bytes": sum(b.inflight_bytes for b in boxes),
+        "pending_motion": sum(len(b.motion) for b in boxes),
+        "slow": [{"sid": b.sid, "player": b.world.sid_to_player.get(b.sid), "world": b.world.id,
+                  "queued_bytes": b.queued_bytes,
+                  "inflight_bytes": b.inflight_bytes} for b in boxes if b.slow],
+        **totals,
+    }
+
+
+def _frame_size(frame):
+    event, data = frame
+    if isinstance(data, (bytes, bytearray)):
+        return len(data) + len(event)
+    return len(json.dumps(data, separators=(",", ":"))) + len(event)
+
+
+def emit_hot(event, payload, to=None, skip_sid=None):
+    """Emit a high-rate event, encoded per client codec.
+
+    Binary clients receive a single "bin" event whose first byte says which
+    event it replaces; JSON clients get the original event unchanged.
+    Broadcasts are queued as stream frames for the bound world's clients;
+    targeted sends go out with the client's direct messages.
+    """
+    if to is not None:
+        queue_emit(*encode_frame(sid_codecs.get(to), event, payload), to=to)
+        return
+    stream, mode = outbox_stream(event, payload)
+    frames = {}  # codec -> (frame, size), encoded once per broadcast
+    w = bound_world()
+    with outbox_lock:
+        for sid, box in outboxes.items():
+            if sid == skip_sid or box.world is not w:
+                continue
+            codec = sid_codecs.get(sid, "json")
+            if codec not in frames:
+                frame = encode_frame(codec, event, payload)
+                frames[codec] = (frame, _frame_size(frame))
+            frame, size = frames[codec]
+            box.push(stream, mode, event, payload, frame, size)
+
+
+# Change feeds: per-collection batches of upsert/patch/remove deltas with a
+# sequence number. Handlers record which ids changed; the feed loop builds the
+# payloads from the live objects and emits one "<name>_delta" per batch.
+# Clients that notice a gap in seq ask for a resync and get the full list.
+FEED_FLUSH_INTERVAL = 1 / 30
+# Flushed deltas kept per feed so a reconnecting client can catch up from
+# its last seq instead of reloading the collection (~30s of busy ticks).
+FEED_LOG_SIZE = 900
+
+
+def patch_entry(obj, keys, meta_keys=()):
+    """{"id", *keys, "meta": {*meta_keys}} taken from the live object."""
+    entry = {"id": obj.get("id")}
+    for k in keys:
+        entry[k] = obj.get(k)
+    if meta_keys:
+        meta = obj.get("meta") or {}
+        entry["meta"] = {k: meta.get(k) for k in meta_keys}
+    return entry
+
+
+class ChangeFeed:
+    def __init__(self, name, lookup, wire=None):
+        self.name = name
+        self.lookup = lookup
+        self.wire = wire or (lambda obj: obj)
+        self.seq = 0
+        # id -> "upsert" | "remove" | (top-level keys, meta keys) for patches
+        self.pending = {}
+        self.log = deque(maxlen=FEED_LOG_SIZE)
+
+    def upsert(self, oid):
+        self.pending[oid] = "upsert"
+        note_row_change(self.name, oid)
+
+    def remove(self, oid):
+        self.pending[oid] = "remove"
+        note_row_change(self.name, oid)
+
+    def patch(self, oid, keys=(), meta_keys=()):
+        """Send only some fields of an existing object (merged client side)."""
+        note_row_change(self.name, oid)
+        current = self.pending.get(oid)
+        if current in ("upsert", "remove"):
+            return
+        if current is None:
+            current = (set(), set())
+            self.pending[oid] = current
+        current[0].update(keys)
+        current[1].update(meta_keys)
+
+    def build(self):
+        """Turn pending ids into a delta payload (or None) and advance seq."""
+        if not self.pending:
+            return None
+        pending, self.pending = self.pending, {}
+        delta = {"seq": self.seq + 1, "upsert": [], "patch": [], "remove": []}
+        for oid, op in pending.items():
+            obj = None if op == "remove" else self.lookup(oid)
+            if obj is None:
+                delta["remove"].append(oid)
+            elif op == "upsert":
+                delta["upsert"].append(self.wire(obj))
+            else:
+                delta["patch"].append(patch_entry(obj, *op))
+        self.seq += 1
+        return delta
+
+    def flush(self):
+        delta = self.build()
+        if delta:
+            self.log.append(delta)
+            emit_hot(f"{self.name}_delta", delta)
+        return delta
+
+    def since(self, seq):
+        """Deltas after seq, or None if seq is unknown or aged out of the log."""
+        if seq == self.seq:
+            return []
+        if seq > self.seq or not self.log or self.log[0]["seq"] > seq + 1:
+            return None
+        return [d for d in self.log if d["seq"] > seq]
+
+
+def reindex_resources():
+    world.resource_index.clear()
+    world.resource_index.update((r.get("id"), r) for r in world.resources)
+
+
+def flush_change_feeds():
+    for feed in world.feeds.values():
+        feed.flush()
+
+
+def feed_seqs():
+    return {name: feed.seq for name, feed in world.feeds.items()}
+
+
+def collection_snapshot(name):
+    """Full list of one collection with its current seq (join / resync)."""
+    if name == "map_objects":
+        items = compact_map_objects()
+    elif name == "ground_items":
+        items = world.ground_items
+    else:
+        items = world.resources
+    return {"collection": name, "epoch": world.epoch, "seq": world.feeds[name].seq, "items": items}
+
+
+def emit_collection_snapshot(name, to_sid):
+    if name in world.feeds:
+        queue_emit("feed_snapshot", collection_snapshot(name), to=to_sid)
+
+
+def sync_collections(to_sid, since, names=None):
+    """Bring a client from its last applied version up to date.
+
+    since is {"epoch": ..., "feeds": {collection: seq}} as echoed by the
+    client. Collections whose seq is still covered by the feed log get the
+    missed deltas in one feed_catchup event; everything else (unknown
+    epoch, aged-out seq, no version at all) falls back to a snapshot.
+    """
+    since = since if isinstance(since, dict) else {}
+    seqs = since.get("feeds") if since.get("epoch") == world.epoch else None
+    seqs = seqs if isinstance(seqs, dict) else {}
+    for name in (names or world.feeds):
+        seq = seqs.get(name)
+        deltas = world.feeds[name].since(seq) if isinstance(seq, int) else None
+        if deltas is None:
+            emit_collection_snapshot(name, to_sid)
+        elif deltas:
+            queue_emit("feed_catchup", {"collection": name, "deltas": deltas}, to=to_sid)
+
+
+# Static world layer: everything that does not move on its own (buildings,
+# decorations, mines, resources, trees) is bucketed into square chunks and
+# served over HTTP as gzip'd JSON named by content hash, so browsers and
+# proxies cache them forever. Login sends only the dynamic layer (NPCs,
+# ground items) plus a chunk manifest; feed deltas after the manifest's
+# seqs keep the chunks current on the client.
+STATIC_CHUNK_SIZE = 2048
+STATIC_CHUNK_RETAIN = 512  # bodies kept so manifests already sent still resolve
+MOTION_KINDS = ("npc", "spider")
+
+static_chunk_bodies = OrderedDict()  # content hash -> gzip'd chunk JSON
+
+
+def static_chunk_key(x, y):
+    return int(math.floor(float(x or 0) / STATIC_CHUNK_SIZE)), int(math.floor(float(y or 0) / STATIC_CHUNK_SIZE))
+
+
+def dynamic_map_objects():
+    return [compact_map_object(o) for o in world.map_objects if o.get("kind") in MOTION_KINDS]
+
+
+def static_layer_manifest():
+    """Chunk manifest for the current world, rebuilt only when it changed."""
+    version = (world.epoch, world.map_feed.seq, world.resources_feed.seq, len(world.trees), len(world.map_feed.pending), len(world.resources_feed.pending),
+               world.pager.generation if world.pager is not None else 0)
+    if world.static_manifest_cache["version"] == version:
+        return world.static_manifest_cache["manifest"]
+    chunks = {}
+
+    def bucket(x, y):
+        key = static_chunk_key(x, y)
+        if key not in chunks:
+            chunks[key] = {"map_objects": [], "resources": [], "trees": []}
+        return chunks[key]
+
+    for o in world.map_objects:
+        if o.get("kind") not in MOTION_KINDS:
+            bucket(o.get("x"), o.get("y"))["map_objects"].append(compact_map_object(o))
+    for r in world.resources:
+        bucket(r.get("x"), r.get("y"))["resources"].append(r)
+    for t in world.trees:
+        bucket(t.get("x"), t.get("y"))["trees"].append(t)
+    if world.pager is not None:
+        # one entry per coordinate: a paged-out chunk that shares its cell with
+        # live resources or trees is folded into that body
+        for key in world.pager.dormant_keys():
+            if key in chunks:
+                chunks[key]["map_objects"].extend(world.pager.dormant_rows(key))
+
+    entries = []
+    for (cx, cy), body in sorted(chunks.items()):
+        raw = json.dumps(body, separators=(",", ":"), sort_keys=True).encode("utf-8")
+        digest = hashlib.sha1(raw).hexdigest()[:20]
+        if digest not in static_chunk_bodies:
+            static_chunk_bodies[digest] = gzip.compress(raw, compresslevel=6, mtime=0)
+        static_chunk_bodies.move_to_end(digest)
+        entries.append({"cx": cx, "cy": cy, "hash": digest,
+                        "count": len(body["map_objects"]) + len(body["resources"]) + len(body["trees"])})
+    if world.pager is not None:
+        # the other paged-out chunks (dormant NPCs included) are served from their files
+        entries += world.pager.dormant_manifest_entries(skip=chunks)
+    while len(static_chunk_bodies) > max(STATIC_CHUNK_RETAIN * len(worlds), len(entries)):
+        static_chunk_bodies.popitem(last=False)
+    manifest = {"chunk_size": STATIC_CHUNK_SIZE, "chunks": entries,
+                "seqs": {"map_objects": world.map_feed.seq, "resources": world.resources_feed.seq}}
+    world.static_manifest_cache.update(version=version, manifest=manifest)
+    return manifest
+
+
+# Persistence marks: handlers flag a collection dirty and the persist loop
+# writes each dirty file at most once per PERSIST_INTERVAL.
+PERSIST_INTERVAL = 1.0
+
+
+def mark_dirty(name):
+    world.dirty_collections.add(name)
+
+
+def flush_dirty():
+    for name, lock, save in (("map", world.map_lock, save_map),
+                             ("ground", world.ground_lock, save_ground),
+                             ("resources", world.resources_lock, save_resources),
+                             ("terrain", world.terrain_lock, save_terrain)):
+        if name not in world.dirty_collections:
+            continue
+        world.dirty_collections.discard(name)
+        try:
+            with lock:
+                save()
+        except OSError:
+            world.dirty_collections.add(name)
+            raise
+
+
+class CollisionIndex:
+    """Uniform-grid broad phase over colliding map objects.
+
+    Boxes come from each object's resolved meta (i.e. its archetype geometry
+    plus overrides); callers still run their own exact overlap test on the
+    returned candidates.
+    """
+
+    CELL = 256
+
+    def __init__(self):
+        self.cells = {}
+        self.dirty = True
+
+    def _cell_range(self, lo, hi):
+        return range(int(math.floor(lo / self.CELL)), int(math.floor(hi / self.CELL)) + 1)
+
+    def rebuild(self, objs):
+        self.cells = {}
+        for obj in objs:
+            self.add(obj)
+        self.dirty = False
+
+    def add(self, obj):
+        meta = obj.get("meta") or {}
+        if not meta.get("collides"):
+            return
+        try:
+            cw = float(meta.get("cw") or meta.get("w") or 0)
+            ch = float(meta.get("ch") or meta.get("h") or 0)
+            cx = float(obj.get("x", 0)) + float(meta.get("cx", 0) or 0)
+            cy = float(obj.get("y", 0)) + float(meta.get("cy", 0) or 0)
+        except (TypeError, ValueError):
+            return
+        if cw <= 0 or ch <= 0:
+            return
+        for gx in self._cell_range(cx - cw / 2, cx + cw / 2):
+            for gy in self._cell_range(cy - ch / 2, cy + ch / 2):
+                self.cells.setdefault((gx, gy), []).append(obj)
+
+    def candidates(self, x, y, pad=0.0):
+        """Colliding objects whose box may lie within *pad* of (x, y)."""
+        if self.dirty:
+            self.rebuild(world.map_objects)
+        seen = set()
+        out = []
+        for gx in self._cell_range(x - pad, x + pad):
+            for gy in self._cell_range(y - pad, y + pad):
+                for obj in self.cells.get((gx, gy), ()):
+                    if id(obj) in seen:
+                        continue
+                    seen.add(id(obj))
+                    out.append(obj)
+        return out
+
+
+def invalidate_collision_index():
+    world.collision_index.dirty = True
+
+class WorldDB:
+    """SQLite world store: one table per collection, rows upserted by id.
+
+    Rows carry a few typed columns for ad-hoc queries plus the object itself
+    as compact JSON (map objects in their archetype-compacted wire form).
+    Ids reach the dirty sets through the change feeds and mark_motion; a
+    periodic reconcile pass diffs every row against what was last written to
+    catch mutations that bypass the feeds. Either way only rows whose JSON
+    actually changed are written, in one transaction per flush.
+    """
+
+    # ids are left untyped: resources use integer ids, everything else uuids
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS map_objects (id PRIMARY KEY, kind TEXT, x REAL, y REAL, owner TEXT, body TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS ground_items (id PRIMARY KEY, x REAL, y REAL, body TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS resources (id PRIMARY KEY, type TEXT, x REAL, y REAL, body TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS archetypes (kind TEXT PRIMARY KEY, body TEXT NOT NULL)",
+    )
+    UPSERT = {
+        "map_objects": "INSERT INTO map_objects (id, kind, x, y, owner, body) VALUES (?, ?, ?, ?, ?, ?) "
+                       "ON CONFLICT(id) DO UPDATE SET kind=excluded.kind, x=excluded.x, y=excluded.y, "
+                       "owner=excluded.owner, body=excluded.body",
+        "ground_items": "INSERT INTO ground_items (id, x, y, body) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT(id) DO UPDATE SET x=excluded.x, y=excluded.y, body=excluded.body",
+        "resources": "INSERT INTO resources (id, type, x, y, body) VALUES (?, ?, ?, ?, ?) "
+                     "ON CONFLICT(id) DO UPDATE SET type=excluded.type, x=excluded.x, y=excluded.y, body=excluded.body",
+    }
+    COLLECTIONS = tuple(UPSERT)
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        # autocommit mode: transactions are opened explicitly per flush
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for ddl in self.SCHEMA:
+            self.conn.execute(ddl)
+        self.dirty = {name: set() for name in self.COLLECTIONS}
+        # id -> hash of the JSON body last written, so unchanged rows are skipped
+        self.written = {name: {} for name in self.COLLECTIONS}
+        self.written_archetypes = None
+        self.last_reconcile = time.time()
+
+    def is_empty(self):
+        return not any(self.conn.execute(f"SELECT 1 FROM {name} LIMIT 1").fetchone()
+                       for name in self.COLLECTIONS)
+
+    def row(self, name, obj):
+        oid = obj.get("id")
+        if name == "map_objects":
+            body = json.dumps(compact_map_object(obj), ensure_ascii=False, separators=(",", ":"))
+            return (oid, obj.get("kind"), obj.get("x"), obj.get("y"), obj.get("owner"), body)
+        body = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+        if name == "resources":
+            return (oid, obj.get("type"), obj.get("x"), obj.get("y"), body)
+        return (oid, obj.get("x"), obj.get("y"), body)
+
+    def load(self, name):
+        items = []
+        written = self.written[name]
+        for oid, body in self.conn.execute(f"SELECT id, body FROM {name} ORDER BY rowid"):
+            written[oid] = hash(body)
+            items.append(json.loads(body))
+        return items
+
+    def load_map(self):
+        """Same shape as map_objects.json: {"schema": n, "archetypes": {...}, "objects": [...]}."""
+        archetypes = {kind: json.loads(body) for kind, body in self.conn.execute("SELECT kind, body FROM archetypes")}
+        self.written_archetypes = hash(json.dumps(archetypes, sort_keys=True))
+        return {"schema": self.schema(), "archetypes": archetypes, "objects": self.load("map_objects")}
+
+    def schema(self):
+        # the world schema version lives in SQLite's own header field
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def set_schema(self, version):
+        self.conn.execute(f"PRAGMA user_version = {int(version)}")
+
+    def flush(self, names=None):
+        """Write the dirty rows of *names* (default: all collections) in one transaction."""
+        names = names or self.COLLECTIONS
+        upserts, deletes = {}, {}
+        for name in names:
+            ids, self.dirty[name] = self.dirty[name], set()
+            lookup = world.feeds[name].lookup
+            written = self.written[name]
+            for oid in ids:
+                obj = lookup(oid)
+                if obj is None:
+                    if written.pop(oid, None) is not None:
+                        deletes.setdefault(name, []).append((oid,))
+                    continue
+                row = self.row(name, obj)
+                digest = hash(row[-1])
+                if written.get(oid) != digest:
+                    upserts.setdefault(name, []).append(row)
+                    written[oid] = digest
+        archetypes = None
+        if "map_objects" in names:
+            digest = hash(json.dumps(world.learned_archetypes, sort_keys=True))
+            if digest != self.written_archetypes:
+                archetypes = [(kind, json.dumps(a, ensure_ascii=False, separators=(",", ":")))
+                              for kind, a in world.learned_archetypes.items()]
+                self.written_archetypes = digest
+        if not upserts and not deletes and archetypes is None:
+            return 0
+        with self.conn:
+            self.conn.execute("BEGIN")
+            for name, rows in upserts.items():
+                self.conn.executemany(self.UPSERT[name], rows)
+            for name, rows in deletes.items():
+                self.conn.executemany(f"DELETE FROM {name} WHERE id = ?", rows)
+            if archetypes is not None:
+                self.conn.execute("DELETE FROM archetypes")
+                self.conn.executemany("INSERT INTO archetypes (kind, body) VALUES (?, ?)", archetypes)
+        return sum(len(r) for r in upserts.values()) + sum(len(r) for r in deletes.values())
+
+    def reconcile(self):
+        """Diff every live row (and every row we think is stored) and write the differences."""
+        self.dirty["map_objects"].update(world.map_index)
+        self.dirty["ground_items"].update(world.ground_index)
+        self.dirty["resources"].update(world.resource_index)
+        for name in self.COLLECTIONS:
+            self.dirty[name].update(self.written[name])
+        self.last_reconcile = time.time()
+        return self.flush()
+
+    def import_json(self):
+        """One-shot import of map_objects.json, ground_items.json and resources.json (replaces the tables)."""
+        raw_map = load_json_file(world.map_file, "map objects", [])
+        if isinstance(raw_map, dict):
+            archetypes, objects = raw_map.get("archetypes") or {}, raw_map.get("objects") or []
+            schema = raw_map.get("schema", 0)
+        else:
+            archetypes, objects, schema = {}, raw_map, 0
+        sources = {
+            "map_objects": objects,
+            "ground_items": load_json_file(world.ground_file, "ground items", []),
+            "resources": load_json_file(world.res_file, "resources", []),
+        }
+        with self.conn:
+            self.conn.execute("BEGIN")
+            for name, items in sources.items():
+                self.conn.execute(f"DELETE FROM {name}")
+                # stored as found; the map rows are re-compacted by the first reconcile
+                rows = []
+                for obj in items:
+                    body = json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+                    rows.append(self.row(name, obj)[:-1] + (body,))
+                self.conn.executemany(self.UPSERT[name], rows)
+            self.conn.execute("DELETE FROM archetypes")
+            self.conn.executemany("INSERT INTO archetypes (kind, body) VALUES (?, ?)",
+                                  [(k, json.dumps(a, separators=(",", ":"))) for k, a in archetypes.items()])
+        # rows are imported as found; the next boot migrates them
+        self.set_schema(schema)
+        counts = {name: len(items) for name, items in sources.items()}
+        print(f"[WORLD_DB] Imported JSON into {self.path}: {counts}", flush=True)
+        return counts
+
+
+class WorldJournal:
+    """Append-only log of row images on top of the JSON snapshot files.
+
+    Each line is "<crc32 hex> <json>" holding the latest state of one row:
+    {"c": collection, "i": id, "v": row} with "v": null for deletions, or
+    {"c": "archetypes", "v": {...}}. Replay is latest-wins, so replaying a
+    journal over a snapshot that already contains some of it is harmless,
+    and compaction (rewrite the snapshots, then truncate) is crash safe.
+    """
+
+    COLLECTIONS = ("map_objects", "ground_items", "resources")
+
+    def __init__(self, path):
+        self.path = path
+        self.dirty = {name: set() for name in self.COLLECTIONS}
+        self.written = {name: {} for name in self.COLLECTIONS}
+        self.written_archetypes = None
+        self.tail = self.read_tail()
+        self.file = open(path, "ab")
+        self.last_compact = time.time()
+
+    def read_tail(self):
+        """Parse the journal into {collection: [(id, row or None)]}, truncating a corrupt tail."""
+        tail = {name: [] for name in self.COLLECTIONS + ("archetypes",)}
+        if not os.path.exists(self.path):
+            return tail
+        with open(self.path, "rb") as f:
+            raw = f.read()
+        good = 0
+        count = 0
+        for line in raw.splitlines(keepends=True):
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("torn record")
+                crc, payload = line.rstrip(b"\n").split(b" ", 1)
+                if int(crc, 16) != zlib.crc32(payload):
+                    raise ValueError("checksum mismatch")
+                rec = json.loads(payload)
+                if rec["c"] not in tail:
+                    raise ValueError(f"unknown collection {rec['c']!r}")
+            except (ValueError, KeyError, TypeError) as exc:
+                backup_path = f"{self.path}.corrupt.{int(time.time())}"
+                try:
+                    with open(backup_path, "wb") as backup:
+                        backup.write(raw)
+                    print(f"[JOURNAL] Saved unreadable journal to {backup_path}", flush=True)
+                except OSError as backup_exc:
+                    print(f"[JOURNAL] Failed to write journal backup: {backup_exc}", flush=True)
+                print(f"[JOURNAL] {self.path} is corrupt after {count} records ({exc}); dropping the rest", flush=True)
+                with open(self.path, "r+b") as f:
+                    f.truncate(good)
+                break
+            tail[rec["c"]].append((rec.get("i"), rec.get("v")))
+            good += len(line)
+            count += 1
+        if count:
+            print(f"[JOURNAL] Replaying {count} records from {self.path}", flush=True)
+        return tail
+
+    def replay(self, name, items):
+        """Apply the journal tail of one collection onto its snapshot list."""
+        records = self.tail.get(name)
+        if not records:
+            return items
+        by_id = {item.get("id"): item for item in items}
+        for oid, row in records:
+            if row is None:
+                by_id.pop(oid, None)
+            else:
+                by_id[oid] = row
+        self.tail[name] = []
+        return list(by_id.values())
+
+    def replay_map(self, raw):
+        if not isinstance(raw, dict):
+            raw = {"archetypes": {}, "objects": raw}
+        archetypes = dict(raw.get("archetypes") or {})
+        for _, row in self.tail.get("archetypes", ()):
+            archetypes = row or {}
+        self.tail["archetypes"] = []
+        # journal rows may be newer than the base's schema; migrations are idempotent
+        return {"schema": raw.get("schema", 0), "archetypes": archetypes,
+                "objects": self.replay("map_objects", raw.get("objects") or [])}
+
+    def record(self, rec):
+        payload = json.dumps(rec, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return b"%08x %s\n" % (zlib.crc32(payload), payload)
+
+    def flush(self):
+        """Group commit: append every changed row, then fsync once. Returns records written."""
+        lines = []
+        for name in self.COLLECTIONS:
+            ids, self.dirty[name] = self.dirty[name], set()
+            lookup = world.feeds[name].lookup
+            wire = world.feeds[name].wire
+            written = self.written[name]
+            for oid in ids:
+                obj = lookup(oid)
+                if obj is None:
+                    written.pop(oid, None)
+                    lines.append(self.record({"c": name, "i": oid, "v": None}))
+                    continue
+                row = wire(obj)
+                line = self.record({"c": name, "i": oid, "v": row})
+                digest = hash(line)
+                if written.get(oid) != digest:
+                    lines.append(line)
+                    written[oid] = digest
+        digest = hash(json.dumps(world.learned_archetypes, sort_keys=True))
+        if digest != self.written_archetypes:
+            lines.append(self.record({"c": "archetypes", "v": world.learned_archetypes}))
+            self.written_archetypes = digest
+        if lines:
+            self.file.write(b"".join(lines))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        return len(lines)
+
+    def size(self):
+        return self.file.tell()
+
+    def compact(self):
+        """Fold the journal into fresh snapshots and start an empty journal."""
+        self.flush()
+        write_world_snapshots()
+        self.file.truncate(0)
+        self.file.seek(0)
+        os.fsync(self.file.fileno())
+        self.last_compact = time.time()
+
+    def compact_due(self):
+        if self.size() >= JOURNAL_COMPACT_BYTES:
+            return True
+        return self.size() > 0 and time.time() - self.last_compact > JOURNAL_COMPACT_INTERVAL
+
+
+def note_row_change(name, oid, w=None):
+    w = w or bound_world()
+    if w.pager is not None and name == "map_objects":
+        w.pager.dirty_ids.add(oid)
+    if w.db is not None:
+        w.db.dirty[name].add(oid)
+    if w.journal is not None:
+        w.journal.dirty[name].add(oid)
+
+
+def open_world_journal():
+    if WORLD_STORE != "json" or not world.journal_path:
+        return None
+    return WorldJournal(world.journal_path)
+
+
+# ===== BINARY WORLD SNAPSHOT =====
+# Layout (little-endian, sections 8-byte aligned):
+#   header   magic "AOWSNAP\0", u16 version, u16 flags, u32 section count
+#   table    per section: 16-byte name, u64 offset, u64 length
+#   strings  u32 count, u32 offsets[count + 1], utf-8 bytes
+#   archetypes  compact JSON
+#   meta     compact JSON, {"schema": n} (absent in older files: schema 0)
+#   one section per collection, columnar:
+#     u32 count, pad, f64 x[count], f64 y[count],
+#     u32 id[count], u32 kind[count], u32 owner[count], ...   (string refs)
+#     u32 blob_offsets[count + 1], u8 flags[count], blob bytes
+# String refs index the string table; 0x80000000 | n is the integer n, and
+# ABSENT / NULL mark a missing key / None. Everything that does not fit a
+# column (meta, HP, waypoints, ...) is the row's compact JSON object; each is
+# followed by a comma so the whole blob parses as one JSON array when every
+# row is wanted, while single rows are sliced out by offset.
+SNAPSHOT_MAGIC = b"AOWSNAP\0"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ABSENT = 0xFFFFFFFF
+SNAPSHOT_NULL = 0xFFFFFFFE
+SNAPSHOT_INT = 0x80000000
+# collection -> string-ref columns (id, kind-like, owner, ...)
+SNAPSHOT_REF_FIELDS = {
+    "map_objects": ("id", "kind", "owner", "type"),
+    "ground_items": ("id", "name", "owner"),
+    "resources": ("id", "type", "owner"),
+}
+# flags bits: x present, x was an int, y present, y was an int
+SNAP_X, SNAP_X_INT, SNAP_Y, SNAP_Y_INT = 1, 2, 4, 8
+
+
+class SnapshotStrings:
+    def __init__(self, buf=None):
+        self.index = {}
+        self.values = []
+        if buf is not None:
+            count = struct.unpack_from("<I", buf, 0)[0]
+            self.offsets = buf[4:8 + 4 * count].cast("I")
+            self.data = buf[8 + 4 * count:]
+            self.values = [None] * count
+
+    def ref(self, value):
+        """Column ref for value, or None when it has to stay in the blob."""
+        if value is None:
+            return SNAPSHOT_NULL
+        if isinstance(value, str):
+            idx = self.index.get(value)
+            if idx is None:
+                idx = self.index[value] = len(self.values)
+                self.values.append(value)
+            return idx
+        if type(value) is int and 0 <= value < SNAPSHOT_NULL - SNAPSHOT_INT:
+            return SNAPSHOT_INT | value
+        return None
+
+    def value(self, ref):
+        if ref == SNAPSHOT_NULL:
+            return None
+        if ref & SNAPSHOT_INT:
+            return ref & ~SNAPSHOT_INT
+        value = self.values[ref]
+        if value is None:
+            value = self.values[ref] = str(self.data[self.offsets[ref]:self.offsets[ref + 1]], "utf-8")
+        return value
+
+    def pack(self):
+        encoded = [v.encode("utf-8") for v in self.values]
+        offsets = array("I", [0])
+        for b in encoded:
+            offsets.append(offsets[-1] + len(b))
+        return struct.pack("<I", len(encoded)) + snapshot_le(offsets) + b"".join(encoded)
+
+
+def snapshot_le(arr):
+    if sys.byteorder != "little":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def pack_snapshot_collection(name, items, strings):
+    ref_fields = SNAPSHOT_REF_FIELDS[name]
+    refs = [array("I") for _ in ref_fields]
+    xs, ys = array("d"), array("d")
+    flags = bytearray()
+    offsets = array("I", [0])
+    blobs = []
+    for item in items:
+        rest = dict(item)
+        for field, column in zip(ref_fields, refs):
+            ref = strings.ref(rest[field]) if field in rest else None
+            if ref is None:
+                column.append(SNAPSHOT_ABSENT)
+            else:
+                column.append(ref)
+                del rest[field]
+        flag = 0
+        for field, column, present, is_int in (("x", xs, SNAP_X, SNAP_X_INT), ("y", ys, SNAP_Y, SNAP_Y_INT)):
+            v = rest.get(field)
+            if type(v) is float or (type(v) is int and abs(v) < 2 ** 53):
+                column.append(float(v))
+                flag |= present | (is_int if type(v) is int else 0)
+                del rest[field]
+            else:
+                column.append(float("nan"))
+        flags.append(flag)
+        blob = json.dumps(rest, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b","
+        blobs.append(blob)
+        offsets.append(offsets[-1] + len(blob))
+    parts = [struct.pack("<I4x", len(flags)), snapshot_le(xs), snapshot_le(ys)]
+    parts += [snapshot_le(column) for column in refs]
+    parts += [snapshot_le(offsets), bytes(flags)] + blobs
+    return b"".join(parts)
+
+
+class SnapshotCollection(Sequence):
+    """Read-only view of one snapshot collection; rows materialize on access."""
+
+    def __init__(self, name, buf, strings):
+        self.ref_fields = SNAPSHOT_REF_FIELDS[name]
+        self.xs = self.ys = self.offsets = self.flags = self.blob = None
+        self.refs = []
+        try:
+            n = self.count = struct.unpack_from("<I", buf, 0)[0]
+            pos = 8
+            self.xs = buf[pos:pos + 8 * n].cast("d"); pos += 8 * n
+            self.ys = buf[pos:pos + 8 * n].cast("d"); pos += 8 * n
+            for _ in self.ref_fields:
+                self.refs.append(buf[pos:pos + 4 * n].cast("I")); pos += 4 * n
+            self.offsets = buf[pos:pos + 4 * (n + 1)].cast("I"); pos += 4 * (n + 1)
+            self.flags = buf[pos:pos + n]; pos += n
+            self.blob = buf[pos:]
+            if len(self.flags) != n or len(self.offsets) != n + 1 or len(self.blob) != self.offsets[n]:
+                raise ValueError(f"{name} section is truncated")
+        except (struct.error, TypeError, ValueError) as exc:
+            # the views pin the mmap; drop them so the snapshot can still be closed
+            self.release()
+            raise ValueError(f"malformed {name} section: {exc}") from exc
+        self.strings = strings
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        obj = json.loads(bytes(self.blob[self.offsets[i]:self.offsets[i + 1] - 1]))
+        return self._fill(obj, i, self.flags[i], self.xs[i], self.ys[i],
+                          [column[i] for column in self.refs])
+
+    def __iter__(self):
+        """All rows, parsing the blob section in one go."""
+        if not self.count:
+            return
+        blobs = json.loads(b"[" + bytes(self.blob[:-1]) + b"]")
+        refs = list(zip(*(column.tolist() for column in self.refs)))
+        for i, (obj, flag, x, y) in enumerate(zip(blobs, self.flags.tolist(), self.xs.tolist(), self.ys.tolist())):
+            yield self._fill(obj, i, flag, x, y, refs[i])
+
+    def _fill(self, obj, i, flag, x, y, refs):
+        value = self.strings.value
+        for field, ref in zip(self.ref_fields, refs):
+            if ref != SNAPSHOT_ABSENT:
+                obj[field] = value(ref)
+        if flag & SNAP_X:
+            obj["x"] = int(x) if flag & SNAP_X_INT else x
+        if flag & SNAP_Y:
+            obj["y"] = int(y) if flag & SNAP_Y_INT else y
+        return obj
+
+    def release(self):
+        for view in (self.xs, self.ys, self.offsets, self.flags, self.blob, *self.refs):
+            if view is not None:
+                view.release()
+
+
+class WorldSnapshot:
+    """A memory-mapped binary world snapshot. Call close() once loaded."""
+
+    def __init__(self, path):
+        if sys.byteorder != "little":
+            raise ValueError("memory-mapped snapshot columns need a little-endian host")
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self.mm)
+        try:
+            magic, version, _flags, count = struct.unpack_from("<8sHHI", self.buf, 0)
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError("not a world snapshot")
+            if version != SNAPSHOT_VERSION:
+                raise ValueError(f"unsupported snapshot version {version}")
+            sections = self.sections = {}  # filled in place so close() can release a partial read
+            for i in range(count):
+                raw_name, offset, length = struct.unpack_from("<16sQQ", self.buf, 16 + 32 * i)
+                if offset + length > len(self.buf):
+                    raise ValueError("section runs past end of file")
+                sections[raw_name.rstrip(b"\0").decode("ascii")] = self.buf[offset:offset + length]
+            self.strings = SnapshotStrings(sections["strings"])
+            self.archetypes = json.loads(bytes(sections["archetypes"]))
+            self.meta = json.loads(bytes(sections["meta"])) if "meta" in sections else {}
+            self.collections = {}
+            for name in SNAPSHOT_REF_FIELDS:
+                self.collections[name] = SnapshotCollection(name, sections[name], self.strings)
+        except (KeyError, struct.error, TypeError, json.JSONDecodeError) as exc:
+            self.close()
+            raise ValueError(f"malformed snapshot: {exc!r}") from exc
+        except ValueError:
+            self.close()
+            raise
+
+    def close(self):
+        for coll in getattr(self, "collections", {}).values():
+            coll.release()
+        strings = getattr(self, "strings", None)
+        if strings is not None and hasattr(strings, "offsets"):
+            strings.offsets.release()
+            strings.data.release()
+        for view in getattr(self, "sections", {}).values():
+            view.release()
+        self.buf.release()
+        self.mm.close()
+
+
+def pack_world_snapshot(path, archetypes, collections, schema=None):
+    """Write archetypes + {collection: rows} as a binary snapshot (atomically)."""
+    strings = SnapshotStrings()
+    bodies = {name: pack_snapshot_collection(name, collections.get(name) or [], strings)
+              for name in SNAPSHOT_REF_FIELDS}
+    meta = {"schema": WORLD_SCHEMA_VERSION if schema is None else schema}
+    sections = [("strings", strings.pack()),
+                ("archetypes", json.dumps(archetypes, ensure_ascii=False, separators=(",", ":")).encode("utf-8")),
+                ("meta", json.dumps(meta).encode("utf-8"))]
+    sections += list(bodies.items())
+    offset = 16 + 32 * len(sections)
+    table, payload = [], []
+    for name, body in sections:
+        pad = -offset % 8
+        payload.append(b"\0" * pad)
+        offset += pad
+        table.append(struct.pack("<16sQQ", name.encode("ascii"), offset, len(body)))
+        payload.append(body)
+        offset += len(body)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(struct.pack("<8sHHI", SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, len(sections)))
+        f.write(b"".join(table))
+        f.write(b"".join(payload))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def open_world_snapshot():
+    if not world.snapshot_path or world.journal is None or not os.path.exists(world.snapshot_path):
+        return None
+    try:
+        return WorldSnapshot(world.snapshot_path)
+    except (OSError, ValueError) as exc:
+        backup_path = f"{world.snapshot_path}.corrupt.{int(time.time())}"
+        try:
+            os.replace(world.snapshot_path, backup_path)
+            print(f"[SNAPSHOT] Moved unreadable snapshot to {backup_path}", flush=True)
+        except OSError as backup_exc:
+            print(f"[SNAPSHOT] Failed to back up snapshot: {backup_exc}", flush=True)
+        print(f"[SNAPSHOT] {world.snapshot_path} is unusable ({exc}); loading the JSON files", flush=True)
+        return None
+
+
+def write_world_snapshots():
+    """Journal compaction target: the binary snapshot if configured, else the JSON files."""
+    if not world.snapshot_path:
+        with world.map_lock:
+            if world.pager is not None:
+                world.pager.flush(everything=True)
+            else:
+                write_map_snapshot()
+        with world.ground_lock:
+            write_ground_snapshot()
+        with world.resources_lock:
+            write_resources_snapshot()
+        return
+    with world.map_lock:
+        archetypes, objects = dict(world.learned_archetypes), compact_map_objects()
+    with world.ground_lock:
+        ground = list(world.ground_items)
+    with world.resources_lock:
+        res = list(world.resources)
+    pack_world_snapshot(world.snapshot_path, archetypes, {"map_objects": objects, "ground_items": ground, "resources": res})
+
+
+def snapshot_cli(command, argv):
+    """python app.py snapshot-pack|snapshot-unpack [path]: convert between the JSON files and a snapshot."""
+    path = argv[0] if argv else (world.snapshot_path or "world.snap")
+    if command == "snapshot-pack":
+        raw = load_json_file(world.map_file, "map objects", [])
+        if not isinstance(raw, dict):
+            raw = {"archetypes": {}, "objects": raw}
+        pack_world_snapshot(path, raw.get("archetypes") or {}, {
+            "map_objects": raw.get("objects") or [],
+            "ground_items": load_json_file(world.ground_file, "ground items", []),
+            "resources": load_json_file(world.res_file, "resources", []),
+        }, schema=raw.get("schema", 0))
+        print(f"[SNAPSHOT] Packed JSON files into {path} ({os.path.getsize(path)} bytes)", flush=True)
+        return
+    snap = WorldSnapshot(path)
+    try:
+        data = {
+            world.map_file: {"schema": snap.meta.get("schema", 0), "archetypes": snap.archetypes,
+                       "objects": list(snap.collections["map_objects"])},
+            world.ground_file: list(snap.collections["ground_items"]),
+            world.res_file: list(snap.collections["resources"]),
+        }
+    finally:
+        snap.close()
+    for target, content in data.items():
+        tmp = target + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            if target == world.map_file:
+                json.dump(content, f, ensure_ascii=False, separators=(",", ":"))
+            else:
+                json.dump(content, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, target)
+    print(f"[SNAPSHOT] Unpacked {path} into {', '.join(data)}", flush=True)
+
+
+def open_world_db():
+    if WORLD_STORE != "sqlite":
+        return None
+    db = WorldDB(world.db_path)
+    if db.is_empty():
+        db.import_json()
+    print(f"[WORLD_DB] Using SQLite world store {world.db_path}", flush=True)
+    return db
+
+
+class WorldPager:
+    """Map objects paged between memory and per-chunk files.
+
+    index.json holds the archetypes and one entry per chunk file
+    ({"n", "kinds", "hash", "saved_at"}); "<cx>_<cy>.json" holds that chunk's
+    compacted objects. Resident objects live in map_objects as before, so the
+    game loops only simulate resident chunks and everything else is dormant
+    on disk exactly as it was paged out. Mine timers are frozen while dormant:
+    on page-in they move forward by the time since the chunk was written.
+    Callers hold map_lock; only the prefetch thread runs outside it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.stats = {"page_in": 0, "page_out": 0, "prefetch_hits": 0, "chunk_writes": 0}
+        os.makedirs(root, exist_ok=True)
+        index = load_json_file(self.path("index"), "chunk index", None)
+        if index is None:
+            index = self.import_map()
+        self.archetypes = index.get("archetypes") or {}
+        self.chunks = {tuple(int(v) for v in name.split("_")): entry
+                       for name, entry in (index.get("chunks") or {}).items()}
+        self.resident = OrderedDict()  # key -> ids whose file is that chunk, least recently used first
+        self.home = {}  # id -> key of the resident chunk the object is saved in
+        self.dirty_ids = set()
+        self.dirty_keys = set()
+        self.written_archetypes = hash(json.dumps(self.archetypes, sort_keys=True))
+        self.prefetch_lock = Lock()
+        self.prefetched = {}  # key -> chunk document read by the prefetch thread
+        self.prefetching = set()
+        self.generation = 0  # bumped on every page in/out (static manifest version)
+        self.dormant_rows_cache = {}  # key -> (chunk hash, stored rows) for manifest merges
+
+    def path(self, name):
+        return os.path.join(self.root, f"{name}.json")
+
+    @staticmethod
+    def name(key):
+        return f"{key[0]}_{key[1]}"
+
+    def write_file(self, name, data):
+        tmp = self.path(name) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, self.path(name))
+
+    def write_index(self):
+        self.write_file("index", {"schema": WORLD_SCHEMA_VERSION, "archetypes": world.learned_archetypes,
+                                  "chunks": {self.name(k): e for k, e in self.chunks.items()}})
+        self.written_archetypes = hash(json.dumps(world.learned_archetypes, sort_keys=True))
+
+    def import_map(self):
+        """Split map_objects.json into chunk files (first start only)."""
+        raw = load_json_file(world.map_file, "map objects", [])
+        if not isinstance(raw, dict):
+            raw = {"archetypes": {}, "objects": raw}
+        world.learned_archetypes.update(raw.get("archetypes") or {})
+        objs = [expand_map_object(o) for o in raw.get("objects") or []]
+        migrate_map_objects(objs, raw.get("schema", 0))
+        now = time.time()
+        by_key = {}
+        for o in objs:
+            register_archetype(o)
+            if o.get("kind") == "mine":
+                # timers restart once here, then stay frozen while their chunk is dormant
+                o["meta"]["nextTick"] = now + o["meta"]["interval"]
+            by_key.setdefault(static_chunk_key(o.get("x"), o.get("y")), []).append(compact_map_object(o))
+        self.chunks = {}
+        for key, rows in by_key.items():
+            self.write_chunk_rows(key, rows)
+        self.write_index()
+        print(f"[PAGER] Imported {len(objs)} map objects into {len(by_key)} chunks under {self.root}", flush=True)
+        return {"archetypes": world.learned_archetypes, "chunks": {self.name(k): e for k, e in self.chunks.items()}}
+
+    def write_chunk_rows(self, key, rows):
+        """Write one chunk file and refresh its index entry (the caller writes the index)."""
+        if not rows:
+            self.chunks.pop(key, None)
+            try:
+                os.remove(self.path(self.name(key)))
+            except FileNotFoundError:
+                pass
+            return
+        now = time.time()
+        self.write_file(self.name(key), {"schema": WORLD_SCHEMA_VERSION, "saved_at": now, "objects": rows})
+        kinds = {}
+        for row in rows:
+            kinds[row.get("kind")] = kinds.get(row.get("kind"), 0) + 1
+        self.chunks[key] = {"n": len(rows), "kinds": kinds, "hash": self.static_digest(rows)[0], "saved_at": now}
+        self.stats["chunk_writes"] += 1
+
+    @staticmethod
+    def static_digest(rows):
+        # same body shape and naming as static_layer_manifest's chunks
+        raw = json.dumps({"map_objects": rows, "resources": [], "trees": []},
+                         separators=(",", ":"), sort_keys=True).encode("utf-8")
+        return hashlib.sha1(raw).hexdigest()[:20], raw
+
+    def read_chunk(self, key):
+        return load_json_file(self.path(self.name(key)), f"chunk {self.name(key)}", None)
+
+    def page_in(self, key):
+        if key in self.resident:
+            self.resident.move_to_end(key)
+            return
+        entry = self.chunks.get(key)
+        doc = None
+        if entry is not None:
+            with self.prefetch_lock:
+                doc = self.prefetched.pop(key, None)
+            if doc is not None and doc.get("saved_at") == entry.get("saved_at"):
+                self.stats["prefetch_hits"] += 1
+            else:
+                doc = self.read_chunk(key)
+        ids = set()
+        self.resident[key] = ids
+        if not doc:
+            return
+        objs = [expand_map_object(o) for o in doc.get("objects") or []]
+        if migrate_map_objects(objs, doc.get("schema", 0)):
+            self.dirty_keys.add(key)
+        slept = time.time() - float(doc.get("saved_at") or time.time())
+        for o in objs:
+            oid = o.get("id")
+            if oid in world.map_index:
+                continue
+            if o.get("kind") == "mine":
+                m = o["meta"]
+                if isinstance(m.get("nextTick"), (int, float)):
+                    m["nextTick"] += slept
+            register_archetype(o)
+            add_map_object(o)
+            ids.add(oid)
+            self.home[oid] = key
+        invalidate_collision_index()
+        self.generation += 1
+        self.stats["page_in"] += 1
+
+    def page_out(self, key):
+        self.write_chunk(key)
+        ids = self.resident.pop(key)
+        world.map_objects[:] = [o for o in world.map_objects if o.get("id") not in ids]
+        for oid in ids:
+            world.map_index.pop(oid, None)
+            self.home.pop(oid, None)
+        invalidate_collision_index()
+        self.generation += 1
+        self.stats["page_out"] += 1
+
+    def write_chunk(self, key):
+        self.write_chunk_rows(key, [compact_map_object(world.map_index[oid]) for oid in self.resident[key]
+                                    if oid in world.map_index])
+        self.dirty_keys.discard(key)
+        with self.prefetch_lock:
+            self.prefetched.pop(key, None)
+
+    def track(self):
+        """Move changed objects to the chunk they now stand in (paging it in if needed)."""
+        if len(self.home) != len(world.map_index):
+            # objects added or removed without going through the feeds
+            self.dirty_ids.update(oid for oid in world.map_index if oid not in self.home)
+            self.dirty_ids.update(oid for oid in self.home if oid not in world.map_index)
+        ids, self.dirty_ids = self.dirty_ids, set()
+        for oid in ids:
+            old = self.home.pop(oid, None)
+            obj = world.map_index.get(oid)
+            new = static_chunk_key(obj.get("x"), obj.get("y")) if obj is not None else None
+            if old is not None:
+                self.resident[old].discard(oid)
+                self.dirty_keys.add(old)
+            if new is not None:
+                self.page_in(new)
+                self.resident[new].add(oid)
+                self.home[oid] = new
+                self.dirty_keys.add(new)
+
+    def flush(self, everything=False):
+        self.track()
+        keys = list(self.resident) if everything else list(self.dirty_keys)
+        for key in keys:
+            self.write_chunk(key)
+        if keys or hash(json.dumps(world.learned_archetypes, sort_keys=True)) != self.written_archetypes:
+            self.write_index()
+        return len(keys)
+
+    def wanted(self):
+        """(chunks pinned around online players' units, chunks ahead of moving units)."""
+        pins, ahead = set(), set()
+        r = range(-PAGE_PIN_RADIUS, PAGE_PIN_RADIUS + 1)
+        for pid in set(world.sid_to_player.values()):
+            for u in (world.players.get(pid) or {}).get("units") or []:
+                x, y = float(u.get("x", 0)), float(u.get("y", 0))
+                cx, cy = static_chunk_key(x, y)
+                pins.update((cx + dx, cy + dy) for dx in r for dy in r)
+                dx, dy = float(u.get("tx", x)) - x, float(u.get("ty", y)) - y
+                dist = math.hypot(dx, dy)
+                if dist > 1:
+                    step = PAGE_PREFETCH_AHEAD / dist
+                    ax, ay = static_chunk_key(x + dx * step, y + dy * step)
+                    ahead.update((ax + ox, ay + oy) for ox in r for oy in r)
+        return pins, ahead - pins
+
+    def prefetch(self, keys):
+        for key in keys:
+            doc = self.read_chunk(key)
+            with self.prefetch_lock:
+                self.prefetching.discard(key)
+                if doc is not None:
+                    self.prefetched[key] = doc
+
+    def tick(self):
+        """Page in what units need, prefetch what they are heading for, evict beyond the budget."""
+        pins, ahead = self.wanted()
+        self.track()
+        for key in pins:
+            if key in self.chunks or key in self.resident:
+                self.page_in(key)
+        wanted = [k for k in ahead if k in self.chunks and k not in self.resident]
+        with self.prefetch_lock:
+            # drop prefetched chunks nobody is heading for any more
+            for key in [k for k in self.prefetched if k not in ahead]:
+                del self.prefetched[key]
+            wanted = [k for k in wanted if k not in self.prefetching and k not in self.prefetched]
+            self.prefetching.update(wanted)
+        if wanted:
+            Thread(target=self.prefetch, args=(wanted,), daemon=True).start()
+        for key in list(self.resident):
+            if len(self.resident) <= WORLD_PAGE_BUDGET:
+                break
+            # a pending feed entry for a paged-out object would reach clients as a removal
+            if key in pins or any(oid in world.map_feed.pending for oid in self.resident[key]):
+                continue
+            self.page_out(key)
+        self.flush()
+
+    def page_in_all(self):
+        for key in list(self.chunks):
+            self.page_in(key)
+
+    def count_kind(self, kind):
+        """Objects of *kind* in chunks that are not resident."""
+        return sum((e.get("kinds") or {}).get(kind, 0) for k, e in self.chunks.items() if k not in self.resident)
+
+    def dormant_keys(self):
+        return [k for k in self.chunks if k not in self.resident]
+
+    def dormant_rows(self, key):
+        """Stored (compact) rows of a paged-out chunk, cached until its hash changes."""
+        entry = self.chunks[key]
+        cached = self.dormant_rows_cache.get(key)
+        if cached is None or cached[0] != entry["hash"]:
+            doc = self.read_chunk(key) or {}
+            cached = self.dormant_rows_cache[key] = (entry["hash"], doc.get("objects") or [])
+        return cached[1]
+
+    def dormant_manifest_entries(self, skip=()):
+        """Manifest entries served straight from chunk files; keys in skip were merged by the caller."""
+        return [{"cx": k[0], "cy": k[1], "hash": e["hash"], "count": e["n"]}
+                for k, e in sorted(self.chunks.items()) if k not in self.resident and k not in skip]
+
+    def static_body(self, digest):
+        """gzip'd static chunk body of a paged-out chunk, rebuilt from its file."""
+        for key, entry in self.chunks.items():
+            if entry.get("hash") == digest:
+                doc = self.read_chunk(key) or {}
+                found, raw = self.static_digest(doc.get("objects") or [])
+                return gzip.compress(raw, compresslevel=6, mtime=0) if found == digest else None
+        return None
+
+    def report(self):
+        return {"resident": len(self.resident), "chunks": len(self.chunks), "budget": WORLD_PAGE_BUDGET,
+                "resident_objects": len(self.home), **self.stats}
+
+
+def open_world_pager():
+    if WORLD_STORE != "chunks":
+        return None
+    pager = WorldPager(world.chunks_dir)
+    print(f"[PAGER] Using chunked world store {world.chunks_dir} ({len(pager.chunks)} chunks)", flush=True)
+    return pager
 
-# Each object: {id, type, kind, x, y, owner, rot, meta}
-map_objects = []
 
 def load_json_file(path, label, default):
     """Load JSON data, falling back to *default* if it cannot be parsed."""
@@ -79,167 +2252,358 @@ def load_json_file(path, label, default):
         print(f"[LOAD_JSON] {label} file {path} is corrupt ({exc}); using default", flush=True)
         return default
 
+# ===== WORLD SCHEMA =====
+# The persisted world carries a schema version ("schema" in map_objects.json,
+# a "meta" section in the binary snapshot, PRAGMA user_version in SQLite).
+# MIGRATIONS[n] upgrades map objects from version n to n + 1; each runs once,
+# after which the rewritten rows are persisted and nothing at boot or in the
+# game loops needs to backfill fields again. Migrations must be idempotent:
+# journal rows newer than the snapshot they replay over go through them too.
+WORLD_SCHEMA_VERSION = 1
+
+# entity kinds that get HP bars, with their default HP
+ENTITY_DEFAULT_HP = {"town_center": 500, "building": 200, "mine": 300, "blacksmith": 300, "spider": 50}
+
+
+def migrate_legacy_entities(objs):
+    """v0 -> v1: backfill mine/blacksmith fields and entity HP, strip HP from invulnerable entities."""
+    for o in objs:
+        kind = o.get("kind")
+        m = o.setdefault("meta", {})
+        if kind == "mine":
+            m["entity"] = True
+            m.setdefault("mine", {}).setdefault("resource", "red")
+            m["interval"] = int(m.get("interval", 30))
+        elif kind == "blacksmith":
+            m["entity"] = True
+            # legacy fields not used by blacksmith anymore
+            m.pop("interval", None)
+            m.pop("nextTick", None)
+            if not o.get("itemSlots"):
+                o["itemSlots"] = [None]
+        if not m.get("entity"):
+            continue
+        if kind in ENTITY_DEFAULT_HP:
+            if o.get("hp") is None:
+                o["hp"] = ENTITY_DEFAULT_HP[kind]
+                if kind == "spider":
+                    o["maxHp"] = o["hp"]
+        else:
+            # other entities are invulnerable
+            o.pop("hp", None)
+
+
+MIGRATIONS = [migrate_legacy_entities]
+assert len(MIGRATIONS) == WORLD_SCHEMA_VERSION
+
+
+def migrate_map_objects(objs, from_version):
+    """Run every migration after *from_version* over *objs* (in place); returns the steps run."""
+    if from_version > WORLD_SCHEMA_VERSION:
+        raise RuntimeError(f"world schema {from_version} is newer than this server ({WORLD_SCHEMA_VERSION})")
+    steps = MIGRATIONS[from_version:]
+    for step in steps:
+        step(objs)
+    return len(steps)
+
+
+def read_map_document():
+    """The stored map as {"schema", "archetypes", "objects"} from whichever store is active."""
+    if world.db is not None:
+        return world.db.load_map()
+    if world.pager is not None:
+        # nothing is resident at boot; each chunk migrates as it is paged in
+        return {"schema": WORLD_SCHEMA_VERSION, "archetypes": world.pager.archetypes, "objects": []}
+    if world.snapshot is not None:
+        raw = {"schema": world.snapshot.meta.get("schema", 0), "archetypes": world.snapshot.archetypes,
+               "objects": list(world.snapshot.collections["map_objects"])}
+    else:
+        raw = load_json_file(world.map_file, "map objects", [])
+    if world.journal is not None:
+        raw = world.journal.replay_map(raw)
+    if not isinstance(raw, dict):
+        # legacy format: a bare list of fully expanded objects
+        raw = {"archetypes": {}, "objects": raw}
+    return raw
+
+
 def load_map():
-    global map_objects
-    map_objects = load_json_file(MAP_FILE, "map objects", [])
-    
-    # Spawn spiders if none exist
-    spider_count = sum(1 for o in map_objects if o.get("kind") == "spider")
-    if spider_count == 0:
-        print("[INIT] Spawning spiders...", flush=True)
-        spawn_spiders()
-    
-    # Reset nextTick for any mines that were loaded from file
-    # (their old nextTick is likely in the past)
+    """Read, migrate (once per schema bump) and index the map; each phase is a startup mark."""
+    raw = read_map_document()
+    world.learned_archetypes.update(raw.get("archetypes") or {})
+    world.map_objects = raw.get("objects") or []
+    # a world with no map yet (first boot) starts at the current schema
+    world.schema = raw.get("schema", 0 if world.map_objects else WORLD_SCHEMA_VERSION)
+    for o in world.map_objects:
+        expand_map_object(o)
+    startup_mark("map_read")
+
+    steps = migrate_map_objects(world.map_objects, world.schema)
+    if steps:
+        print(f"[SCHEMA] Migrated {len(world.map_objects)} map objects from v{world.schema} to v{WORLD_SCHEMA_VERSION}", flush=True)
+    startup_mark("map_migrate")
+
+    # Mine timers are runtime state, not schema: an old nextTick is likely
+    # in the past, so restart every mine's interval (resume_world restores
+    # the real remaining time after a clean shutdown).
     now = time.time()
-    for o in map_objects:
-        if o.get("kind") == "mine" and o.get("meta"):
+    mines_reset = 0
+    for o in world.map_objects:
+        register_archetype(o)
+        if o.get("kind") == "mine":
             m = o["meta"]
-            # Normalize legacy mines so the production loop will process them
-            if not m.get("entity"):
-                m["entity"] = True
-            mine_meta = m.setdefault("mine", {})
-            mine_meta.setdefault("resource", "red")
-            interval = int(m.get("interval", 30))
-            m["interval"] = interval
-            m["nextTick"] = now + interval
-            print(f"[LOAD_MAP] Reset mine {o.get('id')} nextTick to {m['nextTick']} interval={interval}", flush=True)
-
-        if o.get("kind") == "blacksmith":
-            # Normalize blacksmiths to ensure they act as entities with HP and at least one item slot
-            m = o.setdefault("meta", {})
-            m["entity"] = True
-            if "interval" in m:
-                # legacy fields not used by blacksmith anymore
-                m.pop("interval", None)
-                m.pop("nextTick", None)
-            slots = o.setdefault("itemSlots", [])
-            if len(slots) == 0:
-                slots.append(None)
-    
-    # Ensure entities that need HP bars have them set
-    for o in map_objects:
-        if o.get("meta", {}).get("entity"):
-            # town_center, building, mine, blacksmith, and spider all need HP bars
-            if o.get("kind") in ("town_center", "building", "mine", "blacksmith", "spider"):
-                if o.get("hp") is None:
-                    # default HP by kind
-                    if o.get("kind") == "town_center":
-                        o["hp"] = 500
-                    elif o.get("kind") == "mine":
-                        o["hp"] = 300
-                    elif o.get("kind") == "blacksmith":
-                        o["hp"] = 300
-                    elif o.get("kind") == "spider":
-                        o["hp"] = 50
-                        o["maxHp"] = 50
-                    else:
-                        o["hp"] = 200
-            else:
-                # other entities are invulnerable by default
-                if "hp" in o:
-                    del o["hp"]
+            m["nextTick"] = now + m["interval"]
+            mines_reset += 1
+    reindex_map()
+    world.collision_index.rebuild(world.map_objects)
+    if mines_reset:
+        print(f"[LOAD_MAP] Reset nextTick on {mines_reset} mines", flush=True)
+    startup_mark("map_index")
+
+
+def persist_schema_migration():
+    """Write the migrated rows and the new schema version back, once, after a migration at boot."""
+    if world.schema == WORLD_SCHEMA_VERSION:
+        return
+    # the db reconcile and the journal compaction at boot rewrite changed rows
+    # (and the snapshot files with the new version); plain JSON needs a save
+    if world.db is not None:
+        world.db.set_schema(WORLD_SCHEMA_VERSION)
+    elif world.journal is None:
+        with world.map_lock:
+            write_map_snapshot()
+    world.schema = WORLD_SCHEMA_VERSION
+
+
+def bench_load_cli(argv):
+    """python app.py bench-load [--repeat N] [--from-schema V]: time the read/migrate/index phases of load_map."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="app.py bench-load")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--from-schema", type=int, default=None,
+                        help="treat the stored map as this schema version (default: as stored)")
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    # Opening a store can write (the journal file, SQLite's first import,
+    # moving a corrupt snapshot aside), so the bench reads a scratch copy and
+    # leaves the data dir untouched.
+    with tempfile.TemporaryDirectory(prefix="bench-load-") as scratch, bench_world_copy(scratch).bound():
+        index, samples = bench_load_runs(args)
+    report = {phase: round(sorted(v)[len(v) // 2] * 1000, 2) for phase, v in samples.items()}
+    print(f"[BENCH] {len(index)} map objects, median of {args.repeat} runs (ms): {report}", flush=True)
+
+
+BENCH_WORLD_PATHS = ("map_file", "ground_file", "res_file", "db_path", "journal_path",
+                     "snapshot_path", "chunks_dir", "terrain_file")
+
+
+def bench_world_copy(scratch):
+    """A World (not registered) whose store files are copies under *scratch*."""
+    w = World(DEFAULT_WORLD)
+    for attr in BENCH_WORLD_PATHS:
+        path = getattr(bound_world(), attr)
+        if not path:
+            continue
+        copy_path = os.path.join(scratch, os.path.basename(path))
+        if os.path.isdir(path):
+            shutil.copytree(path, copy_path)
+        else:
+            # SQLite's -wal/-shm and rotated journals sit next to the main file
+            for found in glob.glob(glob.escape(path) + "*"):
+                if os.path.isfile(found):
+                    shutil.copy2(found, os.path.join(scratch, os.path.basename(found)))
+        setattr(w, attr, copy_path)
+    return w
+
+
+def bench_load_runs(args):
+    world.db = open_world_db()
+    world.journal = open_world_journal()
+    world.snapshot = open_world_snapshot()
+    world.pager = open_world_pager()
+    try:
+        samples = {"read": [], "migrate": [], "index": []}
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            raw = read_map_document()
+            objs = raw.get("objects") or []
+            for o in objs:
+                expand_map_object(o)
+            t1 = time.perf_counter()
+            migrate_map_objects(objs, raw.get("schema", 0) if args.from_schema is None else args.from_schema)
+            t2 = time.perf_counter()
+            for o in objs:
+                register_archetype(o)
+            index = {o.get("id"): o for o in objs}
+            CollisionIndex().rebuild(objs)
+            t3 = time.perf_counter()
+            samples["read"].append(t1 - t0)
+            samples["migrate"].append(t2 - t1)
+            samples["index"].append(t3 - t2)
+    finally:
+        if world.snapshot is not None:
+            world.snapshot.close()
+        if world.journal is not None:
+            world.journal.file.close()
+        if world.db is not None:
+            world.db.conn.close()
+    return index, samples
 
 def load_ground():
-    global ground_items
-    ground_items[:] = load_json_file(GROUND_FILE, "ground items", [])
+    if world.db is not None:
+        world.ground_items[:] = world.db.load("ground_items")
+    else:
+        if world.snapshot is not None:
+            world.ground_items[:] = world.snapshot.collections["ground_items"]
+        else:
+            world.ground_items[:] = load_json_file(world.ground_file, "ground items", [])
+        if world.journal is not None:
+            world.ground_items[:] = world.journal.replay("ground_items", world.ground_items)
+    reindex_ground()
 
 
 def load_resources():
-    global resources
-    resources = load_json_file(RES_FILE, "resources", [])
+    if world.db is not None:
+        world.resources = world.db.load("resources")
+    else:
+        if world.snapshot is not None:
+            world.resources = list(world.snapshot.collections["resources"])
+        else:
+            world.resources = load_json_file(world.res_file, "resources", [])
+        if world.journal is not None:
+            world.resources = world.journal.replay("resources", world.resources)
+    reindex_resources()
 
 
 def save_resources():
-    tmp = RES_FILE + ".tmp"
+    if world.db is not None:
+        world.db.flush(("resources",))
+        return
+    if world.journal is not None:
+        world.journal.flush()
+        return
+    write_resources_snapshot()
+
+
+def write_resources_snapshot():
+    tmp = world.res_file + ".tmp"
     with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(resources, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, RES_FILE)
+        json.dump(world.resources, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, world.res_file)
 
 def save_map():
-    tmp = MAP_FILE + ".tmp"
+    if world.pager is not None:
+        world.pager.flush()
+        return
+    if world.db is not None:
+        world.db.flush(("map_objects",))
+        return
+    if world.journal is not None:
+        world.journal.flush()
+        return
+    write_map_snapshot()
+
+
+def write_map_snapshot():
+    tmp = world.map_file + ".tmp"
+    data = {"schema": WORLD_SCHEMA_VERSION, "archetypes": world.learned_archetypes, "objects": compact_map_objects()}
     with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(map_objects, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, MAP_FILE)
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, world.map_file)
+
+# ===== WORLD GENERATION =====
+# Spiders, resources and trees are generated from WORLD_SEED, so a fresh
+# world is reproducible. Generation runs once at startup for whatever is
+# missing (or via `python app.py generate-world`), never inside a handler.
+WORLD_SEED = int(os.environ.get("WORLD_SEED", "1337"))
+SPIDER_COUNT = 100
+SPIDER_AREA = (-6000, -4500, 6000, 4500)  # matches the resource grid footprint
+SPIDER_CLEARANCE = 80  # px kept between waypoints and collision boxes
+RESOURCE_GRID = (69, 53, 180)  # cols, rows, spacing of the isometric resource lattice
+RESOURCE_FILL = 0.6
+TREE_COUNT = 100
+TREE_AREA = (-8000, -8000, 8000, 8000)
+
+
+class OccupancyGrid:
+    """Blocked cells of every collision box (grown by a clearance) on a fixed grid.
+
+    Built once per generation pass, so each candidate point costs one
+    bytearray lookup instead of a collision query.
+    """
 
-def spawn_spiders():
-    """Spawn spiders around the map with health and waypoints."""
-    
-    def point_in_collision(x, y):
-        """Check if a point is inside any entity's collision box."""
-        for obj in map_objects:
-            meta = obj.get("meta", {})
-            
-            # Skip if no collision enabled
-            if not meta.get("collides"):
+    CELL = 32
+
+    def __init__(self, objs, clearance, area):
+        boxes = []
+        for obj in objs:
+            meta = obj.get("meta") or {}
+            try:
+                cw = float(meta.get("cw", 0) or 0)
+                ch = float(meta.get("ch", 0) or 0)
+                cx = float(obj.get("x", 0)) + float(meta.get("cx", 0) or 0)
+                cy = float(obj.get("y", 0)) + float(meta.get("cy", 0) or 0)
+            except (TypeError, ValueError):
                 continue
-            
-            # Get collision box dimensions
-            obj_x = obj.get("x", 0)
-            obj_y = obj.get("y", 0)
-            cx = obj_x + meta.get("cx", 0)
-            cy = obj_y + meta.get("cy", 0)
-            cw = meta.get("cw", 0)
-            ch = meta.get("ch", 0)
-            
-            # Skip if collision box has no size
             if cw <= 0 or ch <= 0:
                 continue
-            
-            # Check if point is inside collision box (with padding)
-            padding = 80  # Extra space around collision
-            half_w = cw / 2 + padding
-            half_h = ch / 2 + padding
-            
-            if abs(x - cx) < half_w and abs(y - cy) < half_h:
-                return True
-        return False
-    
-    def generate_valid_waypoint(center_x, center_y, min_radius, max_radius, max_attempts=50):
-        """Generate a waypoint that doesn't collide with entities."""
-        for attempt in range(max_attempts):
-            angle = random.random() * math.pi * 2
-            radius = random.randint(min_radius, max_radius)
-            x = center_x + math.cos(angle) * radius
-            y = center_y + math.sin(angle) * radius
-            
-            if not point_in_collision(x, y):
-                return {"x": x, "y": y}
-        
-        # Fallback: try wider radius
-        for attempt in range(20):
-            angle = random.random() * math.pi * 2
-            radius = random.randint(max_radius, max_radius + 200)
-            x = center_x + math.cos(angle) * radius
-            y = center_y + math.sin(angle) * radius
-            
-            if not point_in_collision(x, y):
-                return {"x": x, "y": y}
-        
-        # Last resort: return position far from center
-        print(f"[SPIDER] Warning: Could not find collision-free waypoint after {max_attempts + 20} attempts", flush=True)
-        return {"x": center_x + random.randint(-500, 500), "y": center_y + random.randint(-500, 500)}
-    
-    # Match resource grid area: 69 cols x 53 rows x 180 spacing
-    # Resources span from roughly -6200 to +6200 in x, -4770 to +4770 in y
-    spider_count = 100
-    print(f"[SPIDER] Spawning {spider_count} spiders, checking collisions with {len(map_objects)} entities", flush=True)
-    
-    for i in range(spider_count):
-        # Spawn randomly within resource area
-        center_x = random.randint(-6000, 6000)
-        center_y = random.randint(-4500, 4500)
-        
-        # Create waypoints in a random walk pattern, avoiding collisions
-        waypoints = []
-        wp_count = random.randint(3, 6)
-        for j in range(wp_count):
-            wp = generate_valid_waypoint(center_x, center_y, 150, 400)
-            waypoints.append(wp)
-            print(f"[SPIDER] Spider {i+1} waypoint {j+1}: ({wp['x']:.1f}, {wp['y']:.1f})", flush=True)
-        
-        spider = {
-            "id": str(uuid.uuid4()),
+            hw, hh = cw / 2 + clearance, ch / 2 + clearance
+            boxes.append((cx - hw, cy - hh, cx + hw, cy + hh))
+        x0, y0, x1, y1 = area
+        for bx0, by0, bx1, by1 in boxes:
+            x0, y0, x1, y1 = min(x0, bx0), min(y0, by0), max(x1, bx1), max(y1, by1)
+        self.x0 = math.floor(x0 / self.CELL)
+        self.y0 = math.floor(y0 / self.CELL)
+        self.w = math.floor(x1 / self.CELL) - self.x0 + 1
+        self.h = math.floor(y1 / self.CELL) - self.y0 + 1
+        self.cells = bytearray(self.w * self.h)
+        for bx0, by0, bx1, by1 in boxes:
+            gx0 = math.floor(bx0 / self.CELL) - self.x0
+            gx1 = math.floor(bx1 / self.CELL) - self.x0
+            run = b"\x01" * (gx1 - gx0 + 1)
+            for gy in range(math.floor(by0 / self.CELL) - self.y0, math.floor(by1 / self.CELL) - self.y0 + 1):
+                row = gy * self.w
+                self.cells[row + gx0:row + gx1 + 1] = run
+
+    def blocked(self, x, y):
+        gx = math.floor(x / self.CELL) - self.x0
+        gy = math.floor(y / self.CELL) - self.y0
+        if not (0 <= gx < self.w and 0 <= gy < self.h):
+            return False
+        return self.cells[gy * self.w + gx] == 1
+
+    def free_points(self, rng, n, center_x, center_y, min_radius, max_radius):
+        """n points in the annulus around a center, drawn in batches and filtered."""
+        out = []
+        for _ in range(8):
+            batch = [(rng.random() * math.tau, rng.uniform(min_radius, max_radius)) for _ in range(n * 2)]
+            out.extend(p for p in ((center_x + math.cos(a) * r, center_y + math.sin(a) * r) for a, r in batch)
+                       if not self.blocked(*p))
+            if len(out) >= n:
+                return out[:n]
+            min_radius, max_radius = max_radius, max_radius + 200
+        # crowded spot: fill up with unchecked points rather than loop forever
+        while len(out) < n:
+            out.append((center_x + rng.randint(-500, 500), center_y + rng.randint(-500, 500)))
+        return out
+
+
+def seeded_uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def generate_spiders(rng, count, grid, first_number=1):
+    """Spider map objects with 3-6 collision-free patrol waypoints each."""
+    ax0, ay0, ax1, ay1 = SPIDER_AREA
+    spiders = []
+    for i in range(count):
+        center_x = rng.randint(ax0, ax1)
+        center_y = rng.randint(ay0, ay1)
+        points = grid.free_points(rng, rng.randint(3, 6), center_x, center_y, 150, 400)
+        waypoints = [{"x": x, "y": y} for x, y in points]
+        spiders.append({
+            "id": seeded_uuid(rng),
             "type": "tile",
             "kind": "spider",
             "x": waypoints[0]["x"],
@@ -248,7 +2612,7 @@ def spawn_spiders():
             "hp": 50,
             "maxHp": 50,
             "meta": {
-                "title": f"Spider {i + 1}",
+                "title": f"Spider {first_number + i}",
                 "w": 100,
                 "h": 100,
                 "waypoints": waypoints,
@@ -258,61 +2622,337 @@ def spawn_spiders():
                 "z": 0,
                 "entity": True
             }
-        }
-        map_objects.append(spider)
-    
-    save_map()
-    print(f"[INIT] Spawned {spider_count} spiders", flush=True)
+        })
+    return spiders
+
+
+def generate_resources(rng, cols, rows, spacing, fill=RESOURCE_FILL):
+    """Resource nodes on the isometric lattice; about `fill` of the sites are used."""
+    out = []
+    col_offset, row_offset = cols // 2, rows // 2
+    for r in range(rows):
+        rr = r - row_offset
+        for c in range(cols):
+            if rng.random() < fill:
+                cc = c - col_offset
+                out.append({
+                    "id": len(out),
+                    "x": float((cc - rr) * spacing),
+                    "y": float((cc + rr) * spacing / 2),
+                    "type": rng.choice(("red", "green", "blue")),
+                })
+    return out
+
+
+def generate_trees(rng, n):
+    x0, y0, x1, y1 = TREE_AREA
+    return [{"x": rng.randint(x0, x1), "y": rng.randint(y0, y1)} for _ in range(n)]
+
+
+def spawn_spiders(count=SPIDER_COUNT, seed=None):
+    """Add `count` seeded spiders to the live map (feeds and persistence included)."""
+    started = time.perf_counter()
+    rng = random.Random(f"{WORLD_SEED if seed is None else seed}:spiders:{len(world.map_objects)}")
+    grid = OccupancyGrid(world.map_objects, SPIDER_CLEARANCE, SPIDER_AREA)
+    existing = sum(1 for o in world.map_objects if o.get("kind") == "spider")
+    for spider in generate_spiders(rng, count, grid, first_number=existing + 1):
+        add_map_object(expand_map_object(spider))
+        world.map_feed.upsert(spider["id"])
+    invalidate_collision_index()
+    print(f"[WORLDGEN] Spawned {count} spiders in {(time.perf_counter() - started) * 1000:.1f}ms", flush=True)
+
+
+def generate_missing_world(seed=None):
+    """Startup step: create spiders, resources and trees if the world has none."""
+    seed = world.seed if seed is None else seed
+    dormant_spiders = world.pager.count_kind("spider") if world.pager is not None else 0
+    if not dormant_spiders and not any(o.get("kind") == "spider" for o in world.map_objects):
+        with world.map_lock:
+            spawn_spiders(SPIDER_COUNT, seed)
+            save_map()
+    if not world.resources:
+        cols, rows, spacing = RESOURCE_GRID
+        with world.resources_lock:
+            world.resources = generate_resources(random.Random(f"{seed}:resources"), cols, rows, spacing)
+            reindex_resources()
+            for r in world.resources:
+                world.resources_feed.upsert(r["id"])
+            save_resources()
+        print(f"[WORLDGEN] Generated {len(world.resources)} resources", flush=True)
+    if not world.trees:
+        world.trees.extend(generate_trees(random.Random(f"{seed}:trees"), TREE_COUNT))
 
 def save_ground():
-    tmp = GROUND_FILE + ".tmp"
+    if world.db is not None:
+        world.db.flush(("ground_items",))
+        return
+    if world.journal is not None:
+        world.journal.flush()
+        return
+    write_ground_snapshot()
+
+
+def write_ground_snapshot():
+    tmp = world.ground_file + ".tmp"
     with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(ground_items, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, GROUND_FILE)
+        json.dump(world.ground_items, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, world.ground_file)
 
 
-def ensure_mine_loop_started():
-    """Start the mine production loop exactly once across any run mode."""
-    global mine_loop_started
-    with mine_loop_lock:
-        if mine_loop_started:
-            return
-        socketio.start_background_task(mine_production_loop)
-        mine_loop_started = True
-        print("[MINE_LOOP] Background task started", flush=True)
-
-def ensure_npc_loop_started():
-    """Start the NPC movement loop exactly once."""
-    global npc_loop_started
-    with npc_loop_lock:
-        if npc_loop_started:
+def rle_encode(cells):
+    """array("H") of palette ids -> little-endian (id, run) u16 pairs."""
+    out = array("H")
+    prev, run = None, 0
+    for c in cells:
+        if c == prev and run < 0xFFFF:
+            run += 1
+            continue
+        if run:
+            out.append(prev)
+            out.append(run)
+        prev, run = c, 1
+    if run:
+        out.append(prev)
+        out.append(run)
+    if sys.byteorder != "little":
+        out.byteswap()
+    return out.tobytes()
+
+
+def rle_decode(data, size):
+    pairs = array("H", data)
+    if sys.byteorder != "little":
+        pairs.byteswap()
+    cells = array("H")
+    for i in range(0, len(pairs) - 1, 2):
+        cells.extend(array("H", [pairs[i]]) * pairs[i + 1])
+    if len(cells) != size:
+        raise ValueError(f"terrain chunk decodes to {len(cells)} cells, expected {size}")
+    return cells
+
+
+class TerrainLayer:
+    """Ground tiles as palette ids on a TERRAIN_CELL grid, one array per chunk.
+
+    Palette id 0 is bare ground; chunks that become all bare are dropped.
+    Each chunk's wire/disk body is its RLE bytes, cached under a content hash
+    until the chunk is painted again.
+    """
+
+    def __init__(self):
+        self.palette = [""]  # palette id -> tile name
+        self.palette_ids = {"": 0}
+        self.chunks = {}  # (cx, cy) -> array("H"), row-major
+        self.bodies = {}  # (cx, cy) -> (digest, gzip'd RLE)
+        self.by_digest = {}  # digest -> (cx, cy)
+        self.generation = 0
+
+    def tile_id(self, name):
+        tid = self.palette_ids.get(name)
+        if tid is None:
+            tid = self.palette_ids[name] = len(self.palette)
+            self.palette.append(name)
+        return tid
+
+    def get(self, gx, gy):
+        cells = self.chunks.get((gx // TERRAIN_CHUNK, gy // TERRAIN_CHUNK))
+        return cells[(gy % TERRAIN_CHUNK) * TERRAIN_CHUNK + gx % TERRAIN_CHUNK] if cells else 0
+
+    def paint(self, gx, gy, w, h, tid):
+        """Set a w x h block of cells from (gx, gy); returns how many changed."""
+        changed = 0
+        for cy in range(gy // TERRAIN_CHUNK, (gy + h - 1) // TERRAIN_CHUNK + 1):
+            for cx in range(gx // TERRAIN_CHUNK, (gx + w - 1) // TERRAIN_CHUNK + 1):
+                key = (cx, cy)
+                cells = self.chunks.get(key)
+                if cells is None:
+                    if tid == 0:
+                        continue
+                    cells = self.chunks[key] = array("H", [0]) * (TERRAIN_CHUNK * TERRAIN_CHUNK)
+                before = changed
+                x0, x1 = max(gx, cx * TERRAIN_CHUNK), min(gx + w, (cx + 1) * TERRAIN_CHUNK)
+                for y in range(max(gy, cy * TERRAIN_CHUNK), min(gy + h, (cy + 1) * TERRAIN_CHUNK)):
+                    row = (y - cy * TERRAIN_CHUNK) * TERRAIN_CHUNK - cx * TERRAIN_CHUNK
+                    for x in range(x0, x1):
+                        if cells[row + x] != tid:
+                            cells[row + x] = tid
+                            changed += 1
+                if changed != before:
+                    self.forget_body(key)
+                    if tid == 0 and not any(cells):
+                        del self.chunks[key]
+        if changed:
+            self.generation += 1
+        return changed
+
+    def forget_body(self, key):
+        old = self.bodies.pop(key, None)
+        if old is not None:
+            self.by_digest.pop(old[0], None)
+
+    def chunk_body(self, key):
+        body = self.bodies.get(key)
+        if body is None:
+            raw = rle_encode(self.chunks[key])
+            digest = hashlib.sha1(raw).hexdigest()[:20]
+            body = self.bodies[key] = (digest, gzip.compress(raw, compresslevel=6, mtime=0))
+            self.by_digest[digest] = key
+        return body
+
+    def manifest(self):
+        return {
+            "cell": TERRAIN_CELL, "chunk": TERRAIN_CHUNK, "palette": self.palette,
+            "chunks": [{"cx": cx, "cy": cy, "hash": self.chunk_body((cx, cy))[0]}
+                       for cx, cy in sorted(self.chunks)],
+        }
+
+    def to_document(self):
+        return {
+            "version": TERRAIN_VERSION, "cell": TERRAIN_CELL, "chunk": TERRAIN_CHUNK,
+            "palette": self.palette,
+            "chunks": {f"{cx},{cy}": base64.b64encode(rle_encode(cells)).decode("ascii")
+                       for (cx, cy), cells in self.chunks.items()},
+        }
+
+    def load_document(self, doc):
+        if doc.get("cell", TERRAIN_CELL) != TERRAIN_CELL or doc.get("chunk", TERRAIN_CHUNK) != TERRAIN_CHUNK:
+            raise ValueError(f"terrain grid is {doc.get('cell')}px x {doc.get('chunk')}, expected {TERRAIN_CELL}px x {TERRAIN_CHUNK}")
+        self.palette = list(doc.get("palette") or [""])
+        self.palette_ids = {name: i for i, name in enumerate(self.palette)}
+        size = TERRAIN_CHUNK * TERRAIN_CHUNK
+        self.chunks = {}
+        for key, packed in (doc.get("chunks") or {}).items():
+            cx, cy = (int(v) for v in key.split(","))
+            self.chunks[(cx, cy)] = rle_decode(base64.b64decode(packed), size)
+        self.bodies.clear()
+        self.by_digest.clear()
+        self.generation += 1
+
+
+def load_terrain():
+    doc = load_json_file(world.terrain_file, "terrain", None)
+    if not isinstance(doc, dict):
+        return
+    try:
+        world.terrain.load_document(doc)
+    except (ValueError, TypeError) as exc:
+        print(f"[TERRAIN] Ignoring {world.terrain_file}: {exc}", flush=True)
+        return
+    print(f"[TERRAIN] Loaded {len(world.terrain.chunks)} chunks, {len(world.terrain.palette) - 1} tiles", flush=True)
+
+
+def save_terrain():
+    doc = world.terrain.to_document()
+    tmp = world.terrain_file + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(doc, f, separators=(",", ":"))
+    os.replace(tmp, world.terrain_file)
+
+
+def ensure_scheduler_started():
+    """Start the world scheduler exactly once across any run mode."""
+    global scheduler_started
+    with scheduler_lock:
+        if scheduler_started:
             return
-        socketio.start_background_task(npc_movement_loop)
-        npc_loop_started = True
-        print("[NPC_LOOP] Background task started", flush=True)
+        socketio.start_background_task(world_scheduler)
+        scheduler_started = True
+        print(f"[SCHEDULER] Background task started for {len(worlds)} world(s)", flush=True)
 
-load_map()
-load_resources()
 
+def world_jobs():
+    # name, interval (s), per-world tick
+    return (
+        ("npc", NPC_TICK_INTERVAL, npc_tick),
+        ("feed", FEED_FLUSH_INTERVAL, flush_change_feeds),
+        ("mine", MINE_TICK_INTERVAL, mine_tick),
+        ("persist", PERSIST_INTERVAL, persist_tick),
+        ("pager", PAGE_INTERVAL, pager_tick),
+    )
 
-app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")
 
-# State
+def world_scheduler():
+    """One green thread runs every world's periodic work.
 
+    Each job runs once per interval for every world, yielding between
+    worlds; the world order rotates every round so no match is always
+    served first (or last) when a round runs long.
+    """
+    jobs = world_jobs()
+    due = {name: time.perf_counter() + interval for name, interval, _ in jobs}
+    rotation = 0
+    while True:
+        wait = min(due.values()) - time.perf_counter()
+        if wait > 0:
+            socketio.sleep(wait)
+            continue
+        order = list(worlds.values())
+        rotation = (rotation + 1) % len(order)
+        order = order[rotation:] + order[:rotation]
+        for name, interval, tick in jobs:
+            now = time.perf_counter()
+            if due[name] > now:
+                continue
+            # fixed rate, but no burst of catch-up ticks after a stall
+            due[name] = max(due[name] + interval, now)
+            if name in tick_monitors:
+                tick_monitors[name].tick()
+            if name == "feed":
+                replay_coalesced()
+                admit_waiting()
+            for w in order:
+                with w.bound():
+                    try:
+                        tick()
+                    except Exception as exc:
+                        print(f"[SCHEDULER] {name} tick failed in world {w.id}: {exc!r}", flush=True)
+                socketio.sleep(0)
+            if name == "feed":
+                drain_outboxes()
 
-players = {}     # player_id -> {x, y, color, units, resources}
-buildings = []   # list of {x, y, owner}
-sid_to_player = {}  # active socket sid -> player_id
-player_to_sid = {}  # player_id -> last seen sid
 
-ground_items = []  # [{id, name, x, y}]
-PICKUP_DISTANCE = 120
+def pager_tick():
+    if world.pager is None:
+        return
+    try:
+        with world.map_lock:
+            world.pager.tick()
+    except OSError as exc:
+        print(f"[PAGER] Chunk write failed: {exc}", flush=True)
+
+
+def persist_tick():
+    if world.dirty_collections:
+        try:
+            flush_dirty()
+        except OSError as exc:
+            print(f"[PERSIST_LOOP] Save failed: {exc}", flush=True)
+    if world.journal is not None:
+        try:
+            world.journal.flush()
+            if world.journal.compact_due():
+                world.journal.compact()
+        except OSError as exc:
+            print(f"[PERSIST_LOOP] Journal write failed: {exc}", flush=True)
+    if world.db is not None:
+        try:
+            world.db.flush()
+            if time.time() - world.db.last_reconcile > WORLD_DB_RECONCILE_INTERVAL:
+                world.db.reconcile()
+        except Exception as exc:
+            print(f"[PERSIST_LOOP] World DB write failed: {exc}", flush=True)
+
+startup_mark("imports")
 
-load_ground()
+
+app = Flask(__name__)
+socketio = SocketIO(app, cors_allowed_origins="*")
+startup_mark("app_init")
+
+PICKUP_DISTANCE = 120
 
 def find_unit(player_id, unit_id):
-    p = players.get(player_id)
+    p = world.players.get(player_id)
     if not p:
         return None
     for u in p.get("units", []):
@@ -405,56 +3045,304 @@ def slot_payload_from_source(payload, fallback_name="item"):
     return slot
 
 
+# Item name (lowercase) -> stat points it grants; upgrade bonus adds to each stat
+ITEM_STAT_TABLE = {
+    "sword": {"attack": 1},
+    "shield": {"defense": 1},
+}
+
+# (world id, owner, unit id) -> equipment version, bumped whenever the unit's itemSlots change
+unit_equipment_versions = {}
+# (world id, owner, unit id) -> (equipment version, stats)
+unit_stats_cache = {}
+
+
 def compute_unit_stats(u):
-    slots = u.get("itemSlots") or []
-    attack_pts = 0
-    defense_pts = 0
+    points = {"attack": 0, "defense": 0}
 
-    for s in slots:
-        if not s or not isinstance(s, dict):
+    for s in u.get("itemSlots") or []:
+        if not isinstance(s, dict):
             continue
-        name = s.get("name", "").lower()
-        bonus = 0
-        try:
-            bonus = int(s.get("bonus", 0))
-        except Exception:
-            bonus = 0
-        bonus = max(0, bonus)
-        if name == "sword":
-            attack_pts += 1 + bonus
-        elif name == "shield":
-            defense_pts += 1 + bonus
-
-    max_hp = BASE_UNIT_HP + defense_pts * HP_PER_DEFENSE_POINT
-    dps = BASE_UNIT_DPS + attack_pts * DPS_PER_ATTACK_POINT
+        grants = ITEM_STAT_TABLE.get(str(s.get("name") or "").lower())
+        if not grants:
+            continue
+        bonus = max(0, _safe_int(s.get("bonus", 0), 0))
+        for stat, base in grants.items():
+            points[stat] = points.get(stat, 0) + base + bonus
 
     return {
-        "attack": attack_pts,
-        "defense": defense_pts,
-        "max_hp": max_hp,
-        "dps": dps
+        "attack": points["attack"],
+        "defense": points["defense"],
+        "max_hp": BASE_UNIT_HP + points["defense"] * HP_PER_DEFENSE_POINT,
+        "dps": BASE_UNIT_DPS + points["attack"] * DPS_PER_ATTACK_POINT
     }
 
 
+def unit_stats_key(owner, unit_id):
+    # unit ids are only unique within one player's army
+    return (world.id, owner, unit_id)
+
+
+def mark_equipment_changed(u, owner):
+    uid = u.get("id")
+    if uid:
+        key = unit_stats_key(owner, uid)
+        unit_equipment_versions[key] = unit_equipment_versions.get(key, 0) + 1
+
+
+def get_unit_stats(u, owner):
+    """compute_unit_stats, cached until the unit's equipment version changes."""
+    uid = u.get("id")
+    if not uid:
+        return compute_unit_stats(u)
+    key = unit_stats_key(owner, uid)
+    version = unit_equipment_versions.get(key, 0)
+    cached = unit_stats_cache.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+    stats = compute_unit_stats(u)
+    unit_stats_cache[key] = (version, stats)
+    return stats
+
+
+def forget_unit_stats(owner, unit_id):
+    key = unit_stats_key(owner, unit_id)
+    unit_equipment_versions.pop(key, None)
+    unit_stats_cache.pop(key, None)
+
+
 def current_player_id():
-    return sid_to_player.get(request.sid)
+    return world.sid_to_player.get(request.sid)
 
 
 def current_player():
     pid = current_player_id()
-    return pid, players.get(pid)
+    return pid, world.players.get(pid)
 
 
 def require_player_id():
     pid = current_player_id()
     if not pid:
-        socketio.emit("login_error", {"msg": "Login required"}, to=request.sid)
+        queue_emit("login_error", {"msg": "Login required"}, to=request.sid)
     return pid
 
 
+# Per-connection token buckets for high-frequency client events. rate is
+# calls/second, burst the bucket size. On overflow:
+#   coalesce   - keep only the latest call (per "key" field if set) and run
+#                it once a token frees up
+#   drop       - ignore the call
+#   disconnect - drop the connection
+RATE_LIMITS = {
+    "update": {"rate": 20, "burst": 40, "overflow": "coalesce"},
+    "update_units": {"rate": 70, "burst": 140, "overflow": "coalesce"},
+    "attack_unit": {"rate": 10, "burst": 20, "overflow": "drop"},
+    "attack_entity": {"rate": 10, "burst": 20, "overflow": "drop"},
+    "update_map_object": {"rate": 20, "burst": 40, "overflow": "coalesce", "key": "id"},
+    "move_ground_item": {"rate": 20, "burst": 40, "overflow": "coalesce", "key": "groundItemId"},
+    "place_map_object": {"rate": 5, "burst": 20, "overflow": "drop"},
+    "paint_terrain": {"rate": 30, "burst": 60, "overflow": "drop"},
+    "map_batch": {"rate": 5, "burst": 20, "overflow": "drop"},
+    "request_state": {"rate": 1, "burst": 5, "overflow": "coalesce"},
+    "request_map": {"rate": 1, "burst": 5, "overflow": "coalesce"},
+    "request_terrain": {"rate": 1, "burst": 5, "overflow": "coalesce"},
+    "request_resync": {"rate": 2, "burst": 6, "overflow": "coalesce", "key": "collection"},
+    "login": {"rate": 1, "burst": 5, "overflow": "disconnect"},
+}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.time()
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+rate_buckets = {}  # (sid, event) -> TokenBucket
+rate_coalesced = {}  # (sid, event, key) -> (handler, args) waiting for a token
+rate_stats = {}  # (sid, event) -> {"coalesced", "dropped", "disconnected"}
+rate_lock = Lock()
+
+
+def _rate_throttled(sid, event, outcome):
+    counts = rate_stats.setdefault((sid, event), {"coalesced": 0, "dropped": 0, "disconnected": 0})
+    counts[outcome] += 1
+    total = sum(counts.values())
+    if total == 1 or total % 100 == 0:
+        print(f"[RATE_LIMIT] sid={sid} player={sid_world(sid).sid_to_player.get(sid)} event={event} {outcome} (throttled {total}x)", flush=True)
+
+
+def rate_limited(event):
+    """Apply RATE_LIMITS[event] per connection to a socket handler."""
+    cfg = RATE_LIMITS[event]
+
+    def decorate(fn):
+        @wraps(fn)
+        def handler(*args):
+            sid = request.sid
+            now = time.time()
+            with rate_lock:
+                bucket = rate_buckets.get((sid, event))
+                if bucket is None:
+                    bucket = rate_buckets[(sid, event)] = TokenBucket(cfg["rate"], cfg["burst"])
+                allowed = bucket.take(now)
+                if not allowed:
+                    _rate_throttled(sid, event, {"coalesce": "coalesced", "drop": "dropped"}.get(cfg["overflow"], "disconnected"))
+                    if cfg["overflow"] == "coalesce":
+                        data = args[0] if args and isinstance(args[0], dict) else {}
+                        rate_coalesced[(sid, event, data.get(cfg.get("key")))] = (fn, args)
+            if allowed:
+                return fn(*args)
+            if cfg["overflow"] == "disconnect":
+                disconnect(sid=sid)
+        return handler
+    return decorate
+
+
+def replay_coalesced():
+    """Run the latest coalesced call of each throttled stream once its bucket refills."""
+    if not rate_coalesced:
+        return
+    now = time.time()
+    ready = []
+    with rate_lock:
+        for key, call in list(rate_coalesced.items()):
+            sid, event, _ = key
+            bucket = rate_buckets.get((sid, event))
+            if bucket is None or bucket.take(now):
+                del rate_coalesced[key]
+                ready.append((sid, call))
+    for sid, (fn, args) in ready:
+        run_as_socket(sid, fn, *args)
+
+
+def run_as_socket(sid, fn, *args):
+    """Call a socket handler outside its event, as if sid had sent it."""
+    environ = socketio.server.get_environ(sid)
+    if environ is None:
+        return  # disconnected meanwhile
+    with app.request_context(environ), sid_world(sid).bound():
+        request.sid = sid
+        request.namespace = "/"
+        fn(*args)
+
+
+def forget_rate_limits(sid):
+    with rate_lock:
+        for table in (rate_buckets, rate_stats):
+            for key in [k for k in table if k[0] == sid]:
+                del table[key]
+        for key in [k for k in rate_coalesced if k[0] == sid]:
+            del rate_coalesced[key]
+
+
+# Admission control: past the soft limit (or while the NPC tick or the
+# outbound queues are falling behind) logins wait in a queue and are told
+# their position; past the hard limits they are refused so fly's proxy and
+# extra machines take the surge.
+ADMISSION_SOFT_LIMIT = 80  # logged-in players
+ADMISSION_MAX_TICK_LAG = 0.05  # NPC tick lag EWMA (s)
+ADMISSION_MAX_QUEUED_BYTES = 8 * 1024 * 1024  # across all outboxes
+ADMISSION_QUEUE_LIMIT = 50  # waiting logins before new ones are refused
+ADMISSION_RETRY_AFTER = 10  # seconds a refused client should wait
+CONNECTION_HARD_LIMIT = 100  # sockets; matches fly.toml hard_limit
+HEALTH_STALL_SECONDS = 5.0  # NPC loop silent this long => unhealthy
+
+admission_queue = OrderedDict()  # sid -> (username, login data)
+
+
+def overload_reasons():
+    reasons = []
+    if players_online() >= ADMISSION_SOFT_LIMIT:
+        reasons.append("player limit")
+    if tick_monitors["npc"].lag > ADMISSION_MAX_TICK_LAG:
+        reasons.append("tick lag")
+    with outbox_lock:
+        queued = sum(b.queued_bytes for b in outboxes.values())
+    if queued > ADMISSION_MAX_QUEUED_BYTES:
+        reasons.append("outbound queues")
+    return reasons
+
+
+def notify_queue_positions():
+    for position, sid in enumerate(admission_queue, start=1):
+        queue_emit("login_queued", {"position": position, "size": len(admission_queue)}, to=sid)
+
+
+def admit_login(sid, username, data):
+    """True if this login may proceed now; otherwise it is queued or refused."""
+    if sid in world.sid_to_player:
+        return True
+    if sid in admission_queue:
+        admission_queue[sid] = (username, data)
+        notify_queue_positions()
+        return False
+    reasons = overload_reasons()
+    if not reasons and not admission_queue:
+        return True
+    if len(admission_queue) >= ADMISSION_QUEUE_LIMIT:
+        print(f"[ADMISSION] refused login for {username}: queue full ({', '.join(reasons)})", flush=True)
+        queue_emit("login_refused", {"msg": "Server is full, retrying shortly", "retryAfter": ADMISSION_RETRY_AFTER}, to=sid)
+        return False
+    admission_queue[sid] = (username, data)
+    print(f"[ADMISSION] queued login for {username} at {len(admission_queue)} ({', '.join(reasons) or 'queue'})", flush=True)
+    notify_queue_positions()
+    return False
+
+
+def admit_waiting():
+    """Let the head of the login queue in once the server has headroom."""
+    if not admission_queue or overload_reasons():
+        return
+    sid, (username, data) = admission_queue.popitem(last=False)
+    print(f"[ADMISSION] admitting {username} ({len(admission_queue)} still waiting)", flush=True)
+    run_as_socket(sid, complete_login, sid, username, data)
+    notify_queue_positions()
+
+
+def load_report():
+    with outbox_lock:
+        boxes = list(outboxes.values())
+    reasons = overload_reasons()
+    return {
+        "ticks": {name: m.report() for name, m in tick_monitors.items()},
+        "sockets": len(boxes),
+        "players_online": players_online(),
+        "outbound_queued_bytes": sum(b.queued_bytes for b in boxes),
+        "outbound_inflight_bytes": sum(b.inflight_bytes for b in boxes),
+        "slow_clients": sum(1 for b in boxes if b.slow),
+        "admission_queue": len(admission_queue),
+        "overloaded": bool(reasons),
+        "overload_reasons": reasons,
+        "limits": {"players_soft": ADMISSION_SOFT_LIMIT, "sockets_hard": CONNECTION_HARD_LIMIT},
+        "startup_ms": startup_timings,
+        "pager": world.pager.report() if world.pager is not None else None,
+        "worlds": {w.id: {"players": len(w.sid_to_player), "map_objects": len(w.map_objects)}
+                   for w in worlds.values()},
+    }
+
+
+def rate_limit_stats():
+    with rate_lock:
+        entries = [{"sid": sid, "player": sid_world(sid).sid_to_player.get(sid), "event": event, **counts}
+                   for (sid, event), counts in rate_stats.items()]
+    return {"throttled": sorted(entries, key=lambda e: -(e["coalesced"] + e["dropped"] + e["disconnected"])),
+            "pending_coalesced": len(rate_coalesced)}
+
+
 def apply_unit_stats(u, owner_sid=None, broadcast_hp=False):
-    """Recompute derived stats (maxHp/dps) from items and optionally broadcast HP."""
-    stats = compute_unit_stats(u)
+    """Recompute derived stats (maxHp/dps) after an equipment change and optionally broadcast HP."""
+    mark_equipment_changed(u, owner_sid)
+    stats = get_unit_stats(u, owner_sid)
 
     old_max = float(u.get("maxHp", BASE_UNIT_HP))
     old_hp = float(u.get("hp", BASE_UNIT_HP))
@@ -464,151 +3352,1010 @@ def apply_unit_stats(u, owner_sid=None, broadcast_hp=False):
     u["maxHp"] = stats["max_hp"]
     u["dps"] = stats["dps"]
 
-    # If max HP increased, grant the difference (up to new max). If decreased, clamp.
-    if stats["max_hp"] > old_max:
-        new_hp = min(stats["max_hp"], old_hp + (stats["max_hp"] - old_max))
-    else:
-        new_hp = min(old_hp, stats["max_hp"])
+    # If max HP increased, grant the difference (up to new max). If decreased, clamp.
+    if stats["max_hp"] > old_max:
+        new_hp = min(stats["max_hp"], old_hp + (stats["max_hp"] - old_max))
+    else:
+        new_hp = min(old_hp, stats["max_hp"])
+
+    u["hp"] = new_hp
+
+    if broadcast_hp and owner_sid and u.get("id"):
+        target_sid = world.player_to_sid.get(owner_sid, owner_sid)
+        queue_emit("unit_hp_update", {
+            "sid": owner_sid,
+            "unitId": u["id"],
+            "hp": u["hp"],
+            "maxHp": u["maxHp"]
+        }, to=target_sid)
+
+    return u
+
+def broadcast_state():
+    while True:
+        socketio.sleep(1/20)  # 20 updates/sec
+        state = {
+            "players": world.players,
+            "buildings": world.buildings,
+            "trees": world.trees
+        }
+        socketio.emit("state", state, to=world.room)
+
+#socketio.start_background_task(broadcast_state)
+
+
+def random_color():
+    return "#" + "".join(random.choices("0123456789ABCDEF", k=6))
+
+# ===== FINGERPRINTED ASSETS =====
+# index.html and the scripts it loads reference files as "static/<path>".
+# Those literal references are rewritten to /assets/<content hash>/<path>,
+# which can be cached forever: any change to a file changes its URL. Text
+# assets are kept rewritten and precompressed (gzip, plus br when the brotli
+# module is available) in memory; entries are revalidated by (mtime, size)
+# at most once per ASSET_RECHECK_INTERVAL, so editing a file during
+# development still shows up on the next reload. References must not form a
+# cycle (a file can't embed a hash of itself).
+ASSET_TEXT_TYPES = {
+    ".html": "text/html",
+    ".js": "application/javascript",
+    ".json": "application/json",
+    ".css": "text/css",
+}
+ASSET_REF_RE = re.compile(r"""(?<=["'`(])(/?)static/([A-Za-z0-9_./-]+\.[A-Za-z0-9]+)(?=["'`)])""")
+ASSET_IMMUTABLE = "public, max-age=31536000, immutable"
+ASSET_RECHECK_INTERVAL = 1.0  # seconds a validated entry is trusted without a stat
+
+# root-relative path -> {"key", "digest", "body", "variants", "deps", "checked"}
+asset_cache = {}
+asset_lock = Lock()
+
+
+class AssetBuildError(Exception):
+    """A text asset can't be fingerprinted (its references form a cycle)."""
+
+
+def asset_path(rel):
+    rel = os.path.normpath(rel)
+    if os.path.isabs(rel) or rel.split(os.sep)[0] == "..":
+        return None
+    path = Path(app.root_path) / rel
+    return path if path.is_file() else None
+
+
+def asset_fresh(entry, key, visiting, checked):
+    if entry is None or entry["key"] != key:
+        return False
+    return all((dep_entry := asset_entry(dep, visiting, checked)) and dep_entry["digest"] == digest
+               for dep, digest in entry["deps"].items())
+
+
+def asset_entry(rel, visiting=None, checked=None):
+    """
+    Cached fingerprint for a file under the app root. Binary assets only get
+    a digest; text assets also carry their rewritten body and precompressed
+    variants. Returns None for missing files; raises AssetBuildError when
+    references loop back to a file being resolved.
+
+    visiting is the chain of files being resolved and checked the entries
+    already validated in this call, so each file is stat'ed once per lookup.
+    """
+    if visiting is None:
+        visiting, checked = [], {}
+    if rel in checked:
+        return checked[rel]
+    if rel in visiting:
+        raise AssetBuildError("asset reference cycle: " + " -> ".join(visiting[visiting.index(rel):] + [rel]))
+    with asset_lock:
+        entry = asset_cache.get(rel)
+    if entry is not None and time.monotonic() - entry["checked"] < ASSET_RECHECK_INTERVAL:
+        checked[rel] = entry
+        return entry
+    path = asset_path(rel)
+    if path is None:
+        checked[rel] = None
+        return None
+    st = path.stat()
+    key = (st.st_mtime_ns, st.st_size)
+    visiting.append(rel)
+    try:
+        if asset_fresh(entry, key, visiting, checked):
+            entry["checked"] = time.monotonic()
+        else:
+            entry = build_asset_entry(rel, path, key, visiting, checked)
+    finally:
+        visiting.pop()
+    checked[rel] = entry
+    return entry
+
+
+def build_asset_entry(rel, path, key, visiting, checked):
+    data = path.read_bytes()
+    body, deps = None, {}
+    if path.suffix in ASSET_TEXT_TYPES:
+        def fingerprint(m):
+            ref = f"static/{m.group(2)}"
+            dep = asset_entry(ref, visiting, checked) if ref != rel else None
+            if dep is None:
+                return m.group(0)
+            deps[ref] = dep["digest"]
+            return f"{m.group(1)}assets/{dep['digest']}/{m.group(2)}"
+        body = ASSET_REF_RE.sub(fingerprint, data.decode("utf-8")).encode("utf-8")
+        data = body
+    entry = {
+        "key": key,
+        "digest": hashlib.sha1(data).hexdigest()[:16],
+        "body": body,
+        "variants": {},
+        "deps": deps,
+        "checked": time.monotonic(),
+    }
+    if body is not None:
+        entry["variants"]["gzip"] = gzip.compress(body, compresslevel=9, mtime=0)
+        if brotli is not None:
+            entry["variants"]["br"] = brotli.compress(body)
+    with asset_lock:
+        asset_cache[rel] = entry
+    return entry
+
+
+def text_asset_response(rel, entry, cache_control):
+    etag = f'"{entry["digest"]}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status=304, headers=headers)
+    body = entry["body"]
+    accepted = request.accept_encodings
+    for encoding in ("br", "gzip"):
+        variant = entry["variants"].get(encoding)
+        if variant is not None and accepted[encoding]:
+            body = variant
+            headers["Content-Encoding"] = encoding
+            break
+    mimetype = ASSET_TEXT_TYPES[Path(rel).suffix]
+    return Response(body, mimetype=mimetype, headers=headers)
+
+
+# Serve files
+@app.route("/")
+def index():
+    try:
+        entry = asset_entry("index.html")
+    except AssetBuildError as exc:
+        print(f"[ASSETS] {exc}", flush=True)
+        return {"error": str(exc)}, 500
+    # the page itself always revalidates; everything it references is immutable
+    return text_asset_response("index.html", entry, "no-cache")
+
+@app.route("/assets/<digest>/<path:path>")
+def fingerprinted_asset(digest, path):
+    rel = f"static/{path}"
+    try:
+        entry = asset_entry(rel)
+    except AssetBuildError as exc:
+        print(f"[ASSETS] {exc}", flush=True)
+        return {"error": str(exc)}, 500
+    if entry is None:
+        return {"error": "not found"}, 404
+    # a stale hash (page cached from before a deploy) still gets the current
+    # file, just without the long-lived caching
+    cache_control = ASSET_IMMUTABLE if entry["digest"] == digest else "no-cache"
+    if entry["body"] is not None:
+        return text_asset_response(rel, entry, cache_control)
+    resp = send_from_directory("static", path)
+    resp.headers["Cache-Control"] = cache_control
+    return resp
+
+@app.route("/static/<path:path>")
+def send_static(path):
+    return send_from_directory("static", path)
+
+@app.route("/world/chunks/<digest>.json")
+def static_chunk(digest):
+    body = static_chunk_bodies.get(digest)
+    for w in worlds.values():
+        if body is not None:
+            break
+        if w.pager is not None:
+            with w.map_lock:
+                body = w.pager.static_body(digest)
+            if body is not None:
+                static_chunk_bodies[digest] = body
+    if body is None:
+        return {"error": "unknown chunk"}, 404
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype="application/json", headers={**headers, "Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+
+@app.route("/terrain/chunks/<digest>.bin")
+def terrain_chunk(digest):
+    body = None
+    for w in worlds.values():
+        with w.terrain_lock:
+            key = w.terrain.by_digest.get(digest)
+            if key is not None:
+                body = w.terrain.bodies[key][1]
+                break
+    if body is None:
+        return {"error": "unknown chunk"}, 404
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype="application/octet-stream",
+                    headers={**headers, "Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+
+@app.route("/map/batch", methods=["POST"])
+def map_batch_import():
+    """Scripted map building: {"world"?, "owner"?, "ops": [...]} as in map_batch."""
+    if not MAP_IMPORT_TOKEN:
+        return {"error": "map import is disabled (set MAP_IMPORT_TOKEN)"}, 404
+    if request.headers.get("Authorization") != f"Bearer {MAP_IMPORT_TOKEN}":
+        return {"error": "unauthorized"}, 401
+    body = request.get_json(silent=True) or {}
+    target = worlds.get(body.get("world") or DEFAULT_WORLD)
+    if target is None:
+        return {"error": f"unknown world {body.get('world')!r}"}, 404
+    with target.bound():
+        try:
+            result = apply_map_batch(body.get("ops"), body.get("owner"), limit=MAP_IMPORT_MAX)
+        except MapBatchError as exc:
+            return {"ok": False, "error": str(exc), "index": exc.index}, 400
+    return {"ok": True, **result}
+
+@app.route("/healthz")
+def healthz():
+    npc = tick_monitors["npc"]
+    stalled = scheduler_started and npc.last is not None and time.time() - npc.last > HEALTH_STALL_SECONDS
+    return {"ok": not stalled, "npc_tick_lag": round(npc.lag, 4)}, (503 if stalled else 200)
+
+@app.route("/loadz")
+def loadz():
+    return load_report()
+
+@app.route("/metrics")
+def metrics():
+    return {"outbox": outbox_stats(), "rate_limits": rate_limit_stats()}
+
+# Helper to emit current state. Collections (map objects, ground items,
+# resources) are only included on a full snapshot; otherwise clients keep
+# them current from the change feeds.
+def emit_state(to_sid=None, full=False, skip_sid=None):
+    state = {
+        "players": world.players,
+        "buildings": world.buildings
+    }
+    if full:
+        # static objects, resources and trees come from the chunk manifest
+        state["ground_items"] = world.ground_items
+        state["map_objects"] = dynamic_map_objects()
+        state["static"] = static_layer_manifest()
+        state["feeds"] = feed_seqs()
+        state["epoch"] = world.epoch
+    if to_sid:
+        queue_emit("state", state, to=to_sid)
+    else:
+        emit_hot("state", state, skip_sid=skip_sid)
+
+
+def first_collision(candidates, x, y, pad=0.0, ignore=()):
+    """Exact box test over broad-phase candidates; ids in ignore never block."""
+    for obj in candidates:
+        if ignore and obj.get("id") in ignore:
+            continue
+        meta = obj.get("meta") or {}
+        cw = float(meta.get("cw") or meta.get("w") or 0)
+        ch = float(meta.get("ch") or meta.get("h") or 0)
+        if cw <= 0 or ch <= 0:
+            continue
+        cx = float(obj.get("x", 0)) + float(meta.get("cx", 0))
+        cy = float(obj.get("y", 0)) + float(meta.get("cy", 0))
+        half_w = cw / 2 + pad
+        half_h = ch / 2 + pad
+        if abs(x - cx) <= half_w and abs(y - cy) <= half_h:
+            return obj
+    return None
+
+
+def find_world_collision(x, y, padding=0.0, ignore=()):
+    """Return blocking object if the point collides with any entity (ids in ignore excepted)."""
+    pad = float(padding or 0.0)
+    obj = first_collision(world.collision_index.candidates(x, y, pad), x, y, pad, ignore)
+    if obj is not None:
+        return obj
+
+    for b in world.buildings:
+        bx = float(b.get("x", 0))
+        by = float(b.get("y", 0))
+        left = bx - BUILD_W / 2 - BUILD_COLLISION_PADDING - pad
+        right = bx + BUILD_W / 2 + BUILD_COLLISION_PADDING + pad
+        top = by - BUILD_H / 2 - BUILD_COLLISION_PADDING - pad
+        bottom = by + BUILD_H / 2 + BUILD_COLLISION_PADDING + pad
+        if left <= x <= right and top <= y <= bottom:
+            return b
+
+    return None
+
+
+
+# ===== Inventory transfer engine =====
+#
+# Every item move between units, entities, ground items and map items goes
+# through inventory_move(). Slot references look like:
+#   {"kind": "unit", "id": unit_id, "slot": i}      (unit owned by the caller)
+#   {"kind": "entity", "id": entity_id, "slot": i}
+#   {"kind": "ground", "id": ground_item_id}       (source only)
+#   {"kind": "map_item", "id": map_object_id}      (source only)
+#   {"kind": "world", "x": x, "y": y}              (destination only)
+# Everything is validated before anything is mutated, so a rejected move
+# leaves the world untouched.
+
+class InventoryError(Exception):
+    """A transfer was rejected; the message is reported back to the client."""
+
+
+def _slot_index(value, default=-1):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _slot_list(container, min_len=0):
+    slots = container.get("itemSlots") or []
+    if len(slots) < min_len:
+        slots += [None] * (min_len - len(slots))
+    container["itemSlots"] = slots
+    return slots
+
+
+def _resolve_container(pid, ref):
+    kind = ref.get("kind")
+    if kind == "unit":
+        u = find_unit(pid, ref.get("id"))
+        if not u:
+            raise InventoryError("unit not owned by you")
+        return u
+    if kind == "entity":
+        ent = find_map_object(ref.get("id"))
+        if not ent:
+            raise InventoryError("entity not found")
+        return ent
+    raise InventoryError(f"bad slot kind {kind!r}")
+
+
+def make_dropped_object(stats, x, y):
+    """Map item (for tile-backed items) or ground item for a dropped item."""
+    if stats.get("itemTile"):
+        return "map", expand_map_object({
+            "id": str(uuid.uuid4()),
+            "type": "tile",
+            "kind": "item",
+            "x": x,
+            "y": y,
+            "meta": {
+                "entity": True,
+                "title": stats["name"],
+                "bio": "An item that can be picked up",
+                "actions": [],
+                "collides": False,
+                "w": 64,
+                "h": 64,
+                "itemTile": stats["itemTile"],
+                "itemStats": stats
+            }
+        })
+    return "ground", {
+        "id": str(uuid.uuid4()),
+        "name": stats["name"],
+        "bonus": stats["bonus"],
+        "attack": stats["attack"],
+        "defense": stats["defense"],
+        "x": x,
+        "y": y,
+        "itemStats": stats
+    }
+
 
-    u["hp"] = new_hp
+def new_inventory_changes():
+    return {"slots": [], "ground": {"add": [], "remove": []}, "map": {"add": [], "remove": []}, "units": []}
 
-    if broadcast_hp and owner_sid and u.get("id"):
-        target_sid = player_to_sid.get(owner_sid, owner_sid)
-        socketio.emit("unit_hp_update", {
-            "sid": owner_sid,
-            "unitId": u["id"],
-            "hp": u["hp"],
-            "maxHp": u["maxHp"]
-        }, to=target_sid)
 
-    return u
+def _slot_change(ref, container, index):
+    change = {"kind": ref["kind"], "id": container.get("id"), "slot": index, "item": container["itemSlots"][index]}
+    if ref["kind"] == "unit":
+        change["owner"] = ref.get("owner")
+    return change
 
-# Add global state for trees
-trees = []
 
-# Function to generate a random tree
-def generate_tree():
-    return {"x": random.randint(-8000, 8000), "y": random.randint(-8000, 8000)}
+def inventory_move(pid, src, dst, max_distance=None, collision_pad=None):
+    """Move one item from *src* to *dst* as a single transaction.
 
-# Function to generate n trees
-def generate_trees(n=50):
-    global trees
-    for _ in range(n):
-        trees.append(generate_tree())
+    max_distance limits pickups (ground/map item -> unit) to items near the
+    unit; collision_pad rejects world drops that land inside a collider.
+    Returns a change record for emit_inventory_changes().
+    """
+    changes = new_inventory_changes()
+    for ref in (src, dst):
+        if ref.get("kind") == "unit":
+            ref.setdefault("owner", pid)
+    with world.map_lock, world.ground_lock:
+        # --- resolve source ---
+        skind = src.get("kind")
+        src_container = src_index = None
+        if skind in ("unit", "entity"):
+            src_container = _resolve_container(pid, src)
+            src_index = _slot_index(src.get("slot"))
+            slots = src_container.get("itemSlots") or []
+            if not (0 <= src_index < len(slots)):
+                raise InventoryError("source slot out of range")
+            item = slots[src_index]
+            if not item:
+                raise InventoryError("no item in that slot")
+        elif skind == "ground":
+            item = world.ground_index.get(src.get("id"))
+            if item is None:
+                raise InventoryError("ground item not found")
+        elif skind == "map_item":
+            item = find_map_object(src.get("id"))
+            if item is None:
+                raise InventoryError("map item not found")
+            if item.get("kind") != "item":
+                raise InventoryError("object is not an item")
+        else:
+            raise InventoryError(f"bad source kind {skind!r}")
+
+        # --- resolve destination ---
+        dkind = dst.get("kind")
+        dst_container = dst_index = None
+        drop_xy = None
+        if dkind == "unit":
+            dst_container = _resolve_container(pid, dst)
+            dst_index = _slot_index(dst.get("slot"))
+            uslots = dst_container.get("itemSlots") or [None, None, None, None, None]
+            if not (0 <= dst_index < len(uslots)):
+                raise InventoryError("slot index out of range")
+            if uslots[dst_index] is not None:
+                raise InventoryError("unit slot occupied")
+            if max_distance is not None and skind in ("ground", "map_item"):
+                if dist_xy(dst_container.get("x", 0), dst_container.get("y", 0), item.get("x", 0), item.get("y", 0)) > max_distance:
+                    raise InventoryError("item out of reach")
+        elif dkind == "entity":
+            dst_container = _resolve_container(pid, dst)
+            dst_index = _slot_index(dst.get("slot"))
+            if dst_index < 0:
+                raise InventoryError("slot index out of range")
+            eslots = dst_container.get("itemSlots") or []
+            if dst_index < len(eslots) and eslots[dst_index] is not None:
+                raise InventoryError("entity slot already occupied")
+        elif dkind == "world":
+            try:
+                drop_xy = (float(dst.get("x")), float(dst.get("y")))
+            except (TypeError, ValueError):
+                raise InventoryError("bad drop position")
+            if skind not in ("unit", "entity"):
+                raise InventoryError("only slotted items can be dropped")
+            if collision_pad is not None and find_world_collision(drop_xy[0], drop_xy[1], collision_pad):
+                raise InventoryError("blocked: collision")
+        else:
+            raise InventoryError(f"bad destination kind {dkind!r}")
+
+        if src_container is not None and src_container is dst_container and src_index == dst_index:
+            raise InventoryError("source and destination are the same slot")
+
+        # --- apply ---
+        if skind in ("unit", "entity"):
+            src_container["itemSlots"][src_index] = None
+            changes["slots"].append(_slot_change(src, src_container, src_index))
+            if skind == "unit":
+                changes["units"].append(src_container)
+        elif skind == "ground":
+            remove_ground_item(item.get("id"))
+            changes["ground"]["remove"].append(item.get("id"))
+        else:
+            remove_map_object(item.get("id"))
+            changes["map"]["remove"].append(item.get("id"))
+
+        if dkind in ("unit", "entity"):
+            # Items coming off the ground, or into a unit, are normalized into
+            # a fresh slot payload; entity-to-entity moves keep the item as-is.
+            if dkind == "unit" or skind in ("ground", "map_item"):
+                payload = slot_payload_from_source(item)
+            else:
+                payload = item
+            _slot_list(dst_container, dst_index + 1)[dst_index] = payload
+            changes["slots"].append(_slot_change(dst, dst_container, dst_index))
+            if dkind == "unit":
+                changes["units"].append(dst_container)
+        else:
+            stats = normalize_item_stats(item, fallback_name="Item")
+            where, dropped = make_dropped_object(stats, *drop_xy)
+            if where == "map":
+                add_map_object(dropped)
+                changes["map"]["add"].append(dropped)
+            else:
+                add_ground_item(dropped)
+                changes["ground"]["add"].append(dropped)
+
+    if any(c["kind"] == "entity" for c in changes["slots"]) or changes["map"]["add"] or changes["map"]["remove"]:
+        mark_dirty("map")
+    if changes["ground"]["add"] or changes["ground"]["remove"]:
+        mark_dirty("ground")
+    return changes
+
+
+def inventory_set_slot(pid, ref, item):
+    """Replace the item in one slot (e.g. a blacksmith upgrade) and return a change record."""
+    changes = new_inventory_changes()
+    if ref.get("kind") == "unit":
+        ref.setdefault("owner", pid)
+    with world.map_lock:
+        container = _resolve_container(pid, ref)
+        index = _slot_index(ref.get("slot"))
+        if index < 0:
+            raise InventoryError("slot index out of range")
+        _slot_list(container, index + 1)[index] = item
+        changes["slots"].append(_slot_change(ref, container, index))
+        if ref.get("kind") == "unit":
+            changes["units"].append(container)
+        else:
+            mark_dirty("map")
+    return changes
 
-# Emit trees to a client
-def emit_trees(sid=None):
-    if sid:
-        socketio.emit("server_trees", trees, to=sid)
-    else:
-        socketio.emit("server_trees", trees)
 
+def emit_inventory_changes(pid, changes):
+    """Send slot-level deltas: unit slots to their owner, entity slots to all clients.
 
-def broadcast_state():
-    while True:
-        socketio.sleep(1/20)  # 20 updates/sec
-        state = {
-            "players": players,
-            "buildings": buildings,
-            "trees": trees
-        }
-        socketio.emit("state", state)
+    Ground/map items created or consumed by the move go out on the change feeds.
+    """
+    for u in changes["units"]:
+        apply_unit_stats(u, owner_sid=pid, broadcast_hp=True)
 
-#socketio.start_background_task(broadcast_state)
+    unit_slots = [c for c in changes["slots"] if c["kind"] == "unit"]
+    public_slots = [c for c in changes["slots"] if c["kind"] != "unit"]
+    if unit_slots:
+        queue_emit("slots_changed", {"slots": unit_slots}, to=world.player_to_sid.get(pid, pid))
 
+    if public_slots:
+        queue_emit("slots_changed", {"slots": public_slots})
 
-def random_color():
-    return "#" + "".join(random.choices("0123456789ABCDEF", k=6))
+    for obj in changes["map"]["add"]:
+        world.map_feed.upsert(obj["id"])
+    for oid in changes["map"]["remove"]:
+        world.map_feed.remove(oid)
+    for gi in changes["ground"]["add"]:
+        world.ground_feed.upsert(gi["id"])
+    for gid in changes["ground"]["remove"]:
+        world.ground_feed.remove(gid)
 
-# Serve files
-@app.route("/")
-def index():
-    return send_from_directory(".", "index.html")
 
-@app.route("/static/<path:path>")
-def send_static(path):
-    return send_from_directory("static", path)
+def run_inventory_move(event, pid, src, dst, **kwargs):
+    """inventory_move for a socket handler: report rejections as server_debug."""
+    try:
+        changes = inventory_move(pid, src, dst, **kwargs)
+    except InventoryError as exc:
+        print(f"[{event}] rejected for player={pid}: {exc}", flush=True)
+        queue_emit("server_debug", {"msg": f"{event}: {exc}"}, to=request.sid)
+        return None
+    emit_inventory_changes(pid, changes)
+    return changes
 
-# Helper to emit current state
-def emit_state(to_sid=None):
-    state = {
-        "players": players,
-        "buildings": buildings,
-        "trees": trees,
-        "ground_items": ground_items,
-        "map_objects": map_objects,
-        "resources": resources
-    }
-    if to_sid:
-        socketio.emit("state", state, to=to_sid)
-    else:
-        socketio.emit("state", state)
 
+# Socket events
 
-def find_world_collision(x, y, padding=0.0):
-    """Return blocking object if the point collides with any entity."""
-    pad = float(padding or 0.0)
-    for obj in map_objects:
-        meta = obj.get("meta") or {}
-        if not meta.get("collides"):
-            continue
-        cw = float(meta.get("cw") or meta.get("w") or 0)
-        ch = float(meta.get("ch") or meta.get("h") or 0)
-        if cw <= 0 or ch <= 0:
-            continue
-        cx = float(obj.get("x", 0)) + float(meta.get("cx", 0))
-        cy = float(obj.get("y", 0)) + float(meta.get("cy", 0))
-        half_w = cw / 2 + pad
-        half_h = ch / 2 + pad
-        if abs(x - cx) <= half_w and abs(y - cy) <= half_h:
-            return obj
+TILE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
 
-    for b in buildings:
-        bx = float(b.get("x", 0))
-        by = float(b.get("y", 0))
-        left = bx - BUILD_W / 2 - BUILD_COLLISION_PADDING - pad
-        right = bx + BUILD_W / 2 + BUILD_COLLISION_PADDING + pad
-        top = by - BUILD_H / 2 - BUILD_COLLISION_PADDING - pad
-        bottom = by + BUILD_H / 2 + BUILD_COLLISION_PADDING + pad
-        if left <= x <= right and top <= y <= bottom:
-            return b
+# name -> ((mtime_ns, size), meta): survives directory rescans so only
+# changed files are re-read and re-hashed
+tile_meta_cache = {}
+tiles_manifest_cache = {"key": None, "body": None, "etag": None, "names": frozenset()}
+tiles_manifest_lock = Lock()
 
-    return None
 
+def image_dimensions(data):
+    """(width, height) from a PNG, JPEG or WebP header, or (None, None)."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and data[12:16] == b"IHDR":
+        return struct.unpack(">II", data[16:24])
+    if data[:2] == b"\xff\xd8":
+        pos = 2
+        while pos + 9 < len(data):
+            if data[pos] != 0xFF:
+                pos += 1
+                continue
+            marker = data[pos + 1]
+            seg_len = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+            # SOF0..SOF15 carry the frame size (C4/C8/CC are not frames)
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                h, w = struct.unpack(">HH", data[pos + 5:pos + 9])
+                return w, h
+            pos += 2 + seg_len
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        chunk = data[12:16]
+        if chunk == b"VP8 ":
+            w, h = struct.unpack("<HH", data[26:30])
+            return w & 0x3FFF, h & 0x3FFF
+        if chunk == b"VP8L":
+            b = data[21:25]
+            return 1 + (((b[1] & 0x3F) << 8) | b[0]), 1 + (((b[3] & 0xF) << 10) | (b[2] << 2) | ((b[1] & 0xC0) >> 6))
+        if chunk == b"VP8X":
+            return 1 + int.from_bytes(data[24:27], "little"), 1 + int.from_bytes(data[27:30], "little")
+    return None, None
+
+
+def tile_meta(path, stat):
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = tile_meta_cache.get(path.name)
+    if cached and cached[0] == key:
+        return cached[1]
+    data = path.read_bytes()
+    w, h = image_dimensions(data)
+    meta = {
+        "file": path.name,
+        "w": w,
+        "h": h,
+        "bytes": len(data),
+        "hash": hashlib.sha1(data).hexdigest()[:12],
+    }
+    tile_meta_cache[path.name] = (key, meta)
+    return meta
 
 
+def build_tiles_manifest():
+    """
+    Rescan /static/tiles only when the directory's mtime moves (a tile was
+    added, removed or replaced by rename); in-place rewrites are caught by the
+    per-file (mtime, size) check the next time the directory changes.
+    Returns (json_body, etag).
+    """
+    tiles_dir = Path(app.root_path) / "static" / "tiles"
+    try:
+        key = tiles_dir.stat().st_mtime_ns
+    except FileNotFoundError:
+        key = None
+    with tiles_manifest_lock:
+        if tiles_manifest_cache["body"] is not None and tiles_manifest_cache["key"] == key:
+            return tiles_manifest_cache["body"], tiles_manifest_cache["etag"]
+        meta = {}
+        if key is not None:
+            for entry in os.scandir(tiles_dir):
+                name = entry.name
+                # keep only images you want
+                if not entry.is_file() or not name.lower().endswith(TILE_EXTENSIONS):
+                    continue
+                stem = Path(name).stem  # "tree.png" -> "tree"
+                meta[stem] = tile_meta(Path(entry.path), entry.stat())
+        for name in list(tile_meta_cache):
+            if Path(name).stem not in meta:
+                tile_meta_cache.pop(name, None)
+        tiles = sorted(meta)
+        body = json.dumps({"tiles": tiles, "meta": {t: meta[t] for t in tiles}}, separators=(",", ":"))
+        etag = f'"{hashlib.sha1(body.encode()).hexdigest()[:20]}"'
+        tiles_manifest_cache.update(key=key, body=body, etag=etag, names=frozenset(tiles))
+        print(f"[TILES] manifest rebuilt: {len(tiles)} tiles, {len(body)} bytes", flush=True)
+        return body, etag
 
 
+def tile_names():
+    build_tiles_manifest()
+    return tiles_manifest_cache["names"]
 
-# Socket events
 
 @app.route("/tiles_manifest")
 def tiles_manifest():
     """
     Returns available tile images from /static/tiles as:
-    { "tiles": ["building2", "tree", ...] }
+    { "tiles": ["building2", "tree", ...],
+      "meta": { "tree": {"file": "tree.png", "w": 128, "h": 160, "bytes": 5120, "hash": "..."} } }
     """
-    tiles_dir = Path(app.root_path) / "static" / "tiles"
-    tiles = []
+    body, etag = build_tiles_manifest()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype="application/json", headers=headers)
+
+
+# ===== SPRITE ATLASES =====
+# Unit animations ship as thousands of single-frame PNGs. Each animation
+# layer (a folder holding one subfolder per direction) is packed into a few
+# trimmed atlas pages plus a JSON frame map. Builds are cached on disk keyed
+# by a fingerprint of the source frames; run `python app.py build-atlases`
+# at deploy time, or the first /atlases.json request builds them in the
+# background while clients fall back to individual frames.
+ATLAS_ROOTS = ("Idle", "Run", "Walk", "Attack", "SpiderFrames")
+ATLAS_FORMATS = ("png", "webp")
+ATLAS_SCALES = (1.0, 0.5)
+ATLAS_MAX_SIDE = 2048
+ATLAS_PADDING = 2
+ATLAS_LAYOUT_VERSION = 1
+ATLAS_CACHE_DIR = Path(os.environ.get("ATLAS_CACHE_DIR", Path(app.root_path) / "atlas_cache"))
+
+# (format, scale) -> (manifest_json, etag)
+atlas_manifests = {}
+atlas_builds = set()
+atlas_failed = set()
+atlas_lock = Lock()
+
+
+def atlas_sources():
+    """{layer: {direction: [frame paths in order]}} for every animation under ATLAS_ROOTS."""
+    static_dir = Path(app.root_path) / "static"
+    layers = {}
+    for root in ATLAS_ROOTS:
+        base = static_dir / root
+        if not base.is_dir():
+            continue
+        for frame_path in sorted(base.rglob("*.png")):
+            direction_dir = frame_path.parent
+            layer = direction_dir.parent.relative_to(static_dir).as_posix()
+            layers.setdefault(layer, {}).setdefault(direction_dir.name, []).append(frame_path)
+    return layers
 
-    if tiles_dir.exists():
-        for name in os.listdir(tiles_dir):
-            # keep only images you want
-            if name.lower().endswith((".png", ".jpg", ".jpeg", ".webp")):
-                stem = Path(name).stem  # "tree.png" -> "tree"
-                tiles.append(stem)
 
-    tiles.sort()
-    return {"tiles": tiles}
+def atlas_fingerprint(layers, fmt, scale):
+    h = hashlib.sha1(f"{ATLAS_LAYOUT_VERSION}:{ATLAS_MAX_SIDE}:{ATLAS_PADDING}:{fmt}:{scale:g}".encode())
+    for layer in sorted(layers):
+        for direction in sorted(layers[layer]):
+            for frame_path in layers[layer][direction]:
+                st = frame_path.stat()
+                h.update(f"{frame_path.name}:{st.st_mtime_ns}:{st.st_size};".encode())
+    return h.hexdigest()[:20]
 
 
-@socketio.on("request_map")
-def on_request_map():
+def pack_shelves(sizes):
+    """
+    Shelf-pack (w, h) boxes, tallest first, into pages of at most ATLAS_MAX_SIDE.
+    Returns ([(page, x, y)] in input order, [(page_w, page_h)]).
+    """
+    pad = ATLAS_PADDING
+    area = sum((w + pad) * (h + pad) for w, h in sizes)
+    widest = max((w + pad for w, _ in sizes), default=1)
+    shelf_w = min(ATLAS_MAX_SIDE, max(widest, int(math.sqrt(area * 1.1)) + 1))
+    placements = [None] * len(sizes)
+    pages = []
+    x = y = shelf_h = used_w = 0
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i][1]):
+        w, h = sizes[i]
+        if x + w + pad > shelf_w:
+            x, y, shelf_h = 0, y + shelf_h, 0
+        if not pages or y + h + pad > ATLAS_MAX_SIDE:
+            if pages:
+                pages[-1] = (used_w, y)
+            pages.append(None)
+            x = y = shelf_h = used_w = 0
+        placements[i] = (len(pages) - 1, x, y)
+        x += w + pad
+        shelf_h = max(shelf_h, h + pad)
+        used_w = max(used_w, x)
+    if pages:
+        pages[-1] = (used_w, y + shelf_h)
+    return placements, pages
+
+
+def write_atlas_page(page, fmt):
+    """Encode one atlas page into the cache dir under its content hash; returns its URL."""
+    from io import BytesIO
+    buf = BytesIO()
+    if fmt == "webp":
+        page.save(buf, "WEBP", quality=90, method=4)
+    else:
+        page.save(buf, "PNG", optimize=True)
+    data = buf.getvalue()
+    digest = hashlib.sha1(data).hexdigest()[:20]
+    path = ATLAS_CACHE_DIR / f"{digest}.{fmt}"
+    if not path.exists():
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+    return f"atlas/{digest}.{fmt}"
+
+
+def build_atlas_layer(frames_by_dir, fmt, scale):
+    from PIL import Image  # optional dependency: only atlas builds need Pillow
+
+    frames = []  # (direction, trimmed image, ox, oy)
+    frame_size = None
+    for direction, paths in sorted(frames_by_dir.items()):
+        for frame_path in paths:
+            with Image.open(frame_path) as src:
+                im = src.convert("RGBA")
+            if scale != 1.0:
+                im = im.resize((max(1, round(im.width * scale)), max(1, round(im.height * scale))), Image.LANCZOS)
+            frame_size = frame_size or im.size
+            bbox = im.getbbox()
+            if bbox is None:
+                frames.append((direction, None, 0, 0))
+            else:
+                frames.append((direction, im.crop(bbox), bbox[0], bbox[1]))
+    sizes = [(im.width, im.height) if im else (0, 0) for _, im, _, _ in frames]
+    placements, page_sizes = pack_shelves(sizes)
+    pages = [Image.new("RGBA", size) for size in page_sizes]
+    regions = {}
+    for (direction, im, ox, oy), (page, x, y) in zip(frames, placements):
+        if im is not None:
+            pages[page].paste(im, (x, y))
+        # [page, x, y, w, h, offset_x, offset_y]; w == 0 marks an empty frame
+        regions.setdefault(direction, []).append([page, x, y, im.width if im else 0, im.height if im else 0, ox, oy])
+    return {
+        "size": list(frame_size or (0, 0)),
+        "pages": [write_atlas_page(page, fmt) for page in pages],
+        "frames": regions,
+    }
+
+
+def build_atlas_variant(fmt, scale):
+    """Build (or load from the disk cache) every atlas for one format/scale. Returns (json, etag)."""
+    layers = atlas_sources()
+    fingerprint = atlas_fingerprint(layers, fmt, scale)
+    manifest_path = ATLAS_CACHE_DIR / f"manifest-{fmt}-{scale:g}.json"
+    if manifest_path.exists():
+        body = manifest_path.read_text()
+        cached = json.loads(body)
+        pages = [url for a in cached.get("atlases", {}).values() for url in a["pages"]]
+        if cached.get("fingerprint") == fingerprint and all((ATLAS_CACHE_DIR / Path(u).name).exists() for u in pages):
+            return body, f'"{fingerprint}"'
+
+    started = time.time()
+    ATLAS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    atlases = {layer: build_atlas_layer(frames, fmt, scale) for layer, frames in sorted(layers.items())}
+    body = json.dumps({"format": fmt, "scale": scale, "fingerprint": fingerprint, "atlases": atlases}, separators=(",", ":"))
+    tmp = manifest_path.with_suffix(".tmp")
+    tmp.write_text(body)
+    os.replace(tmp, manifest_path)
+    n_frames = sum(len(paths) for frames in layers.values() for paths in frames.values())
+    n_pages = sum(len(a["pages"]) for a in atlases.values())
+    print(f"[ATLAS] built {fmt}@{scale:g}: {n_frames} frames -> {n_pages} pages in {time.time() - started:.1f}s", flush=True)
+    return body, f'"{fingerprint}"'
+
+
+def _build_atlas_in_background(fmt, scale):
+    key = (fmt, scale)
+    try:
+        result = build_atlas_variant(fmt, scale)
+    except ImportError:
+        print("[ATLAS] Pillow is not installed; clients will load individual frames", flush=True)
+        result = None
+    except Exception as exc:
+        print(f"[ATLAS] build {fmt}@{scale:g} failed: {exc}", flush=True)
+        result = None
+    with atlas_lock:
+        atlas_builds.discard(key)
+        if result:
+            atlas_manifests[key] = result
+        else:
+            atlas_failed.add(key)
+
+
+def atlas_manifest(fmt, scale):
+    """Cached (json, etag) for a variant, or None while it is being built."""
+    key = (fmt, scale)
+    with atlas_lock:
+        if key in atlas_manifests:
+            return atlas_manifests[key]
+        if key in atlas_builds:
+            return None
+        atlas_builds.add(key)
+    # A real OS thread, not a green one: Pillow releases the GIL while it
+    # decodes and encodes, so the game loops keep ticking during a cold build.
+    Thread(target=_build_atlas_in_background, args=key, daemon=True).start()
+    return None
+
+
+@app.route("/atlases.json")
+def atlases():
+    """Frame maps for every animation atlas: ?format=png|webp&scale=1|0.5"""
+    fmt = request.args.get("format", "png")
+    try:
+        scale = float(request.args.get("scale", 1))
+    except ValueError:
+        scale = None
+    if fmt not in ATLAS_FORMATS or scale not in ATLAS_SCALES:
+        return {"error": "unsupported atlas variant"}, 400
+    if (fmt, scale) in atlas_failed:
+        return {"error": "atlases unavailable"}, 404
+    result = atlas_manifest(fmt, scale)
+    if result is None:
+        return {"building": True}, 503, {"Retry-After": "10"}
+    body, etag = result
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype="application/json", headers=headers)
+
+
+@app.route("/atlas/<digest>.<ext>")
+def atlas_page(digest, ext):
+    if ext not in ATLAS_FORMATS or not digest.isalnum():
+        return {"error": "unknown atlas page"}, 404
+    if not (ATLAS_CACHE_DIR / f"{digest}.{ext}").is_file():
+        return {"error": "unknown atlas page"}, 404
+    resp = send_from_directory(ATLAS_CACHE_DIR, f"{digest}.{ext}", max_age=31536000)
+    resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
+
+
+def build_atlases_cli(argv):
+    """python app.py build-atlases [--format png|webp ...] [--scale 1|0.5 ...]"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="app.py build-atlases")
+    parser.add_argument("--format", action="append", choices=ATLAS_FORMATS, help="default: all formats")
+    parser.add_argument("--scale", action="append", type=float, choices=ATLAS_SCALES, help="default: all scales")
+    args = parser.parse_args(argv)
+    for fmt in args.format or ATLAS_FORMATS:
+        for scale in args.scale or ATLAS_SCALES:
+            build_atlas_variant(fmt, scale)
+
+
+@world_event("request_map")
+@rate_limited("request_map")
+def on_request_map(data=None):
     sid = request.sid
-    socketio.emit("map_objects", map_objects, to=sid)
+    sync_collections(sid, (data or {}).get("since"), names=("map_objects",))
+
+
+@world_event("request_resync")
+@rate_limited("request_resync")
+def on_request_resync(data):
+    """Client saw a gap in a change feed's seq: resend that collection in full."""
+    name = (data or {}).get("collection")
+    if name in world.feeds:
+        emit_collection_snapshot(name, request.sid)
+
+
+def new_map_object(data, pid):
+    """A map object built from a place request, with per-kind defaults filled in."""
+    obj = {
+        "id": data.get("id") or str(uuid.uuid4()),
+        "type": data.get("type"),
+        "kind": data.get("kind"),
+        "x": float(data.get("x", 0)),
+        "y": float(data.get("y", 0)),
+        "meta": data.get("meta") or {},
+        # owner: prefer client-provided, otherwise server-assign to the creator
+        # Spiders are hostile (no owner) so they can be attacked by all players
+        "owner": None if data.get("kind") == "spider" else (data.get("owner") or pid),
+        # optional itemSlots for persistent entity items
+        "itemSlots": data.get("itemSlots") or []
+    }
+    # Normalize collision offsets so they persist even if missing
+    m = obj["meta"]
+    if m is not None:
+        if "cx" not in m: m["cx"] = 0
+        if "cy" not in m: m["cy"] = 0
+    # Initialize mine production meta
+    if obj.get("kind") == "mine":
+        normalize_mine_meta(obj.setdefault("meta", {}))
+    if obj.get("kind") == "blacksmith":
+        m = obj.setdefault("meta", {})
+        m["entity"] = True
+        # ensure legacy timer fields are not set
+        m.pop("interval", None)
+        m.pop("nextTick", None)
+        if not obj.get("itemSlots"):
+            obj["itemSlots"] = [None]
+    # If this is a building entity, ensure it has HP; other entities are invulnerable by default
+    if obj.get("meta", {}).get("entity") and (obj.get("type") == "building" or obj.get("kind") in ["town_center", "mine", "blacksmith", "spider"]):
+        if data.get("hp") is not None:
+            obj["hp"] = float(data.get("hp"))
+        else:
+            if obj.get("kind") == "town_center":
+                obj["hp"] = 500
+            elif obj.get("kind") == "mine":
+                obj["hp"] = 300
+            elif obj.get("kind") == "blacksmith":
+                obj["hp"] = 300
+            elif obj.get("kind") == "spider":
+                # Promote meta.hp to top level if present
+                obj["hp"] = float(obj.get("meta", {}).get("hp", 50))
+                obj["maxHp"] = float(obj.get("meta", {}).get("maxHp", 50))
+            else:
+                obj["hp"] = 200
+    return obj
 
 
-@socketio.on("place_map_object")
+@world_event("place_map_object")
+@rate_limited("place_map_object")
 def place_map_object(data):
     pid = require_player_id()
     if not pid:
@@ -616,21 +4363,21 @@ def place_map_object(data):
     # Server-side validation: require resources for town_center placement
     kind = data.get("kind")
     if kind == "town_center":
-        player = players.get(pid)
+        player = world.players.get(pid)
         # check red resource by default
         if not player or player.get("resources", {}).get("red", 0) < TOWN_CENTER_COST:
-            socketio.emit("server_debug", {"msg": f"Not enough red resources to build Town Center (requires {TOWN_CENTER_COST})"}, to=request.sid)
+            queue_emit("server_debug", {"msg": f"Not enough red resources to build Town Center (requires {TOWN_CENTER_COST})"}, to=request.sid)
             return
         # deduct cost from red resource
         player.setdefault("resources", {"red":0,"green":0,"blue":0})
         player["resources"]["red"] = max(0, player["resources"].get("red", 0) - TOWN_CENTER_COST)
     
     if kind == "mine":
-        player = players.get(pid)
+        player = world.players.get(pid)
         mine_cost = 3
         # check blue resource
         if not player or player.get("resources", {}).get("blue", 0) < mine_cost:
-            socketio.emit("server_debug", {"msg": f"Not enough blue resources to build Mine (requires {mine_cost})"}, to=request.sid)
+            queue_emit("server_debug", {"msg": f"Not enough blue resources to build Mine (requires {mine_cost})"}, to=request.sid)
             return
         # deduct cost from blue resource
         player.setdefault("resources", {"red":0,"green":0,"blue":0})
@@ -638,9 +4385,9 @@ def place_map_object(data):
         
         # Ensure player exists in players dict for mine production to work
         # Must include units array so client doesn't delete them for having no units
-        if pid not in players:
+        if pid not in world.players:
             print(f"[MINE_PLACE] Creating player entry for {pid[:8]} (placing mine)", flush=True)
-            players[pid] = {
+            world.players[pid] = {
                 "resources": {"red": 0, "green": 0, "blue": 0},
                 "units": [],
                 "x": 0,
@@ -649,76 +4396,75 @@ def place_map_object(data):
             }
 
     if kind == "blacksmith":
-        player = players.get(pid)
+        player = world.players.get(pid)
         smith_cost = 3
         # check red resource
         if not player or player.get("resources", {}).get("red", 0) < smith_cost:
-            socketio.emit("server_debug", {"msg": f"Not enough red resources to build Blacksmith (requires {smith_cost})"}, to=request.sid)
+            queue_emit("server_debug", {"msg": f"Not enough red resources to build Blacksmith (requires {smith_cost})"}, to=request.sid)
             return
         player.setdefault("resources", {"red":0,"green":0,"blue":0})
         player["resources"]["red"] = max(0, player["resources"].get("red", 0) - smith_cost)
 
-    with map_lock:
-        obj = {
-            "id": data.get("id") or str(uuid.uuid4()),
-            "type": data.get("type"),
-            "kind": data.get("kind"),
-            "x": float(data.get("x", 0)),
-            "y": float(data.get("y", 0)),
-            "meta": data.get("meta") or {},
-            # owner: prefer client-provided, otherwise server-assign to the creator
-            # Spiders are hostile (no owner) so they can be attacked by all players
-            "owner": None if data.get("kind") == "spider" else (data.get("owner") or pid),
-            # optional itemSlots for persistent entity items
-            "itemSlots": data.get("itemSlots") or []
-        }
+    with world.map_lock:
+        obj = new_map_object(data, pid)
         print(f"[PLACE_MAP_OBJECT] {obj['kind']} at ({obj['x']}, {obj['y']}), entity={obj['meta'].get('entity')}", flush=True)
-        # Normalize collision offsets so they persist even if missing
-        m = obj["meta"]
-        if m is not None:
-            if "cx" not in m: m["cx"] = 0
-            if "cy" not in m: m["cy"] = 0
-        # Initialize mine production meta
-        if obj.get("kind") == "mine":
-            m = obj.setdefault("meta", {})
-            m["entity"] = True  # Mark as entity so production loop processes it
-            mine_meta = m.setdefault("mine", {})
-            mine_meta.setdefault("resource", "red")
-            m.setdefault("interval", 30)
-            m.setdefault("nextTick", time.time() + int(m.get("interval", 30)))
-        if obj.get("kind") == "blacksmith":
-            m = obj.setdefault("meta", {})
-            m["entity"] = True
-            # ensure legacy timer fields are not set
-            m.pop("interval", None)
-            m.pop("nextTick", None)
-            if not obj.get("itemSlots"):
-                obj["itemSlots"] = [None]
-        # If this is a building entity, ensure it has HP; other entities are invulnerable by default
-        if obj.get("meta", {}).get("entity") and (obj.get("type") == "building" or obj.get("kind") in ["town_center", "mine", "blacksmith", "spider"]):
-            if data.get("hp") is not None:
-                obj["hp"] = float(data.get("hp"))
-            else:
-                if obj.get("kind") == "town_center":
-                    obj["hp"] = 500
-                elif obj.get("kind") == "mine":
-                    obj["hp"] = 300
-                elif obj.get("kind") == "blacksmith":
-                    obj["hp"] = 300
-                elif obj.get("kind") == "spider":
-                    # Promote meta.hp to top level if present
-                    obj["hp"] = float(obj.get("meta", {}).get("hp", 50))
-                    obj["maxHp"] = float(obj.get("meta", {}).get("maxHp", 50))
-                else:
-                    obj["hp"] = 200
-        map_objects.append(obj)
-        save_map()
-
-    # broadcast map and full state (so resources update on clients)
-    socketio.emit("map_objects", map_objects)
+        new_archetype = register_archetype(obj)
+        add_map_object(expand_map_object(obj))
+        invalidate_collision_index()
+        mark_dirty("map")
+
+    if new_archetype:
+        queue_emit("archetypes", {obj["kind"]: get_archetype(obj["kind"])})
+    # broadcast the new object and state (so resources update on clients)
+    world.map_feed.upsert(obj["id"])
     emit_state()
 
-@socketio.on("update_map_object")
+MINE_RESOURCES = ("red", "green", "blue")
+MINE_DEFAULT_INTERVAL = 30
+
+
+def normalize_mine_meta(m):
+    """Coerce a mine's production fields (from placement or a client update) to values mine_tick can use."""
+    m["entity"] = True  # Mark as entity so production loop processes it
+    if not isinstance(m.get("mine"), dict):
+        m["mine"] = {}
+    if m["mine"].get("resource") not in MINE_RESOURCES:
+        m["mine"]["resource"] = "red"
+    try:
+        m["interval"] = max(1, int(m.get("interval", MINE_DEFAULT_INTERVAL)))
+    except (TypeError, ValueError, OverflowError):
+        m["interval"] = MINE_DEFAULT_INTERVAL
+    next_tick = m.get("nextTick")
+    if type(next_tick) not in (int, float) or not math.isfinite(next_tick):
+        m["nextTick"] = time.time() + m["interval"]
+    return m
+
+
+def merge_map_update(o, meta, item_slots=None, x=None, y=None, hp=None):
+    """Apply an update request's fields to a map object (meta merges shallowly, a mine's "mine" one level deeper)."""
+    old = o.get("meta") or {}
+    o["meta"] = {**old, **meta}  # merge
+    if o.get("kind") == "mine":
+        if isinstance(old.get("mine"), dict) and isinstance(meta.get("mine"), dict):
+            o["meta"]["mine"] = {**old["mine"], **meta["mine"]}
+        normalize_mine_meta(o["meta"])
+    # update persistent itemSlots if provided
+    if item_slots is not None:
+        o["itemSlots"] = item_slots
+    if x is not None:
+        o["x"] = x
+    if y is not None:
+        o["y"] = y
+    # keep hp if provided, but only for building-type entities or town_center kind
+    if hp is not None and (o.get("type") == "building" or o.get("kind") == "town_center"):
+        try:
+            o["hp"] = float(hp)
+        except Exception:
+            pass
+
+
+@world_event("update_map_object")
+@rate_limited("update_map_object")
 def update_map_object(data):
     oid = data.get("id")
     meta = data.get("meta") or {}
@@ -738,90 +4484,261 @@ def update_map_object(data):
             new_y = float(new_y)
             collision = find_world_collision(new_x, new_y, GROUND_ITEM_COLLISION_PAD)
             if collision:
-                socketio.emit("server_debug", {"msg": "update_map_object blocked: collision"}, to=request.sid)
+                queue_emit("server_debug", {"msg": "update_map_object blocked: collision"}, to=request.sid)
                 return
         except (TypeError, ValueError):
             return
 
-    with map_lock:
-        changed = False
-        for o in map_objects:
-            if o.get("id") == oid:
-                print(f"[UPDATE_MAP_OBJECT] Found object, type={o.get('type')}, kind={o.get('kind')}, owner={o.get('owner')}", flush=True)
-                # Only the owner may change a mine's resource type
-                try:
-                    new_mine_resource = meta.get("mine", {}).get("resource")
-                    print(f"[UPDATE_MAP_OBJECT] new_mine_resource={new_mine_resource}", flush=True)
-                except Exception as e:
-                    print(f"[UPDATE_MAP_OBJECT] Exception getting new_mine_resource: {e}", flush=True)
-                    new_mine_resource = None
-                if new_mine_resource is not None and o.get("kind") == "mine":
-                    owner = o.get("owner")
-                    print(f"[UPDATE_MAP_OBJECT] Mine resource change: owner={owner}, pid={pid}", flush=True)
-                    # Allow change only if no owner (neutral) OR if player is the owner
-                    if owner and owner != pid:
-                        socketio.emit("server_debug", {"msg": "update_map_object: only the owner can change mine resource"}, to=request.sid)
-                        print(f"[UPDATE_MAP_OBJECT] Blocked: player {pid[:8]} is not owner {owner[:8]}", flush=True)
-                        break
-                o["meta"] = {**(o.get("meta") or {}), **meta}  # merge
-                print(f"[UPDATE_MAP_OBJECT] Meta after merge: {o['meta']}", flush=True)
-                # update persistent itemSlots if provided
-                if itemSlots is not None:
-                    o["itemSlots"] = itemSlots
-                # update position if provided (already validated above)
-                if new_x is not None:
-                    o["x"] = new_x
-                if new_y is not None:
-                    o["y"] = new_y
-                # keep hp if provided, but only for building-type entities or town_center kind
-                if data.get("hp") is not None and (o.get("type") == "building" or o.get("kind") == "town_center"):
-                    try:
-                        o["hp"] = float(data.get("hp"))
-                    except Exception:
-                        pass
-                changed = True
-                break
-        if changed:
-            print(f"[UPDATE_MAP_OBJECT] Saving map", flush=True)
-            save_map()
-        else:
+    with world.map_lock:
+        o = world.map_index.get(oid)
+        if o is None:
             print(f"[UPDATE_MAP_OBJECT] No object found with id={oid}", flush=True)
-
-    socketio.emit("map_objects", map_objects)
-    emit_state()
+            return
+        print(f"[UPDATE_MAP_OBJECT] Found object, type={o.get('type')}, kind={o.get('kind')}, owner={o.get('owner')}", flush=True)
+        # Only the owner may change a mine's resource type
+        try:
+            new_mine_resource = meta.get("mine", {}).get("resource")
+            print(f"[UPDATE_MAP_OBJECT] new_mine_resource={new_mine_resource}", flush=True)
+        except Exception as e:
+            print(f"[UPDATE_MAP_OBJECT] Exception getting new_mine_resource: {e}", flush=True)
+            new_mine_resource = None
+        if new_mine_resource is not None and o.get("kind") == "mine":
+            owner = o.get("owner")
+            print(f"[UPDATE_MAP_OBJECT] Mine resource change: owner={owner}, pid={pid}", flush=True)
+            # Allow change only if no owner (neutral) OR if player is the owner
+            if owner and owner != pid:
+                queue_emit("server_debug", {"msg": "update_map_object: only the owner can change mine resource"}, to=request.sid)
+                print(f"[UPDATE_MAP_OBJECT] Blocked: player {pid[:8]} is not owner {owner[:8]}", flush=True)
+                return
+        # position already validated above
+        merge_map_update(o, meta, itemSlots, new_x, new_y, data.get("hp"))
+        print(f"[UPDATE_MAP_OBJECT] Meta after merge: {o['meta']}", flush=True)
+        invalidate_collision_index()
+        mark_dirty("map")
+        world.map_feed.upsert(oid)
 
 
-@socketio.on("delete_map_object")
+@world_event("delete_map_object")
 def delete_map_object(data):
     oid = data.get("id")
 
-    with map_lock:
-        before = len(map_objects)
-        # mutate in-place to avoid any weird reference issues
-        map_objects[:] = [o for o in map_objects if o.get("id") != oid]
-        if len(map_objects) != before:
-            save_map()
+    with world.map_lock:
+        if remove_map_object(oid) is not None:
+            invalidate_collision_index()
+            mark_dirty("map")
+            world.map_feed.remove(oid)
+
+
+# ===== MAP EDIT BATCHES =====
+# "map_batch" (editor) and POST /map/batch (scripts) apply many editor
+# operations at once:
+#   {"op": "place", "kind", "type", "x", "y", "meta", ...}  fields as place_map_object
+#   {"op": "update", "id", "x"?, "y"?, "meta"?, "itemSlots"?}
+#   {"op": "delete", "id"}
+# The whole batch is validated (shape, ids, collisions) before anything is
+# applied, so one rejected op leaves the map untouched. Collision checks use
+# each object's archetype-resolved meta. An applied batch marks the map dirty
+# once (persist_tick writes it) and reaches clients as one map_objects delta.
+MAP_BATCH_MAX = 500  # ops per socket batch
+MAP_IMPORT_MAX = 50000  # ops per HTTP import
+MAP_BATCH_PAID_KINDS = ("town_center", "mine", "blacksmith")  # cost resources: placed one at a time
+# POST /map/batch is off unless MAP_IMPORT_TOKEN is set (send it as a Bearer token)
+MAP_IMPORT_TOKEN = os.environ.get("MAP_IMPORT_TOKEN", "")
+
 
-    socketio.emit("map_objects", map_objects)
+class MapBatchError(Exception):
+    """A batch was rejected; index is the offending op (-1 for the batch itself)."""
 
+    def __init__(self, index, msg):
+        super().__init__(f"op {index}: {msg}" if index >= 0 else msg)
+        self.index = index
 
-@socketio.on("delete_ground_item")
+
+def _batch_point(op, index, required=True):
+    if not required and op.get("x") is None and op.get("y") is None:
+        return None
+    try:
+        x, y = float(op["x"]), float(op["y"])
+    except (KeyError, TypeError, ValueError):
+        raise MapBatchError(index, "x and y must be numbers")
+    if not (math.isfinite(x) and math.isfinite(y)):
+        raise MapBatchError(index, "x and y must be finite")
+    return x, y
+
+
+def _placed_meta(op):
+    """Meta a placed object will end up with: its kind's archetype plus the op's fields."""
+    return expand_map_object({"kind": op.get("kind"), "type": op.get("type"), "meta": dict(op.get("meta") or {})})["meta"]
+
+
+def plan_map_batch(ops, pid, limit):
+    """Validate every op against the current map; returns [(op name, index, op, target)]."""
+    if not isinstance(ops, list) or not ops:
+        raise MapBatchError(-1, "ops must be a non-empty list")
+    if len(ops) > limit:
+        raise MapBatchError(-1, f"at most {limit} ops per batch")
+    plan = []
+    placed = {}  # id -> meta of objects placed by this batch
+    deleted = set()
+    gone = set()  # deleted or moved in this batch: their old boxes no longer block
+    # colliding objects placed or moved by this batch; latest[id] is the live
+    # entry, older ones (moved again, deleted) no longer block
+    staged = CollisionIndex()
+    staged.rebuild(())
+    latest = {}
+    for i, op in enumerate(ops):
+        if not isinstance(op, dict):
+            raise MapBatchError(i, "op must be an object")
+        name = op.get("op")
+        oid = op.get("id")
+        if name == "place":
+            if not op.get("kind"):
+                raise MapBatchError(i, "kind is required")
+            if op.get("kind") in MAP_BATCH_PAID_KINDS:
+                raise MapBatchError(i, f"{op['kind']} costs resources; use place_map_object")
+            if oid is not None and (oid in world.map_index or oid in placed):
+                raise MapBatchError(i, f"id {oid} already exists")
+            if op.get("meta") is not None and not isinstance(op.get("meta"), dict):
+                raise MapBatchError(i, "meta must be an object")
+            point = _batch_point(op, i)
+            meta = _placed_meta(op)
+            target = None
+            op = {**op, "id": oid or str(uuid.uuid4())}
+            oid = op["id"]
+        elif name in ("update", "delete"):
+            target = world.map_index.get(oid)
+            if oid in deleted or (target is None and oid not in placed):
+                raise MapBatchError(i, f"unknown id {oid}")
+            if name == "delete":
+                deleted.add(oid)
+                gone.add(oid)
+                latest.pop(oid, None)
+                plan.append((name, i, op, target))
+                continue
+            if op.get("meta") is not None and not isinstance(op.get("meta"), dict):
+                raise MapBatchError(i, "meta must be an object")
+            new_resource = ((op.get("meta") or {}).get("mine") or {}).get("resource")
+            if (new_resource is not None and target is not None and target.get("kind") == "mine"
+                    and target.get("owner") and target.get("owner") != pid):
+                raise MapBatchError(i, "only the owner can change a mine's resource")
+            point = _batch_point(op, i, required=False)
+            meta = {**(placed[oid] if target is None else target.get("meta") or {}), **(op.get("meta") or {})}
+            if target is None:
+                placed[oid] = meta
+            if point is not None:
+                gone.add(oid)
+        else:
+            raise MapBatchError(i, f"unknown op {name!r}")
+        if point is not None and meta.get("collides"):
+            x, y = point
+            # gone holds oid itself when it moves; a new id is not on the map yet
+            hit = find_world_collision(x, y, ignore=gone)
+            if hit is not None:
+                raise MapBatchError(i, f"blocked by {hit.get('kind') or 'building'} {hit.get('id', '')}".rstrip())
+            if first_collision((c for c in staged.candidates(x, y) if latest.get(c["id"]) is c), x, y, ignore=(oid,)):
+                raise MapBatchError(i, "blocked by an object placed earlier in this batch")
+            entry = {"id": oid, "x": x, "y": y, "meta": meta}
+            staged.add(entry)
+            latest[oid] = entry
+        elif point is not None:
+            latest.pop(oid, None)
+        if name == "place":
+            placed[oid] = meta
+        plan.append((name, i, op, target))
+    return plan
+
+
+def apply_map_batch(ops, pid, limit=MAP_BATCH_MAX):
+    """Validate, then apply a batch of map edits with one persistence mark and one feed delta."""
+    archetypes = {}
+    counts = {"placed": [], "updated": 0, "deleted": 0}
+    with world.map_lock:
+        plan = plan_map_batch(ops, pid, limit)
+        for name, _, op, _ in plan:
+            if name == "place":
+                obj = new_map_object(op, pid)
+                if register_archetype(obj):
+                    archetypes[obj["kind"]] = get_archetype(obj["kind"])
+                add_map_object(expand_map_object(obj))
+                world.map_feed.upsert(obj["id"])
+                counts["placed"].append(obj["id"])
+            elif name == "update":
+                point = _batch_point(op, -1, required=False)
+                merge_map_update(world.map_index[op["id"]], op.get("meta") or {}, op.get("itemSlots"),
+                                 *(point or (None, None)), op.get("hp"))
+                world.map_feed.upsert(op["id"])
+                counts["updated"] += 1
+            elif remove_map_object(op["id"]) is not None:
+                world.map_feed.remove(op["id"])
+                counts["deleted"] += 1
+        invalidate_collision_index()
+        mark_dirty("map")
+    if archetypes:
+        queue_emit("archetypes", archetypes)
+    print(f"[MAP_BATCH] {len(plan)} ops: {len(counts['placed'])} placed, {counts['updated']} updated, "
+          f"{counts['deleted']} deleted", flush=True)
+    return counts
+
+
+@world_event("map_batch")
+@rate_limited("map_batch")
+def map_batch(data):
+    """Editor batch; the ack carries {"ok", placed ids, counts} or the rejection."""
+    pid = require_player_id()
+    if not pid:
+        return {"ok": False, "error": "login required"}
+    try:
+        return {"ok": True, **apply_map_batch((data or {}).get("ops"), pid)}
+    except MapBatchError as exc:
+        print(f"[MAP_BATCH] rejected for player={pid}: {exc}", flush=True)
+        return {"ok": False, "error": str(exc), "index": exc.index}
+
+
+@world_event("request_terrain")
+@rate_limited("request_terrain")
+def request_terrain(data=None):
+    with world.terrain_lock:
+        queue_emit("terrain", world.terrain.manifest(), to=request.sid)
+
+
+@world_event("paint_terrain")
+@rate_limited("paint_terrain")
+def paint_terrain(data):
+    """Brush a size x size block of terrain cells centred on (x, y); tile None erases."""
+    if not require_player_id():
+        return
+    tile = data.get("tile") or ""
+    if tile and tile not in tile_names():
+        queue_emit("server_debug", {"msg": f"paint_terrain: unknown tile {tile!r}"}, to=request.sid)
+        return
+    try:
+        size = max(1, min(TERRAIN_MAX_BRUSH, int(data.get("size", 1))))
+        gx = math.floor(float(data.get("x", 0)) / TERRAIN_CELL) - (size - 1) // 2
+        gy = math.floor(float(data.get("y", 0)) / TERRAIN_CELL) - (size - 1) // 2
+    except (TypeError, ValueError, OverflowError):
+        return
+    with world.terrain_lock:
+        tid = world.terrain.tile_id(tile)
+        if not world.terrain.paint(gx, gy, size, size, tid):
+            return
+        world.dirty_collections.add("terrain")
+    queue_emit("terrain_patch", {"gx": gx, "gy": gy, "w": size, "h": size, "id": tid, "tile": tile})
+
+
+@world_event("delete_ground_item")
 def delete_ground_item(data):
     gid = data.get("id")
     if not gid:
         return
 
-    global ground_items
-    with ground_lock:
-        before = len(ground_items)
-        ground_items[:] = [g for g in ground_items if g.get("id") != gid]
-        if len(ground_items) != before:
-            save_ground()
-
-    socketio.emit("ground_items", ground_items)
+    with world.ground_lock:
+        if remove_ground_item(gid) is not None:
+            mark_dirty("ground")
+            world.ground_feed.remove(gid)
 
 
-@socketio.on("move_ground_item")
+@world_event("move_ground_item")
+@rate_limited("move_ground_item")
 def move_ground_item(data):
     pid = require_player_id()
     if not pid:
@@ -840,24 +4757,21 @@ def move_ground_item(data):
     except (TypeError, ValueError):
         return
 
-    gi = next((g for g in ground_items if g.get("id") == ground_item_id), None)
-    if gi is None:
-        return
-
     if find_world_collision(x, y, GROUND_ITEM_COLLISION_PAD):
-        socketio.emit("server_debug", {"msg": "move_ground_item blocked: collision"}, to=request.sid)
+        queue_emit("server_debug", {"msg": "move_ground_item blocked: collision"}, to=request.sid)
         return
 
-    gi["x"] = x
-    gi["y"] = y
-
-    with ground_lock:
-        save_ground()
-
-    socketio.emit("ground_items", ground_items)
+    with world.ground_lock:
+        gi = world.ground_index.get(ground_item_id)
+        if gi is None:
+            return
+        gi["x"] = x
+        gi["y"] = y
+        mark_dirty("ground")
+        world.ground_feed.patch(ground_item_id, ("x", "y"))
 
 
-@socketio.on("entity_drop_item")
+@world_event("entity_drop_item")
 def entity_drop_item(data):
     """Drop an item from an entity slot onto the ground at world coords."""
     pid = require_player_id()
@@ -872,103 +4786,69 @@ def entity_drop_item(data):
     if entity_id is None or entity_slot_index is None or x is None or y is None:
         return
 
-    try:
-        x = float(x)
-        y = float(y)
-        entity_slot_index = int(entity_slot_index)
-    except (TypeError, ValueError):
-        return
-
-    if find_world_collision(x, y, GROUND_ITEM_COLLISION_PAD):
-        socketio.emit("server_debug", {"msg": "entity_drop_item blocked: collision"}, to=request.sid)
-        return
-
-    # Find the entity
-    entity = next((o for o in map_objects if o.get("id") == entity_id), None)
-    if entity is None:
-        return
-
-    slots = entity.get("itemSlots") or []
-    if not (0 <= entity_slot_index < len(slots)):
-        return
-
-    item = slots[entity_slot_index]
-    if not item:
-        return
-
-    # Remove from slot
-    slots[entity_slot_index] = None
-    entity["itemSlots"] = slots
-
-    # Create ground item or map item depending on whether it has an itemTile
-    stats_snapshot = normalize_item_stats(item)
-    item_tile = stats_snapshot.get("itemTile")
-
-    if item_tile:
-        # Create a map object item
-        map_item = {
-            "id": str(uuid.uuid4()),
-            "type": "tile",
-            "kind": "item",
-            "x": x,
-            "y": y,
-            "meta": {
-                "entity": True,
-                "title": stats_snapshot["name"],
-                "bio": "An item that can be picked up",
-                "actions": [],
-                "collides": False,
-                "w": 64,
-                "h": 64,
-                "itemTile": item_tile,
-                "itemStats": stats_snapshot
-            }
-        }
-        map_objects.append(map_item)
-        save_map()
-        socketio.emit("map_objects", map_objects)
-    else:
-        # Create a ground item
-        gi = {
-            "id": str(uuid.uuid4()),
-            "name": stats_snapshot["name"],
-            "bonus": stats_snapshot["bonus"],
-            "attack": stats_snapshot["attack"],
-            "defense": stats_snapshot["defense"],
-            "x": x,
-            "y": y,
-            "itemStats": stats_snapshot
-        }
-        ground_items.append(gi)
-        socketio.emit("ground_items", ground_items)
-        with ground_lock:
-            save_ground()
+    run_inventory_move(
+        "entity_drop_item", pid,
+        {"kind": "entity", "id": entity_id, "slot": entity_slot_index},
+        {"kind": "world", "x": x, "y": y},
+        collision_pad=GROUND_ITEM_COLLISION_PAD
+    )
 
 
 @socketio.on("connect")
 def on_connect():
     sid = request.sid
-    ensure_mine_loop_started()
-    ensure_npc_loop_started()
-    socketio.emit("login_required", {}, to=sid)
+    ensure_scheduler_started()
+    with outbox_lock:
+        if len(outboxes) >= CONNECTION_HARD_LIMIT:
+            print(f"[ADMISSION] refused connection {sid}: {len(outboxes)} sockets", flush=True)
+            raise ConnectionRefusedError("Server is full")
+        outboxes[sid] = ClientOutbox(sid)
+    queue_emit("login_required", {}, to=sid)
 
 
-@socketio.on("login")
+@world_event("login")
+@rate_limited("login")
 def on_login(data):
     sid = request.sid
-    ensure_mine_loop_started()
-    ensure_npc_loop_started()
+    ensure_scheduler_started()
     username = str((data or {}).get("username", "")).strip()
     if not username:
-        socketio.emit("login_error", {"msg": "Username required"}, to=sid)
+        queue_emit("login_error", {"msg": "Username required"}, to=sid)
         return
     username = username[:32]
+    if not admit_login(sid, username, data):
+        return
+    complete_login(sid, username, data)
 
-    sid_to_player[sid] = username
-    player_to_sid[username] = sid
 
-    if username not in players:
-        players[username] = {
+def join_world(sid, world_id):
+    """Move a socket into the world it asked for (the first world if unknown)."""
+    w = worlds.get(world_id) or worlds[DEFAULT_WORLD]
+    with outbox_lock:
+        box = outboxes.get(sid)
+        previous = box.world if box is not None else None
+        if box is not None:
+            box.world = w
+    if previous is not None and previous is not w:
+        pid = previous.sid_to_player.pop(sid, None)
+        if pid:
+            previous.player_to_sid.pop(pid, None)
+        leave_room(previous.room, sid=sid)
+    join_room(w.room, sid=sid)
+    return w
+
+
+def complete_login(sid, username, data):
+    with join_world(sid, (data or {}).get("world")).bound():
+        enter_world(sid, username, data)
+
+
+def enter_world(sid, username, data):
+    world.sid_to_player[sid] = username
+    world.player_to_sid[username] = sid
+
+    if username not in world.players:
+        world.players[username] = {
             "x": 0,
             "y": 0,
             "color": random_color(),
@@ -983,10 +4863,10 @@ def on_login(data):
             }],
             "resources": {"red": 0, "green": 0, "blue": 0}
         }
-        apply_unit_stats(players[username]["units"][0], owner_sid=username, broadcast_hp=False)
+        apply_unit_stats(world.players[username]["units"][0], owner_sid=username, broadcast_hp=False)
     else:
         # ensure legacy records have required fields
-        p = players[username]
+        p = world.players[username]
         p.setdefault("resources", {"red": 0, "green": 0, "blue": 0})
         p.setdefault("units", [])
         if not p["units"]:
@@ -1001,69 +4881,60 @@ def on_login(data):
             })
             apply_unit_stats(p["units"][0], owner_sid=username, broadcast_hp=False)
 
-    if not trees:
-        generate_trees(100)
-
-    if not resources:
-        cols = 69
-        rows = 53
-        spacing = 180
-        colOffset = cols // 2
-        rowOffset = rows // 2
-        nextId = 0
-        for r in range(rows):
-            for c in range(cols):
-                if random.random() < 0.6:
-                    types = ["red", "green", "blue"]
-                    t = random.choice(types)
-                    cc = c - colOffset
-                    rr = r - rowOffset
-                    resources.append({
-                        "id": nextId,
-                        "x": float((cc - rr) * spacing),
-                        "y": float((cc + rr) * spacing / 2),
-                        "type": t
-                    })
-                    nextId += 1
-        with resources_lock:
-            save_resources()
-
-    socketio.emit("login_success", {"playerId": username}, to=sid)
-    emit_state(to_sid=sid)
-    emit_trees(sid)
-    socketio.emit("map_objects", map_objects, to=sid)
-    emit_state()
+    codec = negotiate_codec(sid, (data or {}).get("codecs"))
+    queue_emit("login_success", {"playerId": username, "codec": codec}, to=sid)
+    queue_emit("archetypes", archetype_table(), to=sid)
+    with world.terrain_lock:
+        queue_emit("terrain", world.terrain.manifest(), to=sid)
+    since = (data or {}).get("since")
+    if since:
+        # reconnect: only what changed since the client's last version;
+        # NPC motion is not in the feed log, so schedule all of it
+        emit_state(to_sid=sid)
+        sync_collections(sid, since)
+        seed_motion(sid)
+    else:
+        emit_state(to_sid=sid, full=True)
+    emit_state(skip_sid=sid)
 
 
 
-@socketio.on("disconnect")
+@world_event("disconnect")
 def on_disconnect():
     sid = request.sid
-    pid = sid_to_player.pop(sid, None)
+    pid = world.sid_to_player.pop(sid, None)
+    sid_codecs.pop(sid, None)
+    forget_rate_limits(sid)
+    if admission_queue.pop(sid, None):
+        notify_queue_positions()
+    with outbox_lock:
+        outboxes.pop(sid, None)
     if pid:
-        player_to_sid.pop(pid, None)
+        world.player_to_sid.pop(pid, None)
     emit_state()
 
 
-@socketio.on("update")
+@world_event("update")
+@rate_limited("update")
 def on_update(data):
     pid = current_player_id()
-    if pid and pid in players:
-        players[pid]["x"] = data.get("x", players[pid]["x"])
-        players[pid]["y"] = data.get("y", players[pid]["y"])
+    if pid and pid in world.players:
+        world.players[pid]["x"] = data.get("x", world.players[pid]["x"])
+        world.players[pid]["y"] = data.get("y", world.players[pid]["y"])
     emit_state()
 
-@socketio.on("spawn_unit")
+@world_event("spawn_unit")
 def spawn_unit(data):
+    """The ack carries the server-assigned unit id ({"id"}) for the client to adopt."""
     pid = require_player_id()
-    if not pid or pid not in players:
+    if not pid or pid not in world.players:
         return
 
     unit = data.get("unit", {})
 
     new_unit = {
-        # ✅ keep client id if provided
-        "id": unit.get("id") or str(uuid.uuid4()),
+        # always server-assigned: a client-chosen id could alias another unit
+        "id": str(uuid.uuid4()),
         "x": unit.get("x", 0),
         "y": unit.get("y", 0),
         "tx": unit.get("tx", unit.get("x", 0)),
@@ -1076,11 +4947,12 @@ def spawn_unit(data):
 
     apply_unit_stats(new_unit, owner_sid=pid, broadcast_hp=False)
 
-    players[pid]["units"].append(new_unit)
-    socketio.emit("update_units", {"sid": pid, "units": players[pid]["units"]})
+    world.players[pid]["units"].append(new_unit)
+    queue_emit("update_units", {"sid": pid, "units": world.players[pid]["units"]})
+    return {"id": new_unit["id"]}
 
 
-@socketio.on("spawn_unit_from_entity")
+@world_event("spawn_unit_from_entity")
 def spawn_unit_from_entity(data):
     pid = require_player_id()
     if not pid:
@@ -1090,8 +4962,8 @@ def spawn_unit_from_entity(data):
         return
 
     # find entity
-    with map_lock:
-        ent = next((m for m in map_objects if m.get("id") == entity_id), None)
+    with world.map_lock:
+        ent = find_map_object(entity_id)
         if not ent:
             return
 
@@ -1104,16 +4976,16 @@ def spawn_unit_from_entity(data):
         owner = ent.get("owner")
         if owner != pid:
             print(f"[spawn_unit_from_entity] unauthorized: player={pid} owner={owner} entity={entity_id}", flush=True)
-            socketio.emit("server_debug", {"msg": "spawn_unit_from_entity: you do not own that town center"}, to=request.sid)
+            queue_emit("server_debug", {"msg": "spawn_unit_from_entity: you do not own that town center"}, to=request.sid)
             return
 
         # Check resource cost: each unit costs 1 green resource
-        p = players.get(pid)
+        p = world.players.get(pid)
         if not p:
             return
         p.setdefault("resources", {"red":0, "green":0, "blue":0})
         if p["resources"].get("green", 0) < 1:
-            socketio.emit("server_debug", {"msg": "Not enough green resources to spawn a unit (cost: 1 green)"}, to=request.sid)
+            queue_emit("server_debug", {"msg": "Not enough green resources to spawn a unit (cost: 1 green)"}, to=request.sid)
             return
 
         # spawn position: offset from entity
@@ -1121,7 +4993,7 @@ def spawn_unit_from_entity(data):
         ey = float(ent.get("y", 0))
 
     # Create unit for requesting player
-    p = players.get(pid)
+    p = world.players.get(pid)
     if not p:
         return
 
@@ -1129,24 +5001,24 @@ def spawn_unit_from_entity(data):
     POP_LIMIT = 10
     # count town centers owned by this owner (should be >=1)
     owned_centers = 0
-    with map_lock:
-        for o in map_objects:
+    with world.map_lock:
+        for o in world.map_objects:
             if o.get("kind") == "town_center" and o.get("owner") == pid:
                 owned_centers += 1
 
     cap = max(POP_LIMIT, POP_LIMIT * owned_centers)
     # count only alive units
     owner_units_count = 0
-    for uu in players.get(pid, {}).get("units", []):
+    for uu in world.players.get(pid, {}).get("units", []):
         if (uu.get("hp") or 0) > 0:
             owner_units_count += 1
 
     print(f"[spawn_unit_from_entity] owner={pid} owned_centers={owned_centers} alive_units={owner_units_count} cap={cap}", flush=True)
-    socketio.emit("server_debug", {"msg": f"spawn attempt: owned_centers={owned_centers} alive_units={owner_units_count} cap={cap}"}, to=request.sid)
+    queue_emit("server_debug", {"msg": f"spawn attempt: owned_centers={owned_centers} alive_units={owner_units_count} cap={cap}"}, to=request.sid)
 
     if owner_units_count >= cap:
         print(f"[spawn_unit_from_entity] owner {pid} unit count {owner_units_count} >= cap {cap}", flush=True)
-        socketio.emit("server_debug", {"msg": f"spawn_unit_from_entity: population cap reached ({owner_units_count}/{cap})"}, to=request.sid)
+        queue_emit("server_debug", {"msg": f"spawn_unit_from_entity: population cap reached ({owner_units_count}/{cap})"}, to=request.sid)
         return
 
     # generate spawn offset to avoid stacking
@@ -1177,166 +5049,54 @@ def spawn_unit_from_entity(data):
     p.setdefault("units", []).append(new_unit)
 
     # notify owner and all clients
-    socketio.emit("update_units", {"sid": pid, "units": p["units"]})
+    queue_emit("update_units", {"sid": pid, "units": p["units"]})
     emit_state()
 
 
-@socketio.on("drop_item")
-def on_drop_item(data):
-    global ground_items
-    pid = require_player_id()
-    if not pid:
-        return
-    unit_id = data.get("unitId")
-    slot_index = data.get("slotIndex")
-    x = data.get("x")
-    y = data.get("y")
-
-    if unit_id is None or slot_index is None or x is None or y is None:
-        return
-
-    u = find_unit(pid, unit_id)
-    if not u:
-        return
-
-    slots = u.get("itemSlots") or [None, None, None, None, None]
-    if not (0 <= int(slot_index) < len(slots)):
-        return
-
-    slot_index = int(slot_index)
-    item = slots[slot_index]
-    if not item:
-        return
-
-    try:
-        x = float(x)
-        y = float(y)
-    except (TypeError, ValueError):
-        return
-
-    if find_world_collision(x, y, GROUND_ITEM_COLLISION_PAD):
-        socketio.emit("server_debug", {"msg": "drop_item blocked: collision"}, to=request.sid)
-        return
-
-    # remove item from unit
-    slots[slot_index] = None
-    u["itemSlots"] = slots
-
-    # Recompute stats after unequip
-    apply_unit_stats(u, owner_sid=pid, broadcast_hp=True)
-
-    stats_snapshot = normalize_item_stats(item)
-    item_tile = stats_snapshot.get("itemTile")
-
-    if item_tile:
-        map_item = {
-            "id": str(uuid.uuid4()),
-            "type": "tile",
-            "kind": "item",
-            "x": x,
-            "y": y,
-            "meta": {
-                "entity": True,
-                "title": stats_snapshot["name"],
-                "bio": "An item that can be picked up",
-                "actions": [],
-                "collides": False,
-                "w": 64,
-                "h": 64,
-                "itemTile": item_tile,
-                "itemStats": stats_snapshot
-            }
-        }
-        map_objects.append(map_item)
-        save_map()
-        socketio.emit("map_objects", map_objects)
-    else:
-        gi = {
-            "id": str(uuid.uuid4()),
-            "name": stats_snapshot["name"],
-            "bonus": stats_snapshot["bonus"],
-            "attack": stats_snapshot["attack"],
-            "defense": stats_snapshot["defense"],
-            "x": x,
-            "y": y,
-            "itemStats": stats_snapshot
-        }
-        ground_items.append(gi)
-        socketio.emit("ground_items", ground_items)
-        with ground_lock:
-            save_ground()
-
-    # only the owner needs equipment UI refresh
-    socketio.emit("unit_slots_update", {"unitId": unit_id, "itemSlots": slots}, to=request.sid)
-
-
-@socketio.on("pickup_item")
-def on_pickup_item(data):
+@world_event("drop_item")
+def on_drop_item(data):
     pid = require_player_id()
     if not pid:
         return
-
     unit_id = data.get("unitId")
     slot_index = data.get("slotIndex")
-    ground_id = data.get("groundItemId")
-
-    if unit_id is None or slot_index is None or ground_id is None:
-        return
+    x = data.get("x")
+    y = data.get("y")
 
-    u = find_unit(pid, unit_id)
-    if not u:
+    if unit_id is None or slot_index is None or x is None or y is None:
         return
 
-    slots = u.get("itemSlots") or [None, None, None, None, None]
-    slot_index = int(slot_index)
-
-    if slot_index < 0 or slot_index >= len(slots):
-        return
+    run_inventory_move(
+        "drop_item", pid,
+        {"kind": "unit", "id": unit_id, "slot": slot_index},
+        {"kind": "world", "x": x, "y": y},
+        collision_pad=GROUND_ITEM_COLLISION_PAD
+    )
 
-    # slot must be empty
-    if slots[slot_index] is not None:
-        return
 
-    # find ground item
-    gi_index = next((i for i, g in enumerate(ground_items) if g.get("id") == ground_id), None)
-    if gi_index is None:
+@world_event("pickup_item")
+def on_pickup_item(data):
+    pid = require_player_id()
+    if not pid:
         return
 
-    gi = ground_items[gi_index]
+    unit_id = data.get("unitId")
+    slot_index = data.get("slotIndex")
+    ground_id = data.get("groundItemId")
 
-    # distance check (server authoritative)
-    if dist_xy(u["x"], u["y"], gi["x"], gi["y"]) > PICKUP_DISTANCE:
+    if unit_id is None or slot_index is None or ground_id is None:
         return
 
-    # ✅ remove from ground IN-PLACE (no reassignment issues)
-    ground_items.pop(gi_index)
-
-    # persist ground items
-    with ground_lock:
-        save_ground()
-
-    # equip
-    slots[slot_index] = slot_payload_from_source(gi)
-    u["itemSlots"] = slots
-
-    # Recompute stats after equip
-    apply_unit_stats(u, owner_sid=pid, broadcast_hp=True)
+    # distance check is server authoritative
+    run_inventory_move(
+        "pickup_item", pid,
+        {"kind": "ground", "id": ground_id},
+        {"kind": "unit", "id": unit_id, "slot": slot_index},
+        max_distance=PICKUP_DISTANCE
+    )
 
-    # ✅ broadcast new ground list to everyone
-    socketio.emit("ground_items", ground_items)
 
-    # ✅ owner gets equipment refresh
-    socketio.emit("unit_slots_update", {"unitId": unit_id, "itemSlots": slots}, to=request.sid)
-
-    # persist ground items
-    with ground_lock:
-        save_ground()
-
-    # ✅ optional but recommended: hard-sync state so late-joiners / state-only clients match
-    emit_state()
-
-
-@socketio.on("pickup_map_item")
+@world_event("pickup_map_item")
 def on_pickup_map_item(data):
     pid = require_player_id()
     if not pid:
@@ -1349,42 +5109,15 @@ def on_pickup_map_item(data):
     if unit_id is None or slot_index is None or map_item_id is None:
         return
 
-    u = find_unit(pid, unit_id)
-    if not u:
-        return
-
-    slots = u.get("itemSlots") or [None, None, None, None, None]
-    slot_index = int(slot_index)
-    if slot_index < 0 or slot_index >= len(slots):
-        return
-    if slots[slot_index] is not None:
-        return
-
-    obj_index = next((i for i, o in enumerate(map_objects) if o.get("id") == map_item_id), None)
-    if obj_index is None:
-        return
-
-    obj = map_objects[obj_index]
-    if obj.get("kind") != "item":
-        return
-
-    if dist_xy(u["x"], u["y"], obj.get("x", 0), obj.get("y", 0)) > PICKUP_DISTANCE:
-        return
-
-    map_objects.pop(obj_index)
-    save_map()
-    socketio.emit("map_objects", map_objects)
-
-    slots[slot_index] = slot_payload_from_source(obj)
-    u["itemSlots"] = slots
-
-    apply_unit_stats(u, owner_sid=pid, broadcast_hp=True)
-
-    socketio.emit("unit_slots_update", {"unitId": unit_id, "itemSlots": slots}, to=request.sid)
-    emit_state()
+    run_inventory_move(
+        "pickup_map_item", pid,
+        {"kind": "map_item", "id": map_item_id},
+        {"kind": "unit", "id": unit_id, "slot": slot_index},
+        max_distance=PICKUP_DISTANCE
+    )
 
 
-@socketio.on("collect_resource")
+@world_event("collect_resource")
 def on_collect_resource(data):
     pid = require_player_id()
     if not pid:
@@ -1398,7 +5131,7 @@ def on_collect_resource(data):
 
     resource_id = data.get("resourceId")
 
-    p = players.get(pid)
+    p = world.players.get(pid)
     if not p:
         return
 
@@ -1413,19 +5146,19 @@ def on_collect_resource(data):
 
     # remove resource from authoritative list if present
     removed = False
-    with resources_lock:
-        idx = next((i for i, rr in enumerate(resources) if rr.get("id") == resource_id), None)
-        if idx is not None:
-            # pop the resource and persist
-            resources.pop(idx)
-            save_resources()
+    with world.resources_lock:
+        rr = world.resource_index.pop(resource_id, None)
+        if rr is not None:
+            # remove the resource and persist
+            world.resources.remove(rr)
+            mark_dirty("resources")
             removed = True
 
     if removed:
         # credit player
         p["resources"][rtype] = p["resources"].get(rtype, 0) + amount
-        # broadcast updated resources and state to all clients
-        socketio.emit("resources", resources)
+        # broadcast the harvested resource and state to all clients
+        world.resources_feed.remove(resource_id)
         emit_state()
     else:
         # resource not found; still send state to keep client in sync
@@ -1433,7 +5166,8 @@ def on_collect_resource(data):
 
 
 
-@socketio.on("attack_unit")
+@world_event("attack_unit")
+@rate_limited("attack_unit")
 def handle_attack_unit(data):
     target_sid = data.get("targetSid")
     target_id  = data.get("unitId")
@@ -1446,7 +5180,7 @@ def handle_attack_unit(data):
     if attacker_id:
         attacker = find_unit(attacker_owner, attacker_id)
         if attacker:
-            stats = compute_unit_stats(attacker)
+            stats = get_unit_stats(attacker, attacker_owner)
             damage = stats["dps"] / TICKS_PER_SECOND
 
     if damage is None:
@@ -1455,32 +5189,34 @@ def handle_attack_unit(data):
         except (TypeError, ValueError):
             return
 
-    if not target_sid or target_sid not in players:
+    if not target_sid or target_sid not in world.players:
         return
 
-    units = players[target_sid].get("units", [])
+    units = world.players[target_sid].get("units", [])
     target = next((u for u in units if u.get("id") == target_id), None)
     if not target:
         return
 
     target["hp"] = max(0, float(target.get("hp", 100)) - damage)
 
-    socketio.emit("unit_hp_update", {
+    queue_emit("unit_hp_update", {
         "sid": target_sid,
         "unitId": target["id"],
         "hp": target["hp"]
     })
 
     if target["hp"] <= 0:
-        players[target_sid]["units"] = [u for u in units if u.get("hp", 0) > 0]
-        socketio.emit("update_units", {
+        forget_unit_stats(target_sid, target["id"])
+        world.players[target_sid]["units"] = [u for u in units if u.get("hp", 0) > 0]
+        queue_emit("update_units", {
             "sid": target_sid,
-            "units": players[target_sid]["units"]
+            "units": world.players[target_sid]["units"]
         })
         emit_state()
 
 
-@socketio.on("attack_entity")
+@world_event("attack_entity")
+@rate_limited("attack_entity")
 def handle_attack_entity(data):
     # data: { entityId, damage }
     entity_id = data.get("entityId")
@@ -1491,7 +5227,7 @@ def handle_attack_entity(data):
     if attacker_id:
         attacker = find_unit(attacker_owner, attacker_id)
         if attacker:
-            stats = compute_unit_stats(attacker)
+            stats = get_unit_stats(attacker, attacker_owner)
             damage = stats["dps"] / TICKS_PER_SECOND
 
     if damage is None:
@@ -1503,8 +5239,8 @@ def handle_attack_entity(data):
     if not entity_id:
         return
 
-    with map_lock:
-        ent = next((m for m in map_objects if m.get("id") == entity_id), None)
+    with world.map_lock:
+        ent = find_map_object(entity_id)
         if not ent:
             return
         # only entities with meta.entity may be attacked
@@ -1518,32 +5254,41 @@ def handle_attack_entity(data):
         ent["hp"] = max(0, float(ent.get("hp", 0)) - damage)
 
         # broadcast HP update for entity
-        socketio.emit("entity_hp_update", {"entityId": entity_id, "hp": ent["hp"]})
+        queue_emit("entity_hp_update", {"entityId": entity_id, "hp": ent["hp"]})
 
         # if destroyed, remove from map_objects
         if ent["hp"] <= 0:
-            map_objects[:] = [o for o in map_objects if o.get("id") != entity_id]
-            save_map()
-            socketio.emit("map_objects", map_objects)
+            remove_map_object(entity_id)
+            invalidate_collision_index()
+            mark_dirty("map")
+            world.map_feed.remove(entity_id)
             emit_state()
         else:
-            # persist change
-            save_map()
-
-
-@socketio.on("request_state")
-def on_request_state():
-    emit_state(to_sid=request.sid)
+            # journaled with the next group commit, like any other row change
+            world.map_feed.patch(entity_id, ("hp",))
+            mark_dirty("map")
+
+
+@world_event("request_state")
+@rate_limited("request_state")
+def on_request_state(data=None):
+    since = (data or {}).get("since")
+    if since:
+        emit_state(to_sid=request.sid)
+        sync_collections(request.sid, since)
+    else:
+        emit_state(to_sid=request.sid, full=True)
 
 
-@socketio.on("update_units")
+@world_event("update_units")
+@rate_limited("update_units")
 def on_update_units(data):
     pid = require_player_id()
     if not pid:
         return
     incoming = data.get("units", []) or []
 
-    p = players.get(pid)
+    p = world.players.get(pid)
     if not p:
         return
 
@@ -1577,329 +5322,193 @@ def on_update_units(data):
         p["x"] = float(units[0].get("x", p.get("x", 0)))
         p["y"] = float(units[0].get("y", p.get("y", 0)))
 
-    socketio.emit("update_units", {"sid": pid, "units": units})
+    emit_hot("update_units", {"sid": pid, "units": units})
 
 
 
 
-@socketio.on("place_building")
+@world_event("place_building")
 def place_building(data):
     pid = require_player_id()
     if not pid:
         return
-    buildings.append({"x": data["x"], "y": data["y"], "owner": pid})
+    world.buildings.append({"x": data["x"], "y": data["y"], "owner": pid})
     emit_state()
 
 
-@socketio.on("unit_give_to_entity")
+@world_event("unit_give_to_entity")
 def handle_unit_give_to_entity(data):
     pid = require_player_id()
     if not pid:
         return
     print(f"[unit_give_to_entity] called by player={pid} data={data}", flush=True)
     unit_id = data.get("unitId")
-    unit_slot_index = int(data.get("unitSlotIndex", -1))
+    unit_slot_index = _slot_index(data.get("unitSlotIndex", -1))
     entity_id = data.get("entityId")
-    entity_slot_index = int(data.get("entitySlotIndex", -1))
+    entity_slot_index = _slot_index(data.get("entitySlotIndex", -1))
 
     if not unit_id or unit_slot_index < 0 or not entity_id or entity_slot_index < 0:
         print(f"[unit_give_to_entity] invalid args: unit_id={unit_id} unit_slot_index={unit_slot_index} entity_id={entity_id} entity_slot_index={entity_slot_index}", flush=True)
-        socketio.emit("server_debug", {"msg": "unit_give_to_entity: invalid args"}, to=request.sid)
-        return
-
-    u = find_unit(pid, unit_id)
-    if not u:
-        print(f"[unit_give_to_entity] unit not found for player={pid} unit_id={unit_id}", flush=True)
-        socketio.emit("server_debug", {"msg": "unit_give_to_entity: unit not owned by you"}, to=request.sid)
+        queue_emit("server_debug", {"msg": "unit_give_to_entity: invalid args"}, to=request.sid)
         return
 
-    slots = u.get("itemSlots") or [None, None, None, None, None]
-    if unit_slot_index >= len(slots):
-        print(f"[unit_give_to_entity] unit_slot_index out of range: {unit_slot_index} >= {len(slots)}", flush=True)
-        socketio.emit("server_debug", {"msg": "unit_give_to_entity: slot index out of range"}, to=request.sid)
-        return
-    item = slots[unit_slot_index]
-    if not item:
-        print(f"[unit_give_to_entity] no item in unit slot {unit_slot_index}", flush=True)
-        socketio.emit("server_debug", {"msg": "unit_give_to_entity: no item in that slot"}, to=request.sid)
+    if run_inventory_move(
+        "unit_give_to_entity", pid,
+        {"kind": "unit", "id": unit_id, "slot": unit_slot_index},
+        {"kind": "entity", "id": entity_id, "slot": entity_slot_index}
+    ) is None:
         return
 
-    # find entity
-    with map_lock:
-        ent = next((m for m in map_objects if m.get("id") == entity_id), None)
-        if not ent:
-            print(f"[unit_give_to_entity] entity not found: {entity_id}", flush=True)
-            socketio.emit("server_debug", {"msg": "unit_give_to_entity: entity not found"}, to=request.sid)
-            return
-        eslots = ent.get("itemSlots") or []
-        # expand if needed
-        if entity_slot_index >= len(eslots):
-            eslots += [None] * (entity_slot_index + 1 - len(eslots))
-        if eslots[entity_slot_index] is not None:
-            print(f"[unit_give_to_entity] entity slot occupied: {entity_slot_index}", flush=True)
-            socketio.emit("server_debug", {"msg": "unit_give_to_entity: entity slot already occupied"}, to=request.sid)
-            return
-        # transfer
-        eslots[entity_slot_index] = item
-        ent["itemSlots"] = eslots
-        # remove from unit
-        slots[unit_slot_index] = None
-        u["itemSlots"] = slots
-        save_map()
-
     print(f"[unit_give_to_entity] transfer success: unit {unit_id} slot {unit_slot_index} -> entity {entity_id} slot {entity_slot_index}", flush=True)
-    socketio.emit("server_debug", {"msg": "unit_give_to_entity: transfer success"}, to=request.sid)
+    queue_emit("server_debug", {"msg": "unit_give_to_entity: transfer success"}, to=request.sid)
 
-    # notify clients
-    socketio.emit("map_objects", map_objects)
-    socketio.emit("unit_slots_update", {"unitId": unit_id, "itemSlots": slots}, to=request.sid)
 
-
-@socketio.on("ground_give_to_entity")
+@world_event("ground_give_to_entity")
 def handle_ground_give_to_entity(data):
     pid = require_player_id()
     if not pid:
         return
     print(f"[ground_give_to_entity] called by player={pid} data={data}", flush=True)
     entity_id = data.get("entityId")
-    try:
-        entity_slot_index = int(data.get("entitySlotIndex", -1))
-    except Exception:
-        entity_slot_index = -1
+    entity_slot_index = _slot_index(data.get("entitySlotIndex", -1))
     ground_id = data.get("groundItemId")
 
     if not entity_id or entity_slot_index < 0 or not ground_id:
         print(f"[ground_give_to_entity] invalid args: entity_id={entity_id} slot={entity_slot_index} ground_id={ground_id}", flush=True)
-        socketio.emit("server_debug", {"msg": "ground_give_to_entity: invalid args"}, to=request.sid)
+        queue_emit("server_debug", {"msg": "ground_give_to_entity: invalid args"}, to=request.sid)
         return
 
-    # find ground item
-    gi_index = next((i for i, g in enumerate(ground_items) if g.get("id") == ground_id), None)
-    if gi_index is None:
-        print(f"[ground_give_to_entity] ground item not found: {ground_id}", flush=True)
-        socketio.emit("server_debug", {"msg": "ground_give_to_entity: ground item not found"}, to=request.sid)
+    # transfer ground item into entity slot, preserving stats + tile metadata
+    if run_inventory_move(
+        "ground_give_to_entity", pid,
+        {"kind": "ground", "id": ground_id},
+        {"kind": "entity", "id": entity_id, "slot": entity_slot_index}
+    ) is None:
         return
 
-    gi = ground_items[gi_index]
-
-    # find entity and transfer
-    with map_lock:
-        ent = next((m for m in map_objects if m.get("id") == entity_id), None)
-        if not ent:
-            print(f"[ground_give_to_entity] entity not found: {entity_id}", flush=True)
-            socketio.emit("server_debug", {"msg": "ground_give_to_entity: entity not found"}, to=request.sid)
-            return
-
-        eslots = ent.get("itemSlots") or []
-        if entity_slot_index >= len(eslots):
-            eslots += [None] * (entity_slot_index + 1 - len(eslots))
-        if eslots[entity_slot_index] is not None:
-            print(f"[ground_give_to_entity] entity slot occupied: {entity_slot_index}", flush=True)
-            socketio.emit("server_debug", {"msg": "ground_give_to_entity: entity slot occupied"}, to=request.sid)
-            return
-
-        # transfer ground item into entity slot, preserving stats + tile metadata
-        eslots[entity_slot_index] = slot_payload_from_source(gi)
-        ent["itemSlots"] = eslots
-
-    # remove ground item
-    ground_items.pop(gi_index)
-
-    # persist changes
-    with ground_lock:
-        save_ground()
-    with map_lock:
-        save_map()
-
     print(f"[ground_give_to_entity] success: ground {ground_id} -> entity {entity_id} slot {entity_slot_index}", flush=True)
-    socketio.emit("server_debug", {"msg": "ground_give_to_entity: transfer success"}, to=request.sid)
+    queue_emit("server_debug", {"msg": "ground_give_to_entity: transfer success"}, to=request.sid)
 
-    # notify clients
-    socketio.emit("ground_items", ground_items)
 
-
-@socketio.on("map_item_give_to_entity")
+@world_event("map_item_give_to_entity")
 def handle_map_item_give_to_entity(data):
     pid = require_player_id()
     if not pid:
         return
 
     entity_id = data.get("entityId")
-    try:
-        entity_slot_index = int(data.get("entitySlotIndex", -1))
-    except Exception:
-        entity_slot_index = -1
+    entity_slot_index = _slot_index(data.get("entitySlotIndex", -1))
     map_item_id = data.get("mapObjectItemId")
 
     if not entity_id or entity_slot_index < 0 or not map_item_id:
         print(f"[map_item_give_to_entity] invalid args: entity_id={entity_id} slot={entity_slot_index} map_item_id={map_item_id}", flush=True)
-        socketio.emit("server_debug", {"msg": "map_item_give_to_entity: invalid args"}, to=request.sid)
+        queue_emit("server_debug", {"msg": "map_item_give_to_entity: invalid args"}, to=request.sid)
         return
 
-    with map_lock:
-        ent = next((m for m in map_objects if m.get("id") == entity_id), None)
-        if not ent:
-            print(f"[map_item_give_to_entity] entity not found: {entity_id}", flush=True)
-            socketio.emit("server_debug", {"msg": "map_item_give_to_entity: entity not found"}, to=request.sid)
-            return
-
-        eslots = ent.get("itemSlots") or []
-        if entity_slot_index >= len(eslots):
-            eslots += [None] * (entity_slot_index + 1 - len(eslots))
-        if eslots[entity_slot_index] is not None:
-            print(f"[map_item_give_to_entity] entity slot occupied: {entity_slot_index}", flush=True)
-            socketio.emit("server_debug", {"msg": "map_item_give_to_entity: entity slot occupied"}, to=request.sid)
-            return
-
-        item_index = next((i for i, obj in enumerate(map_objects) if obj.get("id") == map_item_id), None)
-        if item_index is None:
-            print(f"[map_item_give_to_entity] map item not found: {map_item_id}", flush=True)
-            socketio.emit("server_debug", {"msg": "map_item_give_to_entity: map item not found"}, to=request.sid)
-            return
-
-        map_item = map_objects[item_index]
-        if map_item.get("kind") != "item":
-            print(f"[map_item_give_to_entity] object is not an item: {map_item_id}", flush=True)
-            socketio.emit("server_debug", {"msg": "map_item_give_to_entity: object is not an item"}, to=request.sid)
-            return
-
-        eslots[entity_slot_index] = slot_payload_from_source(map_item)
-        ent["itemSlots"] = eslots
-
-        map_objects.pop(item_index)
-        save_map()
+    if run_inventory_move(
+        "map_item_give_to_entity", pid,
+        {"kind": "map_item", "id": map_item_id},
+        {"kind": "entity", "id": entity_id, "slot": entity_slot_index}
+    ) is None:
+        return
 
     print(f"[map_item_give_to_entity] success: map_item {map_item_id} -> entity {entity_id} slot {entity_slot_index}", flush=True)
-    socketio.emit("server_debug", {"msg": "map_item_give_to_entity: transfer success"}, to=request.sid)
-    socketio.emit("map_objects", map_objects)
+    queue_emit("server_debug", {"msg": "map_item_give_to_entity: transfer success"}, to=request.sid)
 
 
-@socketio.on("smith_upgrade_item")
+@world_event("smith_upgrade_item")
 def handle_smith_upgrade_item(data):
     pid = require_player_id()
     if not pid:
         return
     entity_id = data.get("entityId")
-    try:
-        slot_index = int(data.get("slotIndex", 0))
-    except Exception:
-        slot_index = 0
+    slot_index = _slot_index(data.get("slotIndex", 0), 0)
 
     cost_blue = 3
 
-    p = players.get(pid)
+    def fail(msg):
+        queue_emit("smith_upgrade_result", {"entityId": entity_id, "success": False, "error": msg}, to=request.sid)
+        queue_emit("server_debug", {"msg": msg}, to=request.sid)
+
+    p = world.players.get(pid)
     if not p:
-        socketio.emit("smith_upgrade_result", {"entityId": entity_id, "success": False, "error": "Player not found"}, to=request.sid)
-        socketio.emit("server_debug", {"msg": "Player not found for smith upgrade"}, to=request.sid)
+        fail("Player not found")
         return
     if p.get("resources", {}).get("blue", 0) < cost_blue:
-        socketio.emit("smith_upgrade_result", {"entityId": entity_id, "success": False, "error": "Not enough blue (3)"}, to=request.sid)
-        socketio.emit("server_debug", {"msg": "Not enough blue resources to upgrade item (requires 3)"}, to=request.sid)
+        fail("Not enough blue (3)")
         return
 
-    with map_lock:
-        ent = next((m for m in map_objects if m.get("id") == entity_id), None)
-        if not ent:
-            socketio.emit("smith_upgrade_result", {"entityId": entity_id, "success": False, "error": "Blacksmith not found"}, to=request.sid)
-            socketio.emit("server_debug", {"msg": "Blacksmith not found"}, to=request.sid)
-            return
-        if ent.get("kind") != "blacksmith":
-            socketio.emit("smith_upgrade_result", {"entityId": entity_id, "success": False, "error": "Upgrade allowed only on blacksmith"}, to=request.sid)
-            socketio.emit("server_debug", {"msg": "Upgrade allowed only on blacksmith"}, to=request.sid)
-            return
-        if ent.get("owner") and ent.get("owner") != pid:
-            socketio.emit("smith_upgrade_result", {"entityId": entity_id, "success": False, "error": "Only the owner can use this blacksmith"}, to=request.sid)
-            socketio.emit("server_debug", {"msg": "Only the owner can use this blacksmith"}, to=request.sid)
-            return
+    ent = find_map_object(entity_id)
+    if not ent:
+        fail("Blacksmith not found")
+        return
+    if ent.get("kind") != "blacksmith":
+        fail("Upgrade allowed only on blacksmith")
+        return
+    if ent.get("owner") and ent.get("owner") != pid:
+        fail("Only the owner can use this blacksmith")
+        return
 
-        slots = ent.get("itemSlots") or []
-        # guarantee at least one slot so upgrades always have a target
-        if len(slots) == 0:
-            slots = [None]
-        if slot_index < 0 or slot_index >= len(slots):
-            socketio.emit("smith_upgrade_result", {"entityId": entity_id, "success": False, "error": "Blacksmith slot unavailable"}, to=request.sid)
-            socketio.emit("server_debug", {"msg": "Blacksmith slot unavailable"}, to=request.sid)
-            return
-        item = slots[slot_index]
-        if not item:
-            socketio.emit("smith_upgrade_result", {"entityId": entity_id, "success": False, "error": "Place an item into the blacksmith slot first"}, to=request.sid)
-            socketio.emit("server_debug", {"msg": "Place an item into the blacksmith slot first"}, to=request.sid)
-            return
+    # guarantee at least one slot so upgrades always have a target
+    slots = ent.get("itemSlots") or [None]
+    if slot_index < 0 or slot_index >= len(slots):
+        fail("Blacksmith slot unavailable")
+        return
+    item = slots[slot_index]
+    if not item:
+        fail("Place an item into the blacksmith slot first")
+        return
+
+    # normalize legacy items that may be plain strings
+    if isinstance(item, dict):
+        item = dict(item)
+    elif isinstance(item, str):
+        item = {"id": str(uuid.uuid4()), "name": item}
+    else:
+        item = {"id": str(uuid.uuid4()), "name": str(item)}
 
-        # normalize legacy items that may be plain strings
-        if isinstance(item, str):
-            item = {"id": str(uuid.uuid4()), "name": item}
-        elif not isinstance(item, dict):
-            item = {"id": str(uuid.uuid4()), "name": str(item)}
+    # Apply upgrade
+    item["bonus"] = max(0, _safe_int(item.get("bonus", 0), 0)) + 1
+    try:
+        changes = inventory_set_slot(pid, {"kind": "entity", "id": entity_id, "slot": slot_index}, item)
+    except InventoryError as exc:
+        fail(str(exc))
+        return
 
-        # Deduct cost
-        p.setdefault("resources", {"red": 0, "green": 0, "blue": 0})
-        p["resources"]["blue"] = max(0, p["resources"].get("blue", 0) - cost_blue)
+    # Deduct cost
+    p.setdefault("resources", {"red": 0, "green": 0, "blue": 0})
+    p["resources"]["blue"] = max(0, p["resources"].get("blue", 0) - cost_blue)
+    new_bonus = item["bonus"]
 
-        # Apply upgrade
-        try:
-            current_bonus = int(item.get("bonus", 0))
-        except Exception:
-            current_bonus = 0
-        current_bonus = max(0, current_bonus)
-        item["bonus"] = current_bonus + 1
-        slots[slot_index] = item
-        ent["itemSlots"] = slots
-        save_map()
-        new_bonus = item.get("bonus", 0)
-
-    # broadcast updated map and state (for resource counts)
-    socketio.emit("map_objects", map_objects)
+    emit_inventory_changes(pid, changes)
+    # full state for resource counts
     emit_state()
-    socketio.emit("server_debug", {"msg": f"Upgraded item to bonus +{new_bonus}"}, to=request.sid)
-    socketio.emit("smith_upgrade_result", {"entityId": entity_id, "success": True, "bonus": new_bonus}, to=request.sid)
+    queue_emit("server_debug", {"msg": f"Upgraded item to bonus +{new_bonus}"}, to=request.sid)
+    queue_emit("smith_upgrade_result", {"entityId": entity_id, "success": True, "bonus": new_bonus}, to=request.sid)
 
 
-@socketio.on("entity_give_to_unit")
+@world_event("entity_give_to_unit")
 def handle_entity_give_to_unit(data):
     pid = require_player_id()
     if not pid:
         return
     entity_id = data.get("entityId")
-    entity_slot_index = int(data.get("entitySlotIndex", -1))
+    entity_slot_index = _slot_index(data.get("entitySlotIndex", -1))
     unit_id = data.get("unitId")
-    unit_slot_index = int(data.get("slotIndex", -1))
+    unit_slot_index = _slot_index(data.get("slotIndex", -1))
 
     if not unit_id or unit_slot_index < 0 or not entity_id or entity_slot_index < 0:
         return
 
-    p = players.get(pid)
-    if not p: return
-
-    u = find_unit(pid, unit_id)
-    if not u: return
-
-    with map_lock:
-        ent = next((m for m in map_objects if m.get("id") == entity_id), None)
-        if not ent: return
-        eslots = ent.get("itemSlots") or []
-        if entity_slot_index >= len(eslots): return
-        item = eslots[entity_slot_index]
-        if not item: return
-        # distance check
-        # NOTE: allow transfers to entities regardless of distance (no drop radius)
-        # make sure unit slot empty
-        uslots = u.get("itemSlots") or [None, None, None, None, None]
-        if unit_slot_index >= len(uslots): return
-        if uslots[unit_slot_index] is not None: return
-        # transfer
-        uslots[unit_slot_index] = slot_payload_from_source(item)
-        u["itemSlots"] = uslots
-        eslots[entity_slot_index] = None
-        ent["itemSlots"] = eslots
-        save_map()
-
-    # notify clients
-    socketio.emit("map_objects", map_objects)
-    socketio.emit("unit_slots_update", {"unitId": unit_id, "itemSlots": uslots}, to=request.sid)
-
-
-@socketio.on("entity_give_to_entity")
+    # NOTE: allow transfers to entities regardless of distance (no drop radius)
+    run_inventory_move(
+        "entity_give_to_unit", pid,
+        {"kind": "entity", "id": entity_id, "slot": entity_slot_index},
+        {"kind": "unit", "id": unit_id, "slot": unit_slot_index}
+    )
+
+
+@world_event("entity_give_to_entity")
 def handle_entity_give_to_entity(data):
     pid = require_player_id()
     if not pid:
@@ -1907,445 +5516,637 @@ def handle_entity_give_to_entity(data):
 
     src_id = data.get("fromEntityId")
     dst_id = data.get("toEntityId")
-    try:
-        src_slot = int(data.get("fromSlotIndex", -1))
-    except Exception:
-        src_slot = -1
-    try:
-        dst_slot = int(data.get("toSlotIndex", -1))
-    except Exception:
-        dst_slot = -1
+    src_slot = _slot_index(data.get("fromSlotIndex", -1))
+    dst_slot = _slot_index(data.get("toSlotIndex", -1))
 
     if not src_id or not dst_id or src_slot < 0 or dst_slot < 0:
-        socketio.emit("server_debug", {"msg": "entity_give_to_entity: invalid args"}, to=request.sid)
+        queue_emit("server_debug", {"msg": "entity_give_to_entity: invalid args"}, to=request.sid)
         return
 
-    with map_lock:
-        src = next((m for m in map_objects if m.get("id") == src_id), None)
-        dst = next((m for m in map_objects if m.get("id") == dst_id), None)
-        if not src or not dst:
-            socketio.emit("server_debug", {"msg": "entity_give_to_entity: entity not found"}, to=request.sid)
-            return
-
-        src_slots = src.get("itemSlots") or []
-        if src_slot >= len(src_slots):
-            socketio.emit("server_debug", {"msg": "entity_give_to_entity: source slot out of range"}, to=request.sid)
-            return
-        item = src_slots[src_slot]
-        if not item:
-            socketio.emit("server_debug", {"msg": "entity_give_to_entity: no item in source slot"}, to=request.sid)
-            return
-
-        dst_slots = dst.get("itemSlots") or []
-        if dst_slot >= len(dst_slots):
-            dst_slots += [None] * (dst_slot + 1 - len(dst_slots))
-        if dst_slots[dst_slot] is not None:
-            socketio.emit("server_debug", {"msg": "entity_give_to_entity: destination slot occupied"}, to=request.sid)
-            return
-
-        src_slots[src_slot] = None
-        dst_slots[dst_slot] = item
-        src["itemSlots"] = src_slots
-        dst["itemSlots"] = dst_slots
-        save_map()
-
-    socketio.emit("map_objects", map_objects)
+    run_inventory_move(
+        "entity_give_to_entity", pid,
+        {"kind": "entity", "id": src_id, "slot": src_slot},
+        {"kind": "entity", "id": dst_id, "slot": dst_slot}
+    )
 
 
-@socketio.on("entity_give_to_ground")
+@world_event("entity_give_to_ground")
 def handle_entity_give_to_ground(data):
     pid = require_player_id()
     if not pid:
         return
     entity_id = data.get("entityId")
-    try:
-        entity_slot_index = int(data.get("entitySlotIndex", -1))
-    except Exception:
-        entity_slot_index = -1
+    entity_slot_index = _slot_index(data.get("entitySlotIndex", -1))
     x = data.get("x")
     y = data.get("y")
 
     if not entity_id or entity_slot_index < 0 or x is None or y is None:
         print(f"[entity_give_to_ground] invalid args: entity_id={entity_id} slot={entity_slot_index} x={x} y={y}", flush=True)
-        socketio.emit("server_debug", {"msg": "entity_give_to_ground: invalid args"}, to=request.sid)
+        queue_emit("server_debug", {"msg": "entity_give_to_ground: invalid args"}, to=request.sid)
         return
 
-    created_map_item = None
-    with map_lock:
-        ent = next((m for m in map_objects if m.get("id") == entity_id), None)
-        if not ent:
-            print(f"[entity_give_to_ground] entity not found: {entity_id}", flush=True)
-            socketio.emit("server_debug", {"msg": "entity_give_to_ground: entity not found"}, to=request.sid)
-            return
-        eslots = ent.get("itemSlots") or []
-        if entity_slot_index >= len(eslots):
-            print(f"[entity_give_to_ground] slot index out of range: {entity_slot_index}", flush=True)
-            socketio.emit("server_debug", {"msg": "entity_give_to_ground: slot index out of range"}, to=request.sid)
-            return
-        item = eslots[entity_slot_index]
-        if not item:
-            print(f"[entity_give_to_ground] no item in slot {entity_slot_index}", flush=True)
-            socketio.emit("server_debug", {"msg": "entity_give_to_ground: no item in that slot"}, to=request.sid)
-            return
+    changes = run_inventory_move(
+        "entity_give_to_ground", pid,
+        {"kind": "entity", "id": entity_id, "slot": entity_slot_index},
+        {"kind": "world", "x": x, "y": y}
+    )
+    if changes is None:
+        return
 
-        # remove from entity slot
-        eslots[entity_slot_index] = None
-        ent["itemSlots"] = eslots
+    created = (changes["map"]["add"] or changes["ground"]["add"])[0]
+    print(f"[entity_give_to_ground] success: entity {entity_id} slot {entity_slot_index} -> {created['id']}", flush=True)
+    queue_emit("server_debug", {"msg": "entity_give_to_ground: transfer success"}, to=request.sid)
 
-        stats = normalize_item_stats(item, fallback_name="Item")
-        item_tile = stats.get("itemTile")
-        if item_tile:
-            created_map_item = {
-                "id": str(uuid.uuid4()),
-                "type": "tile",
-                "kind": "item",
-                "x": float(x),
-                "y": float(y),
-                "meta": {
-                    "entity": True,
-                    "title": stats["name"],
-                    "bio": "An item that can be picked up",
-                    "actions": [],
-                    "collides": False,
-                    "w": 64,
-                    "h": 64,
-                    "itemTile": item_tile,
-                    "itemStats": stats
-                }
-            }
-            map_objects.append(created_map_item)
+MINE_TICK_INTERVAL = 1.0
 
-        save_map()
 
-    if created_map_item:
-        print(f"[entity_give_to_ground] success: entity {entity_id} slot {entity_slot_index} -> map_item {created_map_item['id']}", flush=True)
-        socketio.emit("server_debug", {"msg": "entity_give_to_ground: spawned tile item"}, to=request.sid)
-        socketio.emit("map_objects", map_objects)
-        return
+def mine_tick():
+    """Advance the bound world's mine timers by one tick."""
+    now = time.time()
+    changed = False
+    world.mine_ticks += 1
+    
+    with world.map_lock:
+        mine_count = len([o for o in world.map_objects if o.get("kind") == "mine"])
+    
+    # Log every 30 ticks to avoid spam, and first run
+    if world.mine_ticks % 30 == 0 or (not world.mines_logged and mine_count > 0):
+        print(f"[MINE_LOOP] Tick {world.mine_ticks}: {len(world.map_objects)} total objects, {mine_count} mines", flush=True)
+        world.mines_logged = True
+    
+    with world.map_lock:
+        for o in world.map_objects:
+            if o.get("kind") == "mine":
+                # placement and updates normalize mines; this also repairs
+                # rows stored before they did
+                m = normalize_mine_meta(o.setdefault("meta", {}))
+                interval = m["interval"]
+                next_tick = m["nextTick"]
+                time_until = next_tick - now
+                
+                # Log every tick for debugging
+                if world.mine_ticks <= 5 or (world.mine_ticks % 10 == 0 and time_until < 5):
+                    print(f"[MINE_LOOP] Tick {world.mine_ticks} Mine {o.get('id')}: time_until={time_until:.1f}s", flush=True)
+                
+                if now >= next_tick:
+                    owner = o.get("owner")
+                    rtype = m["mine"]["resource"]
+                    # Determine if a worker unit is present on the field tile next to the mine
+                    worker_present = False
+                    if owner and owner in world.players:
+                        units = world.players.get(owner, {}).get("units", [])
+                        # Find the field for this mine (should be at mine_x + 140, mine_y)
+                        # But directly check if there's a field object in mapObjects
+                        field_object = None
+                        for obj_test in world.map_objects:
+                            if (obj_test.get("kind") == "field" and 
+                                abs(obj_test.get("x", 0) - (o.get("x", 0) + 140)) < 10 and 
+                                abs(obj_test.get("y", 0) - o.get("y", 0)) < 10):
+                                field_object = obj_test
+                                break
+                        
+                        if field_object:
+                            field_cx = field_object.get("x", 0)
+                            field_cy = field_object.get("y", 0)
+                        else:
+                            # Fallback: use expected field position if not found
+                            field_cx = o.get("x", 0) + 140
+                            field_cy = o.get("y", 0)
+                        
+                        field_w = 256
+                        field_h = 256
+                        for u in units:
+                            ux = float(u.get("x", 0))
+                            uy = float(u.get("y", 0))
+                            # Check if unit is within field bounds (not just rough radius)
+                            if abs(ux - field_cx) < field_w / 2 and abs(uy - field_cy) < field_h / 2:
+                                worker_present = True
+                                print(f"[MINE_PRODUCE] Worker found at ({ux:.0f}, {uy:.0f}) on field at ({field_cx:.0f}, {field_cy:.0f})", flush=True)
+                                break
+                        if not worker_present:
+                            print(f"[MINE_PRODUCE] No worker on field at ({field_cx:.0f}, {field_cy:.0f}); units: {[(u.get('x'), u.get('y')) for u in units]}", flush=True)
+
+                    if worker_present:
+                        print(f"[MINE_PRODUCE] Mine {o.get('id')} TRIGGERED with worker present. owner={owner}, resource={rtype}", flush=True)
+                        # Award resource to owner
+                        if owner:
+                            # Ensure player entry exists with full shape so client keeps it
+                            if owner not in world.players:
+                                print(f"[MINE_PRODUCE] Owner {owner[:8]} not in players, creating entry", flush=True)
+                                world.players[owner] = {
+                                    "resources": {"red": 0, "green": 0, "blue": 0},
+                                    "units": [],
+                                    "x": 0,
+                                    "y": 0,
+                                    "color": "#fff",
+                                }
+                            # If entry exists but missing fields, patch them
+                            world.players[owner].setdefault("resources", {"red": 0, "green": 0, "blue": 0})
+                            world.players[owner].setdefault("units", [])
+                            world.players[owner].setdefault("x", 0)
+                            world.players[owner].setdefault("y", 0)
+                            world.players[owner].setdefault("color", "#fff")
+
+                            pr = world.players[owner]["resources"]
+                            old_val = pr.get(rtype, 0)
+                            pr[rtype] = old_val + 1
+                            print(f"[MINE_PRODUCE] Awarded +1 {rtype} to {owner[:8]}. {rtype}: {old_val} -> {pr[rtype]}", flush=True)
+                        # Schedule next tick
+                        m["nextTick"] = now + interval
+                        m["workerNeeded"] = False
+                        print(f"[MINE_PRODUCE] Next tick scheduled for {now + interval}", flush=True)
+                        changed = True
+                    else:
+                        # No worker: do not award, and do not advance nextTick so the timer remains waiting
+                        m["workerNeeded"] = True
+                        if owner:
+                            print(f"[MINE_PRODUCE] Mine {o.get('id')} requires worker; production paused", flush=True)
+                            changed = True
+        
+        if changed:
+            mark_dirty("map")
+            for o in world.map_objects:
+                if o.get("kind") == "mine":
+                    world.map_feed.patch(o.get("id"), (), ("entity", "mine", "interval", "nextTick", "workerNeeded"))
+    
+    if changed:
+        emit_state()
 
-    # create standard ground item at provided coords
-    gi = {
-        "id": str(uuid.uuid4()),
-        "name": stats.get("name"),
-        "bonus": stats.get("bonus"),
-        "attack": stats.get("attack"),
-        "defense": stats.get("defense"),
-        "x": float(x),
-        "y": float(y),
-        "itemStats": stats
-    }
-    ground_items.append(gi)
 
-    # persist
-    with ground_lock:
-        save_ground()
+# Fields the NPC loop changes; moved NPCs go out as feed patches of just these
+NPC_PATCH_KEYS = ("x", "y")
+NPC_PATCH_META_KEYS = ("targetWaypoint", "currentWaypointIndex", "anim", "dir", "chasing")
 
-    print(f"[entity_give_to_ground] success: entity {entity_id} slot {entity_slot_index} -> ground {gi['id']}", flush=True)
-    socketio.emit("server_debug", {"msg": "entity_give_to_ground: transfer success"}, to=request.sid)
 
-    # notify clients
-    socketio.emit("map_objects", map_objects)
-    socketio.emit("ground_items", ground_items)
+def npc_wire_fields(o):
+    m = o.get("meta") or {}
+    tw = m.get("targetWaypoint") or {}
+    return (o.get("x"), o.get("y"), tw.get("x"), tw.get("y"),
+            m.get("currentWaypointIndex"), m.get("anim"), m.get("dir"), m.get("chasing"))
 
-def mine_production_loop():
-    tick_count = 0
-    first_run = True
-    while True:
-        socketio.sleep(1)
-        now = time.time()
-        changed = False
-        tick_count += 1
-        
-        with map_lock:
-            mine_count = len([o for o in map_objects if o.get("kind") == "mine"])
+
+NPC_TICK_INTERVAL = 0.016  # ~60 FPS
+NPC_SPEED = 1.4  # pixels per tick (~150 pixels/sec at 60 FPS)
+SPIDER_ATTACK_RANGE = 200  # pixels
+SPIDER_RETURN_RANGE = 400  # pixels - return to waypoints if target is this far
+
+
+def check_collision(x, y, entity_id):
+    """Check if position collides with any entity."""
+    for obj in bound_world().collision_index.candidates(x, y, 20):
+        if obj.get("id") == entity_id:
+            continue  # Skip self
         
-        # Log every 30 ticks to avoid spam, and first run
-        if tick_count % 30 == 0 or (first_run and mine_count > 0):
-            print(f"[MINE_LOOP] Tick {tick_count}: {len(map_objects)} total objects, {mine_count} mines", flush=True)
-            first_run = False
+        # Get collision box dimensions
+        cx = obj.get("x", 0) + obj.get("meta", {}).get("cx", 0)
+        cy = obj.get("y", 0) + obj.get("meta", {}).get("cy", 0)
+        cw = obj.get("meta", {}).get("cw", 0)
+        ch = obj.get("meta", {}).get("ch", 0)
         
-        with map_lock:
-            for o in map_objects:
-                if o.get("kind") == "mine":
-                    m = o.get("meta", {})
-                    entity_flag = m.get("entity", False)
-                    
-                    if not entity_flag:
-                        if tick_count == 1:
-                            print(f"[MINE_LOOP] Mine {o.get('id')}: entity flag not set, normalizing and continuing", flush=True)
-                        m["entity"] = True
-                        # Backfill defaults so the mine can start ticking
-                        mine_meta = m.setdefault("mine", {})
-                        mine_meta.setdefault("resource", "red")
-                        m.setdefault("interval", 30)
-                        m.setdefault("nextTick", now + int(m.get("interval", 30)))
-                        changed = True
-                        continue
-                    
-                    interval = int(m.get("interval", 30))
-                    next_tick = float(m.get("nextTick", now + interval))
-                    time_until = next_tick - now
-                    
-                    # Log every tick for debugging
-                    if tick_count <= 5 or (tick_count % 10 == 0 and time_until < 5):
-                        print(f"[MINE_LOOP] Tick {tick_count} Mine {o.get('id')}: time_until={time_until:.1f}s", flush=True)
-                    
-                    if now >= next_tick:
-                        owner = o.get("owner")
-                        rtype = (m.get("mine", {}) or {}).get("resource", "red")
-                        # Determine if a worker unit is present on the field tile next to the mine
-                        worker_present = False
-                        if owner and owner in players:
-                            units = players.get(owner, {}).get("units", [])
-                            # Find the field for this mine (should be at mine_x + 140, mine_y)
-                            # But directly check if there's a field object in mapObjects
-                            field_object = None
-                            for obj_test in map_objects:
-                                if (obj_test.get("kind") == "field" and 
-                                    abs(obj_test.get("x", 0) - (o.get("x", 0) + 140)) < 10 and 
-                                    abs(obj_test.get("y", 0) - o.get("y", 0)) < 10):
-                                    field_object = obj_test
-                                    break
-                            
-                            if field_object:
-                                field_cx = field_object.get("x", 0)
-                                field_cy = field_object.get("y", 0)
-                            else:
-                                # Fallback: use expected field position if not found
-                                field_cx = o.get("x", 0) + 140
-                                field_cy = o.get("y", 0)
-                            
-                            field_w = 256
-                            field_h = 256
-                            for u in units:
-                                ux = float(u.get("x", 0))
-                                uy = float(u.get("y", 0))
-                                # Check if unit is within field bounds (not just rough radius)
-                                if abs(ux - field_cx) < field_w / 2 and abs(uy - field_cy) < field_h / 2:
-                                    worker_present = True
-                                    print(f"[MINE_PRODUCE] Worker found at ({ux:.0f}, {uy:.0f}) on field at ({field_cx:.0f}, {field_cy:.0f})", flush=True)
-                                    break
-                            if not worker_present:
-                                print(f"[MINE_PRODUCE] No worker on field at ({field_cx:.0f}, {field_cy:.0f}); units: {[(u.get('x'), u.get('y')) for u in units]}", flush=True)
-
-                        if worker_present:
-                            print(f"[MINE_PRODUCE] Mine {o.get('id')} TRIGGERED with worker present. owner={owner}, resource={rtype}", flush=True)
-                            # Award resource to owner
-                            if owner:
-                                # Ensure player entry exists with full shape so client keeps it
-                                if owner not in players:
-                                    print(f"[MINE_PRODUCE] Owner {owner[:8]} not in players, creating entry", flush=True)
-                                    players[owner] = {
-                                        "resources": {"red": 0, "green": 0, "blue": 0},
-                                        "units": [],
-                                        "x": 0,
-                                        "y": 0,
-                                        "color": "#fff",
-                                    }
-                                # If entry exists but missing fields, patch them
-                                players[owner].setdefault("resources", {"red": 0, "green": 0, "blue": 0})
-                                players[owner].setdefault("units", [])
-                                players[owner].setdefault("x", 0)
-                                players[owner].setdefault("y", 0)
-                                players[owner].setdefault("color", "#fff")
-
-                                pr = players[owner]["resources"]
-                                old_val = pr.get(rtype, 0)
-                                pr[rtype] = old_val + 1
-                                print(f"[MINE_PRODUCE] Awarded +1 {rtype} to {owner[:8]}. {rtype}: {old_val} -> {pr[rtype]}", flush=True)
-                            # Schedule next tick
-                            m["nextTick"] = now + interval
-                            m["workerNeeded"] = False
-                            print(f"[MINE_PRODUCE] Next tick scheduled for {now + interval}", flush=True)
-                            changed = True
-                        else:
-                            # No worker: do not award, and do not advance nextTick so the timer remains waiting
-                            m["workerNeeded"] = True
-                            if owner:
-                                print(f"[MINE_PRODUCE] Mine {o.get('id')} requires worker; production paused", flush=True)
-                                changed = True
+        # Check if position is inside collision box
+        if (abs(x - cx) < cw/2 + 20 and 
+            abs(y - cy) < ch/2 + 20):
+            return True
+    return False
+
+
+def npc_tick():
+    """Move the bound world's NPCs one step along their waypoint paths."""
+    w = bound_world()  # resolved once; this runs ~60 times a second per world
+    w.npc_ticks += 1
+    tick_count = w.npc_ticks
+    with w.map_lock:
+        changed = False
+        npc_count = 0
+        for o in w.map_objects:
+            # Support both 'npc' and 'spider' kinds
+            if o.get("kind") not in ["npc", "spider"]:
+                continue
             
-            if changed:
-                save_map()
-                print(f"[MINE_PRODUCE] Map saved, triggering emit_state", flush=True)
-        
-        if changed:
-            emit_state()
-
-def npc_movement_loop():
-    """Background task that moves NPCs along their waypoint paths."""
-    NPC_SPEED = 1.4  # pixels per tick (~150 pixels/sec at 60 FPS)
-    SPIDER_ATTACK_RANGE = 200  # pixels
-    SPIDER_RETURN_RANGE = 400  # pixels - return to waypoints if target is this far
-    tick_count = 0
-    
-    def check_collision(x, y, entity_id):
-        """Check if position collides with any entity."""
-        for obj in map_objects:
-            if obj.get("id") == entity_id:
-                continue  # Skip self
-            if not obj.get("meta", {}).get("collides"):
+            npc_count += 1
+            m = o.get("meta", {})
+            waypoints = m.get("waypoints", [])
+            if len(waypoints) == 0:
+                if tick_count % 600 == 0:  # Log every 10 seconds
+                    print(f"[NPC_LOOP] NPC {o.get('id')[:8]} has insufficient waypoints ({len(waypoints)})", flush=True)
                 continue
             
-            # Get collision box dimensions
-            cx = obj.get("x", 0) + obj.get("meta", {}).get("cx", 0)
-            cy = obj.get("y", 0) + obj.get("meta", {}).get("cy", 0)
-            cw = obj.get("meta", {}).get("cw", 0)
-            ch = obj.get("meta", {}).get("ch", 0)
+            before = npc_wire_fields(o)
+
+            # Spider AI: attack nearby players
+            is_spider = (o.get("kind") == "spider")
+            target_player = None
             
-            # Check if position is inside collision box
-            if (abs(x - cx) < cw/2 + 20 and 
-                abs(y - cy) < ch/2 + 20):
-                return True
-        return False
-    
-    while True:
-        socketio.sleep(0.016)  # ~60 FPS
-        tick_count += 1
-        
-        with map_lock:
-            changed = False
-            npc_count = 0
-            for o in map_objects:
-                # Support both 'npc' and 'spider' kinds
-                if o.get("kind") not in ["npc", "spider"]:
-                    continue
+            if is_spider:
+                # Find nearest player unit
+                nearest_dist = SPIDER_ATTACK_RANGE
+                for sid, p in w.players.items():
+                    for unit in p.get("units", []):
+                        if unit.get("hp", 0) <= 0:
+                            continue
+                        dist = math.hypot(unit["x"] - o["x"], unit["y"] - o["y"])
+                        if dist < nearest_dist:
+                            nearest_dist = dist
+                            target_player = {"sid": sid, "unit": unit, "dist": dist}
                 
-                npc_count += 1
-                m = o.get("meta", {})
-                waypoints = m.get("waypoints", [])
-                if len(waypoints) == 0:
-                    if tick_count % 600 == 0:  # Log every 10 seconds
-                        print(f"[NPC_LOOP] NPC {o.get('id')[:8]} has insufficient waypoints ({len(waypoints)})", flush=True)
-                    continue
+                # Check if current target is too far (return to waypoints)
+                if target_player and m.get("chasing"):
+                    if target_player["dist"] > SPIDER_RETURN_RANGE:
+                        target_player = None
+                        m["chasing"] = False
+            
+            # If spider has a target, chase and attack
+            if is_spider and target_player:
+                m["chasing"] = True
+                tx = target_player["unit"]["x"]
+                ty = target_player["unit"]["y"]
                 
-                # Spider AI: attack nearby players
-                is_spider = (o.get("kind") == "spider")
-                target_player = None
+                # Store target for client to use
+                m["targetWaypoint"] = {"x": tx, "y": ty}
                 
-                if is_spider:
-                    # Find nearest player unit
-                    nearest_dist = SPIDER_ATTACK_RANGE
-                    for sid, p in players.items():
-                        for unit in p.get("units", []):
-                            if unit.get("hp", 0) <= 0:
-                                continue
-                            dist = math.hypot(unit["x"] - o["x"], unit["y"] - o["y"])
-                            if dist < nearest_dist:
-                                nearest_dist = dist
-                                target_player = {"sid": sid, "unit": unit, "dist": dist}
-                    
-                    # Check if current target is too far (return to waypoints)
-                    if target_player and m.get("chasing"):
-                        if target_player["dist"] > SPIDER_RETURN_RANGE:
-                            target_player = None
-                            m["chasing"] = False
+                dx = tx - o["x"]
+                dy = ty - o["y"]
+                dist = math.hypot(dx, dy)
                 
-                # If spider has a target, chase and attack
-                if is_spider and target_player:
-                    m["chasing"] = True
-                    tx = target_player["unit"]["x"]
-                    ty = target_player["unit"]["y"]
-                    
-                    # Store target for client to use
-                    m["targetWaypoint"] = {"x": tx, "y": ty}
+                # Move towards player
+                if dist > 30:  # Stop when close enough
+                    new_x = o["x"] + (dx / dist) * NPC_SPEED
+                    new_y = o["y"] + (dy / dist) * NPC_SPEED
                     
-                    dx = tx - o["x"]
-                    dy = ty - o["y"]
-                    dist = math.hypot(dx, dy)
-                    
-                    # Move towards player
-                    if dist > 30:  # Stop when close enough
-                        new_x = o["x"] + (dx / dist) * NPC_SPEED
-                        new_y = o["y"] + (dy / dist) * NPC_SPEED
-                        
-                        if not check_collision(new_x, new_y, o.get("id")):
-                            o["x"] = new_x
-                            o["y"] = new_y
+                    if not check_collision(new_x, new_y, o.get("id")):
+                        o["x"] = new_x
+                        o["y"] = new_y
+                        changed = True
+                
+                # Update direction
+                if dist > 0.1:
+                    angle_deg = (math.degrees(math.atan2(dy, dx)) + 90) % 360
+                    directions = [0, 22, 45, 67, 90, 112, 135, 157, 180, 202, 225, 247, 270, 292, 315, 337]
+                    closest_dir = min(directions, key=lambda d: min(abs(angle_deg - d), abs(angle_deg - d + 360), abs(angle_deg - d - 360)))
+                    m["dir"] = str(closest_dir).zfill(3)
+                    m["anim"] = "walk"
+            else:
+                # Follow waypoints (default behavior for NPCs and spiders without targets)
+                m["chasing"] = False
+                current_idx = m.get("currentWaypointIndex", 0)
+                if current_idx >= len(waypoints):
+                    current_idx = 0
+                    m["currentWaypointIndex"] = current_idx
+                
+                target_wp = waypoints[current_idx]
+                tx, ty = target_wp["x"], target_wp["y"]
+                
+                # Always store target waypoint for client
+                m["targetWaypoint"] = {"x": tx, "y": ty}
+                
+                # Move server position toward target (for distance calculation)
+                dx = tx - o["x"]
+                dy = ty - o["y"]
+                dist = math.hypot(dx, dy)
+                
+                # Single waypoint NPCs should always be idle
+                if len(waypoints) == 1:
+                    m["anim"] = "idle"
+                    if dist > 5:  # If far from waypoint, move toward it
+                        move_dist = min(NPC_SPEED, dist)
+                        if dist > 0.1:
+                            o["x"] += (dx / dist) * move_dist
+                            o["y"] += (dy / dist) * move_dist
                             changed = True
-                    
-                    # Update direction
-                    if dist > 0.1:
-                        angle_deg = (math.degrees(math.atan2(dy, dx)) + 90) % 360
-                        directions = [0, 22, 45, 67, 90, 112, 135, 157, 180, 202, 225, 247, 270, 292, 315, 337]
-                        closest_dir = min(directions, key=lambda d: min(abs(angle_deg - d), abs(angle_deg - d + 360), abs(angle_deg - d - 360)))
-                        m["dir"] = str(closest_dir).zfill(3)
-                        m["anim"] = "walk"
                 else:
-                    # Follow waypoints (default behavior for NPCs and spiders without targets)
-                    m["chasing"] = False
-                    current_idx = m.get("currentWaypointIndex", 0)
-                    if current_idx >= len(waypoints):
-                        current_idx = 0
-                        m["currentWaypointIndex"] = current_idx
+                    # Multi-waypoint NPCs walk between waypoints
+                    m["anim"] = "walk"
                     
-                    target_wp = waypoints[current_idx]
-                    tx, ty = target_wp["x"], target_wp["y"]
-                    
-                    # Always store target waypoint for client
-                    m["targetWaypoint"] = {"x": tx, "y": ty}
-                    
-                    # Move server position toward target (for distance calculation)
-                    dx = tx - o["x"]
-                    dy = ty - o["y"]
-                    dist = math.hypot(dx, dy)
+                    # Move toward waypoint
+                    if dist < 20:  # Reached waypoint (increased threshold), advance to next
+                        m["currentWaypointIndex"] = (current_idx + 1) % len(waypoints)
+                        # Snap to waypoint to avoid getting stuck
+                        o["x"] = tx
+                        o["y"] = ty
+                        changed = True
+                    elif dist > 0.1:  # Only move if there's meaningful distance
+                        # Move toward current waypoint
+                        move_dist = min(NPC_SPEED, dist)
+                        o["x"] += (dx / dist) * move_dist
+                        o["y"] += (dy / dist) * move_dist
+                        changed = True
                     
-                    # Single waypoint NPCs should always be idle
-                    if len(waypoints) == 1:
-                        m["anim"] = "idle"
-                        if dist > 5:  # If far from waypoint, move toward it
-                            move_dist = min(NPC_SPEED, dist)
-                            if dist > 0.1:
-                                o["x"] += (dx / dist) * move_dist
-                                o["y"] += (dy / dist) * move_dist
-                                changed = True
-                    else:
-                        # Multi-waypoint NPCs walk between waypoints
-                        m["anim"] = "walk"
-                        
-                        # Move toward waypoint
-                        if dist < 20:  # Reached waypoint (increased threshold), advance to next
-                            m["currentWaypointIndex"] = (current_idx + 1) % len(waypoints)
-                            # Snap to waypoint to avoid getting stuck
-                            o["x"] = tx
-                            o["y"] = ty
-                            changed = True
-                        elif dist > 0.1:  # Only move if there's meaningful distance
-                            # Move toward current waypoint
-                            move_dist = min(NPC_SPEED, dist)
-                            o["x"] += (dx / dist) * move_dist
-                            o["y"] += (dy / dist) * move_dist
-                            changed = True
-                        
-                    # Update direction toward target
-                    if dist > 0.1:
-                        angle_deg = (math.degrees(math.atan2(dy, dx)) + 90) % 360
-                        directions = [0, 22, 45, 67, 90, 112, 135, 157, 180, 202, 225, 247, 270, 292, 315, 337]
-                        closest_dir = min(directions, key=lambda d: min(abs(angle_deg - d), abs(angle_deg - d + 360), abs(angle_deg - d - 360)))
-                        m["dir"] = str(closest_dir).zfill(3)
-            
-            # Log NPC count periodically
-            if tick_count % 600 == 0 and npc_count > 0:  # Every 10 seconds
-                print(f"[NPC_LOOP] Tick {tick_count}: {npc_count} NPCs active", flush=True)
-            
-            # Always broadcast NPC state periodically for new clients
-            if tick_count % 60 == 0:  # Every ~1 second
-                socketio.emit("map_objects", map_objects)
+                # Update direction toward target
+                if dist > 0.1:
+                    angle_deg = (math.degrees(math.atan2(dy, dx)) + 90) % 360
+                    directions = [0, 22, 45, 67, 90, 112, 135, 157, 180, 202, 225, 247, 270, 292, 315, 337]
+                    closest_dir = min(directions, key=lambda d: min(abs(angle_deg - d), abs(angle_deg - d + 360), abs(angle_deg - d - 360)))
+                    m["dir"] = str(closest_dir).zfill(3)
+
+            if npc_wire_fields(o) != before:
+                mark_motion(o.get("id"))
+                # Colliding NPCs carry their box with them
+                if m.get("collides"):
+                    invalidate_collision_index()
+        
+        # Log NPC count periodically
+        if tick_count % 600 == 0 and npc_count > 0:  # Every 10 seconds
+            print(f"[NPC_LOOP] Tick {tick_count}: {npc_count} NPCs active", flush=True)
+        
+        if changed:
+            # Save periodically (every 60 ticks / 1 second)
+            w.npc_moving_ticks += 1
             
-            if changed:
-                # Save periodically (every 60 ticks / 1 second)
-                if not hasattr(npc_movement_loop, '_tick_counter'):
-                    npc_movement_loop._tick_counter = 0
-                npc_movement_loop._tick_counter += 1
-                
-                if npc_movement_loop._tick_counter % 60 == 0:
-                    save_map()
-                
-                # Broadcast waypoint changes immediately
-                socketio.emit("map_objects", map_objects)
+            if w.npc_moving_ticks % 60 == 0:
+                mark_dirty("map")
+
+def generate_world_cli(argv):
+    """python app.py generate-world [--seed N] [--spiders N] [--cols N --rows N]: regenerate and persist."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="app.py generate-world")
+    parser.add_argument("--seed", type=int, default=WORLD_SEED)
+    parser.add_argument("--spiders", type=int, default=SPIDER_COUNT)
+    parser.add_argument("--cols", type=int, default=RESOURCE_GRID[0])
+    parser.add_argument("--rows", type=int, default=RESOURCE_GRID[1])
+    args = parser.parse_args(argv)
+    with world.map_lock:
+        if world.pager is not None:
+            world.pager.page_in_all()
+        for o in [o for o in world.map_objects if o.get("kind") == "spider"]:
+            remove_map_object(o["id"])
+            world.map_feed.remove(o["id"])
+        spawn_spiders(args.spiders, args.seed)
+    started = time.perf_counter()
+    with world.resources_lock:
+        for r in world.resources:
+            world.resources_feed.remove(r["id"])
+        world.resources = generate_resources(random.Random(f"{args.seed}:resources"), args.cols, args.rows, RESOURCE_GRID[2])
+        reindex_resources()
+        for r in world.resources:
+            world.resources_feed.upsert(r["id"])
+    print(f"[WORLDGEN] Generated {len(world.resources)} resources in {(time.perf_counter() - started) * 1000:.1f}ms", flush=True)
+    world.trees[:] = generate_trees(random.Random(f"{args.seed}:trees"), TREE_COUNT)
+    if world.db is not None:
+        world.db.reconcile()
+    elif world.journal is not None:
+        world.journal.compact()
+    else:
+        write_world_snapshots()
+    # a pending suspend snapshot would restore its old trees on the next
+    # boot: keep its players and timers, but give it the regenerated trees
+    if update_pending_suspend(trees=world.trees):
+        print(f"[WORLDGEN] Updated the trees in pending {world.suspend_file}", flush=True)
+
+
+def is_ground_decal(o, tiles):
+    """Tile objects that only decorate the ground: below z 0, no entity, a plain tile image."""
+    meta = o.get("meta") or {}
+    return (o.get("type") == "tile" and o.get("kind") in tiles
+            and o.get("kind") not in BUILTIN_ARCHETYPES and o.get("kind") != "field"
+            and not meta.get("entity") and float(meta.get("z") or 0) < 0)
+
+
+def terrain_import_cli(argv):
+    """python app.py terrain-import [--kinds K ...] [--dry-run]: move ground decals into the terrain layer."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="app.py terrain-import")
+    parser.add_argument("--kinds", nargs="*", default=None, help="only these tile kinds (default: every ground decal)")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+    tiles = tile_names()
+    with world.map_lock:
+        if world.pager is not None:
+            world.pager.page_in_all()
+        decals = [o for o in world.map_objects
+                  if is_ground_decal(o, tiles) and (args.kinds is None or o.get("kind") in args.kinds)]
+        # lower z first, so overlapping decals keep their stacking order
+        decals.sort(key=lambda o: float(o["meta"].get("z") or 0))
+        cells = 0
+        with world.terrain_lock:
+            for o in decals:
+                meta = o["meta"]
+                x, y = float(o.get("x", 0)), float(o.get("y", 0))
+                w, h = float(meta.get("w") or TERRAIN_CELL), float(meta.get("h") or TERRAIN_CELL)
+                # cells whose centres fall inside the decal's footprint
+                gx0 = math.ceil((x - w / 2) / TERRAIN_CELL - 0.5)
+                gx1 = math.floor((x + w / 2) / TERRAIN_CELL - 0.5)
+                gy0 = math.ceil((y - h / 2) / TERRAIN_CELL - 0.5)
+                gy1 = math.floor((y + h / 2) / TERRAIN_CELL - 0.5)
+                if gx1 < gx0 or gy1 < gy0:
+                    continue
+                cells += world.terrain.paint(gx0, gy0, gx1 - gx0 + 1, gy1 - gy0 + 1, world.terrain.tile_id(o["kind"]))
+        colliding = sum(1 for o in decals if o["meta"].get("collides"))
+        print(f"[TERRAIN] {len(decals)} ground decals -> {cells} cells "
+              f"({colliding} had collision boxes, which the terrain layer does not keep)", flush=True)
+        if args.dry_run:
+            return
+        for o in decals:
+            remove_map_object(o["id"])
+            world.map_feed.remove(o["id"])
+        invalidate_collision_index()
+    save_terrain()
+    if world.db is not None:
+        world.db.reconcile()
+    elif world.journal is not None:
+        world.journal.compact()
+    else:
+        write_world_snapshots()
+
+
+# ===== SUSPEND / RESUME =====
+# fly stops idle machines (auto_stop_machines = 'stop'). Players, buildings,
+# trees and mine timers only live in memory, so on SIGTERM/SIGINT we flush
+# the world store and write them to SUSPEND_FILE; the next boot restores
+# them before the first connection. Point SUSPEND_FILE at a mounted volume
+# for it to outlive the machine's root filesystem.
+SUSPEND_FILE = os.environ.get("SUSPEND_FILE", "suspend.json")
+SUSPEND_VERSION = 1
+
+
+def write_suspend_snapshot():
+    now = time.time()
+    mine_timers = {}
+    with world.map_lock:
+        for o in world.map_objects:
+            if o.get("kind") == "mine":
+                next_tick = (o.get("meta") or {}).get("nextTick")
+                if isinstance(next_tick, (int, float)):
+                    mine_timers[o.get("id")] = max(0.0, next_tick - now)
+    data = {
+        "version": SUSPEND_VERSION,
+        "saved_at": now,
+        "players": world.players,
+        "buildings": world.buildings,
+        "trees": world.trees,
+        # remaining seconds, so a mine resumes mid-cycle however long we slept
+        "mine_timers": mine_timers,
+    }
+    write_suspend_file(data)
+
+
+def write_suspend_file(data):
+    tmp = world.suspend_file + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, world.suspend_file)
+
+
+def read_pending_suspend():
+    """The suspend snapshot the next server boot will resume, or None."""
+    data = load_json_file(world.suspend_file, "suspend snapshot", None)
+    if not isinstance(data, dict):
+        return None
+    if data.get("version") != SUSPEND_VERSION:
+        print(f"[RESUME] Ignoring {world.suspend_file}: version {data.get('version')!r}", flush=True)
+        return None
+    return data
+
+
+def update_pending_suspend(**fields):
+    """Replace fields of a pending suspend snapshot (maintenance commands). Returns False if none."""
+    data = read_pending_suspend()
+    if data is None:
+        return False
+    data.update(fields)
+    write_suspend_file(data)
+    return True
+
+
+suspend_requested = False
+
+
+def request_suspend(signum=None, frame=None):
+    """Signal handler. It runs on the hub's thread, possibly in the middle of a
+    scheduler tick that holds world locks (plain, non-reentrant Locks), so it
+    only schedules suspend_world; that greenlet runs once the tick yields."""
+    global suspend_requested
+    if suspend_requested:
+        return
+    suspend_requested = True
+    print(f"[SUSPEND] Signal {signum} received; suspending after the current tick", flush=True)
+    socketio.start_background_task(suspend_world)
+
+
+def suspend_world():
+    """Persist everything that would otherwise be lost, then exit."""
+    started = time.perf_counter()
+    try:
+        for w in list(worlds.values()):
+            with w.bound():
+                flush_dirty()
+                if world.journal is not None:
+                    world.journal.flush()
+                if world.db is not None:
+                    world.db.flush()
+                if world.pager is not None:
+                    # rewrite every resident chunk so its frozen mine timers are current
+                    with world.map_lock:
+                        world.pager.flush(everything=True)
+                write_suspend_snapshot()
+                print(f"[SUSPEND] World {world.id} suspended to {world.suspend_file} "
+                      f"({len(world.players)} players)", flush=True)
+        print(f"[SUSPEND] {len(worlds)} world(s) suspended in {(time.perf_counter() - started) * 1000:.1f}ms", flush=True)
+    except Exception as exc:
+        print(f"[SUSPEND] Failed to suspend world: {exc}", flush=True)
+    finally:
+        os._exit(0)
+
+
+def resume_world():
+    data = read_pending_suspend()
+    if data is None:
+        return
+    world.players.update(data.get("players") or {})
+    world.buildings[:] = data.get("buildings") or []
+    world.trees[:] = data.get("trees") or []
+    now = time.time()
+    for oid, remaining in (data.get("mine_timers") or {}).items():
+        o = world.map_index.get(oid)
+        if o is not None and o.get("kind") == "mine":
+            o.setdefault("meta", {})["nextTick"] = now + remaining
+    slept = now - float(data.get("saved_at") or now)
+    # consume the snapshot: a later crash restart must not roll the world back to it
+    try:
+        os.replace(world.suspend_file, world.suspend_file + ".resumed")
+    except OSError as exc:
+        print(f"[RESUME] Failed to retire {world.suspend_file}: {exc}", flush=True)
+    print(f"[RESUME] Restored {len(world.players)} players, {len(world.buildings)} buildings, {len(world.trees)} trees "
+          f"after {slept:.0f}s suspended", flush=True)
+
+
+def import_json_cli(argv):
+    """python app.py import-json [world.db]: (re)seed the SQLite store from the JSON files."""
+    WorldDB(argv[0] if argv else world.db_path).import_json()
+
+
+def boot_world(world_id, mode="serve"):
+    """Open, load and (if new) generate one world; each phase is a startup mark.
+
+    mode "serve" is the server boot. "load" reads the world for a maintenance
+    command: no load-time persistence, no resume (a pending suspend snapshot
+    stays for the next server boot) and no generation. "bare" only registers
+    the World for commands that just need its file paths.
+    """
+    w = worlds[world_id] = World(world_id)
+    if mode == "bare":
+        return w
+    with w.bound():
+        world.db = open_world_db()
+        world.journal = open_world_journal()
+        world.snapshot = open_world_snapshot()
+        world.pager = open_world_pager()
+        startup_mark("open_store")
+        load_map()
+        load_resources()
+        startup_mark("load_resources")
+        load_ground()
+        startup_mark("load_ground")
+        load_terrain()
+        startup_mark("load_terrain")
+        if mode == "serve":
+            persist_schema_migration()
+            if world.db is not None:
+                # load-time changes (migrations, mine timers, re-compaction) do not
+                # go through the feeds; write them out once
+                world.db.reconcile()
+        if world.snapshot is not None:
+            world.snapshot.close()
+            world.snapshot = None
+        if mode != "serve":
+            return w
+        if world.journal is not None:
+            # start from fresh snapshots (journal tail and load-time fixes folded in)
+            world.journal.compact()
+        startup_mark("persist")
+        resume_world()
+        startup_mark("resume")
+        generate_missing_world()
+        startup_mark("worldgen")
+    return w
+
+
+# python app.py <command> [args]: maintenance commands, run instead of the
+# server. The world is booted in the mode each one needs (see boot_world), so
+# none of them consumes a suspend snapshot or writes load-time fixes.
+CLI_COMMANDS = {
+    "build-atlases": ("bare", build_atlases_cli),
+    "snapshot-pack": ("bare", partial(snapshot_cli, "snapshot-pack")),
+    "snapshot-unpack": ("bare", partial(snapshot_cli, "snapshot-unpack")),
+    "bench-load": ("bare", bench_load_cli),
+    "generate-world": ("load", generate_world_cli),
+    "terrain-import": ("load", terrain_import_cli),
+    "import-json": ("bare", import_json_cli),
+}
+cli_command = sys.argv[1] if __name__ == "__main__" and sys.argv[1:2] and sys.argv[1] in CLI_COMMANDS else None
+
+startup_mark("routes")
+for world_id in WORLDS:
+    boot_world(world_id, CLI_COMMANDS[cli_command][0] if cli_command else "serve")
+print(f"[STARTUP] Ready in {(time.perf_counter() - STARTUP_T0) * 1000:.0f}ms {startup_timings}", flush=True)
 
 # Run server
 if __name__ == "__main__":
-    ensure_mine_loop_started()
-    ensure_npc_loop_started()
-    socketio.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
+    if cli_command:
+        CLI_COMMANDS[cli_command][1](sys.argv[2:])
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, request_suspend)
+    signal.signal(signal.SIGINT, request_suspend)
+    ensure_scheduler_started()
+    socketio.run(app, host="0.0.0.0", port=8080)
@@ -0,0 +1,119 @@
+// ===== WIRE CODEC =====
+// Decoder for the server's packed "bin1" frames (see WIRE_CODECS in app.py).
+// Each "bin" event carries one hot event; decode() returns [eventName, payload]
+// shaped exactly like the JSON event it replaces, so existing handlers run as-is.
+// Add ?wire=json to the URL to stay on plain JSON events for debugging.
+
+(function () {
+  const COORD_SCALE = 16;
+  const ANIM_CODES = ["idle", "walk", "attack"];
+  const DIR_CODES = ["000", "022", "045", "067", "090", "112", "135", "157",
+                     "180", "202", "225", "247", "270", "292", "315", "337"];
+  const ENUM_RAW = 255;
+  const FRAME_MAP_DELTA = 1;
+  const FRAME_UNITS = 2;
+  const FRAME_MOTION = 3;
+  const utf8 = new TextDecoder();
+
+  function hex(b) { return b.toString(16).padStart(2, "0"); }
+
+  class WireReader {
+    constructor(buf) {
+      const bytes = buf instanceof Uint8Array ? buf : new Uint8Array(buf);
+      this.bytes = bytes;
+      this.view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+      this.pos = 0;
+    }
+    u8()  { const v = this.view.getUint8(this.pos); this.pos += 1; return v; }
+    u16() { const v = this.view.getUint16(this.pos, true); this.pos += 2; return v; }
+    u32() { const v = this.view.getUint32(this.pos, true); this.pos += 4; return v; }
+    f32() { const v = this.view.getFloat32(this.pos, true); this.pos += 4; return v; }
+    coord() { const v = this.view.getInt32(this.pos, true); this.pos += 4; return v / COORD_SCALE; }
+    raw(n) { const v = this.bytes.subarray(this.pos, this.pos + n); this.pos += n; return v; }
+    text() { return utf8.decode(this.raw(this.u8())); }
+    ident() {
+      const n = this.u8();
+      if (n !== 0) return utf8.decode(this.raw(n));
+      const h = Array.from(this.raw(16), hex).join("");
+      return `${h.slice(0, 8)}-${h.slice(8, 12)}-${h.slice(12, 16)}-${h.slice(16, 20)}-${h.slice(20)}`;
+    }
+    enumOf(table) {
+      const code = this.u8();
+      return code === ENUM_RAW ? this.text() : table[code];
+    }
+    jsonTail() { return JSON.parse(utf8.decode(this.raw(this.u32()))); }
+  }
+
+  function readNpcPatches(r) {
+    const count = r.u16();
+    const packed = [];
+    for (let i = 0; i < count; i++) {
+      const entry = { id: r.ident() };
+      const mask = r.u8();
+      const meta = {};
+      if (mask & 1) { entry.x = r.coord(); entry.y = r.coord(); }
+      if (mask & 2) meta.targetWaypoint = { x: r.coord(), y: r.coord() };
+      if (mask & 4) meta.currentWaypointIndex = r.u16();
+      if (mask & 8) meta.anim = r.enumOf(ANIM_CODES);
+      if (mask & 16) meta.dir = r.enumOf(DIR_CODES);
+      if (mask & 32) meta.chasing = !!(mask & 64);
+      if (mask & 62) entry.meta = meta;
+      packed.push(entry);
+    }
+    return packed;
+  }
+
+  function decodeMapDelta(r) {
+    const base = r.u32();
+    const seq = r.u32();
+    const packed = readNpcPatches(r);
+    const rest = r.jsonTail();
+    return ["map_objects_delta", {
+      base,
+      seq,
+      upsert: rest.upsert || [],
+      patch: packed.concat(rest.patch || []),
+      remove: rest.remove || [],
+    }];
+  }
+
+  function decodeUnits(r) {
+    const sid = r.text();
+    const count = r.u16();
+    const units = [];
+    for (let i = 0; i < count; i++) {
+      units.push({
+        id: r.ident(),
+        x: r.coord(), y: r.coord(),
+        tx: r.coord(), ty: r.coord(),
+        hp: r.f32(), maxHp: r.f32(),
+        anim: r.enumOf(ANIM_CODES),
+        dir: r.enumOf(DIR_CODES),
+      });
+    }
+    return ["update_units", { sid, units }];
+  }
+
+  function decodeMotion(r) {
+    return ["map_objects_motion", { patch: readNpcPatches(r) }];
+  }
+
+  const FRAME_DECODERS = {
+    [FRAME_MAP_DELTA]: decodeMapDelta,
+    [FRAME_UNITS]: decodeUnits,
+    [FRAME_MOTION]: decodeMotion,
+  };
+
+  window.WireCodec = {
+    // codecs offered at login, most preferred first
+    offered() {
+      const forced = new URLSearchParams(window.location.search).get("wire");
+      return forced === "json" ? [] : ["bin1"];
+    },
+    decode(buf) {
+      const r = new WireReader(buf);
+      const decoder = FRAME_DECODERS[r.u8()];
+      return decoder ? decoder(r) : null;
+    },
+  };
+})();
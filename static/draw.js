@@ -40,6 +40,21 @@ function drawRectDebug(x, y, w, h, color) {
   ctx.strokeRect(x - w / 2, y - h / 2, w, h);
 }
 
+// Unit sprite frames are either one Image per frame or a region of an atlas
+// page ({img, sx, sy, sw, sh, ox, oy, fw, fh}, trimmed, offsets in frame pixels)
+function drawSpriteFrame(frame, dx, dy, dw, dh) {
+  if (!frame) return;
+  if (frame instanceof HTMLImageElement) {
+    if (frame.complete) ctx.drawImage(frame, dx, dy, dw, dh);
+    return;
+  }
+  if (!frame.sw || !frame.img.complete) return;
+  const kx = dw / frame.fw;
+  const ky = dh / frame.fh;
+  ctx.drawImage(frame.img, frame.sx, frame.sy, frame.sw, frame.sh,
+                dx + frame.ox * kx, dy + frame.oy * ky, frame.sw * kx, frame.sh * ky);
+}
+
 function drawEntityTitle(obj, sx, sy) {
   if (!obj?.meta?.entity) return;
 
@@ -191,6 +206,7 @@ function draw() {
 
   // Draw background
   drawBackground();
+  Terrain.draw();
 
   // Persistent NPC animation state (keyed by NPC ID)
   if (typeof window.npcAnimState === 'undefined') {
@@ -617,12 +633,8 @@ function draw() {
     const spriteW = isSpider ? 100 : SPRITE_W;
     const spriteH = isSpider ? 100 : SPRITE_H;
     
-    if (shadowImg && shadowImg.complete) {
-      ctx.drawImage(shadowImg, sx - spriteW/2, sy - spriteH/2, spriteW, spriteH);
-    }
-    if (bodyImg && bodyImg.complete) {
-      ctx.drawImage(bodyImg, sx - spriteW/2, sy - spriteH/2, spriteW, spriteH);
-    }
+    drawSpriteFrame(shadowImg, sx - spriteW/2, sy - spriteH/2, spriteW, spriteH);
+    drawSpriteFrame(bodyImg, sx - spriteW/2, sy - spriteH/2, spriteW, spriteH);
     
     // Draw health bar for spiders
     if (isSpider) {
@@ -912,8 +924,8 @@ for (const item of unitRenderables) {
   const img = frames?.[frameIndex];
   const sh  = framesShadow?.[frameIndex];
 
-  if (sh && sh.complete) ctx.drawImage(sh, sx - SPRITE_W/2, sy - SPRITE_H/2, SPRITE_W, SPRITE_H);
-  if (img && img.complete) ctx.drawImage(img, sx - SPRITE_W/2, sy - SPRITE_H/2, SPRITE_W, SPRITE_H);
+  drawSpriteFrame(sh, sx - SPRITE_W/2, sy - SPRITE_H/2, SPRITE_W, SPRITE_H);
+  drawSpriteFrame(img, sx - SPRITE_W/2, sy - SPRITE_H/2, SPRITE_W, SPRITE_H);
 
   // NPCs show title instead of HP bar
   if (isNPC) {
@@ -87,11 +87,13 @@ async function loadTilesFromServer() {
   }
 
   try {
-    const res = await fetch("/tiles_manifest", { cache: "no-store" });
+    // revalidate with the server's ETag instead of refetching every time
+    const res = await fetch("/tiles_manifest", { cache: "no-cache" });
     if (!res.ok) throw new Error(`tiles_manifest HTTP ${res.status}`);
     const data = await res.json();
 
     const tileNames = Array.isArray(data.tiles) ? data.tiles : [];
+    const tileMeta = data.meta || {};
     if (!tileNames.includes("campfire")) tileNames.push("campfire");
 
     TILE_DEFS = {};
@@ -126,11 +128,13 @@ for (const name of tileNames) {
       else img.onload = () => applySize(img);
     });
   } else {
+    const meta = tileMeta[name] || {};
     const img = new Image();
-    img.src = `static/tiles/${name}.png`;
+    // content hash in the URL lets the browser keep the image until it changes
+    img.src = `static/tiles/${meta.file || `${name}.png`}${meta.hash ? `?v=${meta.hash}` : ""}`;
 
-    // set temporary defaults (will be replaced on load)
-    TILE_DEFS[name] = { src: img.src, w: DEFAULT_TILE_W, h: DEFAULT_TILE_H };
+    // manifest sizes are exact; defaults only until the image loads
+    TILE_DEFS[name] = { src: img.src, w: meta.w || DEFAULT_TILE_W, h: meta.h || DEFAULT_TILE_H };
     tileImages[name] = img;
 
     const applySize = () => {
@@ -271,4 +275,30 @@ if (e.shiftKey) {
     COLLISION_MIN,
     Math.min(COLLISION_MAX, editorCollisionH - delta * COLLISION_STEP)
   );
-}, { passive: false });
\ No newline at end of file
+}, { passive: false });
+// ===== MAP EDIT BATCHING =====
+// Brush placements and deletes made in quick succession are sent as one
+// "map_batch" (see apply_map_batch in app.py): the server validates the whole
+// list, applies it under one lock and persists once. Mines, town centers and
+// blacksmiths cost resources and still go through "place_map_object".
+const MAP_BATCH_DELAY_MS = 50;
+const MAP_BATCH_MAX = 500;
+let mapBatchOps = [];
+let mapBatchTimer = null;
+
+function flushMapOps() {
+  clearTimeout(mapBatchTimer);
+  mapBatchTimer = null;
+  const ops = mapBatchOps;
+  mapBatchOps = [];
+  if (!ops.length) return;
+  socket.emit("map_batch", { ops }, ack => {
+    if (ack && !ack.ok) console.warn("map batch rejected:", ack.error);
+  });
+}
+
+function queueMapOp(op) {
+  mapBatchOps.push(op);
+  if (mapBatchOps.length >= MAP_BATCH_MAX) flushMapOps();
+  else if (!mapBatchTimer) mapBatchTimer = setTimeout(flushMapOps, MAP_BATCH_DELAY_MS);
+}
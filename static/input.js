@@ -581,6 +581,13 @@ canvas.addEventListener("mousedown", e => {
   const wx = camera.x + mouse.x - canvas.width / 2;
   const wy = camera.y + mouse.y - canvas.height / 2;
 
+  // Terrain brush paints (Shift erases) grid cells instead of placing objects
+  if (e.button === 0 && Terrain.brushActive()) {
+    Terrain.startStroke(wx, wy, e.shiftKey);
+    e.preventDefault();
+    return;
+  }
+
   // ✅ Shift-delete in editor mode FIRST (highest priority)
   if (editorMode && e.button === 0 && e.shiftKey) {
     let nearest = null, best = 40, nearestType = null;
@@ -598,7 +605,7 @@ canvas.addEventListener("mousedown", e => {
       if (d < best) { best = d; nearest = t; nearestType = 'tree'; }
     }
     if (nearest) {
-      if (nearestType === 'map') socket.emit("delete_map_object", { id: nearest.id });
+      if (nearestType === 'map') queueMapOp({ op: "delete", id: nearest.id });
       else if (nearestType === 'ground') socket.emit("delete_ground_item", { id: nearest.id });
       else if (nearestType === 'tree') socket.emit("delete_tree", { x: nearest.x, y: nearest.y });
       e.preventDefault();
@@ -901,7 +908,7 @@ if (kind === 'spider') {
   extraData.maxHp = meta.maxHp;
   extraData.owner = null;  // hostile entity
 }
-socket.emit("place_map_object", { type, kind, x: placeX, y: placeY, meta, ...extraData });
+queueMapOp({ op: "place", type, kind, x: placeX, y: placeY, meta, ...extraData });
 resetCollisionOffset();
 
     return;
@@ -1907,7 +1914,10 @@ const newUnit = {
 ]
 };
 myUnits.push(newUnit);
-socket.emit("spawn_unit", { unit: newUnit });
+socket.emit("spawn_unit", { unit: newUnit }, ack => {
+  // the server assigns unit ids; adopt it so later unit events match
+  if (ack && ack.id) newUnit.id = ack.id;
+});
 
     }
 };
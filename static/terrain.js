@@ -0,0 +1,155 @@
+// ===== TERRAIN LAYER =====
+// Ground tiles painted on a grid (see TerrainLayer in app.py). The server
+// sends a manifest at login ({cell, chunk, palette, chunks: [{cx, cy, hash}]});
+// chunk bodies are fetched as content-addressed RLE blobs, so unchanged chunks
+// come from the browser cache. "terrain_patch" events paint blocks of cells.
+// In the editor, tick "Terrain brush" and drag to paint the selected tile;
+// Shift+drag erases.
+
+(function () {
+  const terrain = {
+    cell: 64, chunk: 32, palette: [""],
+    chunks: new Map(),   // "cx,cy" -> { hash, cells: Uint16Array | null }
+    pending: [],         // patches seen while chunks are still loading
+    loading: 0,
+  };
+  let stroke = null;     // { erase, last: "gx,gy" } while the brush is down
+
+  const chunkKey = (cx, cy) => `${cx},${cy}`;
+
+  function decodeRle(buf) {
+    const view = new DataView(buf);
+    const cells = new Uint16Array(terrain.chunk * terrain.chunk);
+    let pos = 0;
+    for (let i = 0; i + 4 <= view.byteLength; i += 4) {
+      const id = view.getUint16(i, true);
+      const run = view.getUint16(i + 2, true);
+      cells.fill(id, pos, pos + run);
+      pos += run;
+    }
+    return cells;
+  }
+
+  function paintCells(gx, gy, w, h, id) {
+    const n = terrain.chunk;
+    for (let y = gy; y < gy + h; y++) {
+      for (let x = gx; x < gx + w; x++) {
+        const cx = Math.floor(x / n), cy = Math.floor(y / n);
+        const key = chunkKey(cx, cy);
+        let entry = terrain.chunks.get(key);
+        if (!entry) {
+          if (id === 0) continue;
+          entry = { hash: null, cells: new Uint16Array(n * n) };
+          terrain.chunks.set(key, entry);
+        }
+        if (!entry.cells) continue; // still loading; replayed when it lands
+        entry.cells[(y - cy * n) * n + (x - cx * n)] = id;
+      }
+    }
+  }
+
+  function fetchChunk(key, entry) {
+    terrain.loading += 1;
+    fetch(`terrain/chunks/${entry.hash}.bin`)
+      .then(r => { if (!r.ok) throw new Error(`terrain chunk ${entry.hash}: ${r.status}`); return r.arrayBuffer(); })
+      .then(buf => {
+        if (terrain.chunks.get(key) !== entry) return; // superseded by a newer manifest
+        entry.cells = decodeRle(buf);
+        for (const p of terrain.pending) paintCells(p.gx, p.gy, p.w, p.h, p.id);
+      })
+      .catch(err => {
+        console.warn("terrain chunk failed", err);
+        // painted again since our manifest: ask for a fresh one
+        socket.emit("request_terrain", {});
+      })
+      .finally(() => {
+        terrain.loading -= 1;
+        if (terrain.loading === 0) terrain.pending = [];
+      });
+  }
+
+  function load(manifest) {
+    terrain.cell = manifest.cell || terrain.cell;
+    terrain.chunk = manifest.chunk || terrain.chunk;
+    terrain.palette = (manifest.palette || [""]).slice();
+    const seen = new Set();
+    for (const { cx, cy, hash } of (manifest.chunks || [])) {
+      const key = chunkKey(cx, cy);
+      seen.add(key);
+      const have = terrain.chunks.get(key);
+      if (have && have.hash === hash && have.cells) continue;
+      const entry = { hash, cells: null };
+      terrain.chunks.set(key, entry);
+      fetchChunk(key, entry);
+    }
+    for (const key of [...terrain.chunks.keys()]) {
+      if (!seen.has(key)) terrain.chunks.delete(key);
+    }
+  }
+
+  function applyPatch(p) {
+    terrain.palette[p.id] = p.tile || "";
+    if (terrain.loading) terrain.pending.push(p);
+    paintCells(p.gx, p.gy, p.w, p.h, p.id);
+  }
+
+  function draw() {
+    const size = terrain.cell, n = terrain.chunk;
+    const left = camera.x - canvas.width / 2, top = camera.y - canvas.height / 2;
+    const gx0 = Math.floor(left / size), gx1 = Math.floor((left + canvas.width) / size);
+    const gy0 = Math.floor(top / size), gy1 = Math.floor((top + canvas.height) / size);
+    for (let cy = Math.floor(gy0 / n); cy <= Math.floor(gy1 / n); cy++) {
+      for (let cx = Math.floor(gx0 / n); cx <= Math.floor(gx1 / n); cx++) {
+        const entry = terrain.chunks.get(chunkKey(cx, cy));
+        if (!entry || !entry.cells) continue;
+        const x0 = Math.max(gx0, cx * n), x1 = Math.min(gx1, cx * n + n - 1);
+        const y0 = Math.max(gy0, cy * n), y1 = Math.min(gy1, cy * n + n - 1);
+        for (let y = y0; y <= y1; y++) {
+          const row = (y - cy * n) * n - cx * n;
+          for (let x = x0; x <= x1; x++) {
+            const id = entry.cells[row + x];
+            if (!id) continue;
+            const img = tileImages[terrain.palette[id]];
+            if (!img || !img.complete || img.naturalWidth === 0) continue;
+            ctx.drawImage(img, x * size - left, y * size - top, size, size);
+          }
+        }
+      }
+    }
+  }
+
+  /* ---------- editor brush ---------- */
+  const brushToggle = document.getElementById("terrainBrush");
+  const brushSize = document.getElementById("terrainBrushSize");
+
+  function brushActive() {
+    return !!(editorMode && brushToggle && brushToggle.checked);
+  }
+
+  function paintAt(wx, wy) {
+    const cellKey = `${Math.floor(wx / terrain.cell)},${Math.floor(wy / terrain.cell)}`;
+    if (cellKey === stroke.last) return;
+    stroke.last = cellKey;
+    let tile = null;
+    if (!stroke.erase) {
+      const [type, kind] = (brushSelect.value || "").split(":");
+      if (type !== "tile" || !tileImages[kind]) return;
+      tile = kind;
+    }
+    socket.emit("paint_terrain", { x: wx, y: wy, tile, size: Number(brushSize && brushSize.value) || 1 });
+  }
+
+  function startStroke(wx, wy, erase) {
+    stroke = { erase, last: null };
+    paintAt(wx, wy);
+  }
+
+  canvas.addEventListener("mousemove", () => {
+    if (!stroke) return;
+    const w = mouseWorld();
+    paintAt(w.x, w.y);
+  });
+  window.addEventListener("mouseup", () => { stroke = null; });
+
+  window.Terrain = { load, applyPatch, draw, brushActive, startStroke };
+})();
@@ -0,0 +1,43 @@
+"""Shared fixtures.
+
+Importing app boots the default world from the working directory (and may
+write journal, worldgen and atlas files next to it), so the suite imports
+it once from a scratch copy of the repo's world files.
+"""
+import os
+import shutil
+import sys
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORLD_FILES = ("map_objects.json", "ground_items.json", "resources.json", "index.html")
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    scratch = tmp_path_factory.mktemp("world")
+    for name in WORLD_FILES:
+        shutil.copy(os.path.join(ROOT, name), scratch / name)
+    os.symlink(os.path.join(ROOT, "static"), scratch / "static")
+    os.environ.pop("WORLD_STORE", None)
+    os.chdir(scratch)
+    sys.path.insert(0, ROOT)
+    import app as module
+    return module
+
+
+# far away from anything the stock map places
+FAR = 900000.0
+
+
+@pytest.fixture
+def player(app):
+    """A logged-out player with one unit (five empty slots) at FAR, FAR."""
+    pid = f"test-{uuid.uuid4().hex[:8]}"
+    unit = {"id": str(uuid.uuid4()), "x": FAR, "y": FAR, "tx": FAR, "ty": FAR, "hp": 100, "maxHp": 100,
+            "itemSlots": [None] * 5}
+    app.world.players[pid] = {"units": [unit], "resources": {"red": 0, "green": 0, "blue": 0}}
+    yield pid, unit
+    app.world.players.pop(pid, None)
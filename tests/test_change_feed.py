@@ -0,0 +1,88 @@
+import pytest
+
+
+@pytest.fixture
+def feed(app, monkeypatch):
+    """A resources-shaped feed over a local dict (flushes are not broadcast)."""
+    monkeypatch.setattr(app, "emit_hot", lambda *args, **kwargs: None)
+    rows = {}
+    f = app.ChangeFeed("resources", rows.get)
+    f.rows = rows
+    return f
+
+
+def test_build_folds_pending_ops(feed):
+    feed.rows.update(a={"id": "a", "x": 1, "meta": {"m": 1, "n": 2}}, b={"id": "b", "x": 2})
+    feed.patch("a", ("x",))
+    feed.patch("a", (), ("m",))
+    feed.upsert("b")
+    feed.patch("b", ("x",))  # an upsert already sends everything
+    feed.patch("gone", ("x",))  # lookup fails: removed
+    delta = feed.build()
+    assert delta == {"seq": 1, "upsert": [feed.rows["b"]], "patch": [{"id": "a", "x": 1, "meta": {"m": 1}}],
+                     "remove": ["gone"]}
+    assert feed.build() is None and feed.seq == 1
+
+
+def test_since_serves_the_log_or_asks_for_a_snapshot(feed):
+    feed.log = type(feed.log)(maxlen=3)
+    feed.rows["a"] = {"id": "a"}
+    for _ in range(5):
+        feed.upsert("a")
+        feed.flush()
+    assert [d["seq"] for d in feed.log] == [3, 4, 5]
+    assert feed.since(5) == []
+    assert [d["seq"] for d in feed.since(2)] == [3, 4, 5]
+    assert [d["seq"] for d in feed.since(4)] == [5]
+    assert feed.since(1) is None  # seq 2 aged out
+    assert feed.since(6) is None  # from the future (e.g. a previous process)
+
+
+def test_sync_collections_catches_up_or_resyncs(app, monkeypatch):
+    sent = []
+    monkeypatch.setattr(app, "queue_emit", lambda event, data=None, to=None, **kw: sent.append((event, data, to)))
+    w = app.world
+    seqs = app.feed_seqs()
+    app.sync_collections("sid-1", {"epoch": w.epoch, "feeds": seqs})
+    assert sent == []  # already current
+
+    monkeypatch.setattr(app, "emit_hot", lambda *args, **kwargs: None)
+    w.resources_feed.upsert(w.resources[0]["id"])
+    w.resources_feed.flush()
+    app.sync_collections("sid-1", {"epoch": w.epoch, "feeds": seqs})
+    [(event, data, to)] = sent
+    assert (event, to, data["collection"]) == ("feed_catchup", "sid-1", "resources")
+    assert [d["seq"] for d in data["deltas"]] == [seqs["resources"] + 1]
+
+    sent.clear()
+    app.sync_collections("sid-1", {"epoch": "another-epoch", "feeds": seqs}, names=["resources"])
+    [(event, data, to)] = sent
+    assert event == "feed_snapshot" and data["seq"] == w.resources_feed.seq
+    assert len(data["items"]) == len(w.resources)
+
+
+def apply(state, delta):
+    for oid in delta["remove"]:
+        state.pop(oid, None)
+    for obj in delta["upsert"]:
+        state[obj["id"]] = dict(obj)
+    for p in delta["patch"]:
+        if p["id"] in state:
+            state[p["id"]] = {**state[p["id"]], **{k: v for k, v in p.items() if k != "meta"},
+                              "meta": {**state[p["id"]].get("meta", {}), **p.get("meta", {})}}
+
+
+def test_merged_deltas_equal_sequential_application(app):
+    base = {"a": {"id": "a", "x": 0, "meta": {"m": 0}}, "b": {"id": "b", "x": 0, "meta": {}},
+            "c": {"id": "c", "x": 0, "meta": {}}}
+    first = {"base": 0, "seq": 1, "upsert": [{"id": "d", "x": 1, "meta": {}}],
+             "patch": [{"id": "a", "x": 1, "meta": {"m": 1}}], "remove": ["b"]}
+    second = {"seq": 2, "upsert": [{"id": "b", "x": 9, "meta": {}}],
+              "patch": [{"id": "a", "meta": {"n": 2}}, {"id": "d", "x": 5, "meta": {}}], "remove": ["c"]}
+    merged = app.merge_feed_deltas(first, second)
+    assert (merged["base"], merged["seq"]) == (0, 2)
+    one, two = {k: dict(v) for k, v in base.items()}, {k: dict(v) for k, v in base.items()}
+    apply(one, first)
+    apply(one, second)
+    apply(two, merged)
+    assert one == two
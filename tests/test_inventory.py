@@ -0,0 +1,124 @@
+import copy
+import uuid
+
+import pytest
+
+from conftest import FAR
+
+
+@pytest.fixture
+def chest(app):
+    """A colliding entity with two slots (one holding a shield), east of the player's unit."""
+    obj = app.expand_map_object({
+        "id": str(uuid.uuid4()), "kind": "chest", "type": "tile", "x": FAR + 500, "y": FAR,
+        "meta": {"entity": True, "collides": True, "w": 64, "h": 64},
+        "itemSlots": [{"id": "shield-1", "name": "shield"}, None],
+    })
+    with app.world.map_lock:
+        app.add_map_object(obj)
+    app.invalidate_collision_index()
+    yield obj
+    with app.world.map_lock:
+        app.remove_map_object(obj["id"])
+    app.invalidate_collision_index()
+
+
+@pytest.fixture
+def ground_item(app):
+    gi = {"id": str(uuid.uuid4()), "name": "Axe", "attack": 3, "defense": 0, "bonus": 0, "x": FAR + 50, "y": FAR}
+    with app.world.ground_lock:
+        app.add_ground_item(gi)
+    yield gi
+    with app.world.ground_lock:
+        app.remove_ground_item(gi["id"])
+
+
+def world_state(app, unit, chest):
+    return copy.deepcopy((unit["itemSlots"], chest["itemSlots"],
+                          sorted(g["id"] for g in app.world.ground_items), len(app.world.map_objects)))
+
+
+@pytest.mark.parametrize("src, dst, error", [
+    ({"kind": "unit", "slot": 0}, {"kind": "entity", "slot": 1}, "no item in that slot"),
+    ({"kind": "unit", "slot": 9}, {"kind": "entity", "slot": 1}, "source slot out of range"),
+    ({"kind": "entity", "slot": 0}, {"kind": "unit", "slot": 7}, "slot index out of range"),
+    ({"kind": "entity", "slot": 0}, {"kind": "entity", "slot": 0}, "entity slot already occupied"),
+    ({"kind": "entity", "slot": 0}, {"kind": "entity", "slot": -1}, "slot index out of range"),
+    ({"kind": "ground", "id": "missing"}, {"kind": "unit", "slot": 0}, "ground item not found"),
+    ({"kind": "map_item", "id": "entity"}, {"kind": "unit", "slot": 0}, "object is not an item"),
+    ({"kind": "entity", "slot": 0}, {"kind": "world", "x": "here", "y": 0}, "bad drop position"),
+    ({"kind": "entity", "slot": 0}, {"kind": "world", "x": FAR + 500, "y": FAR}, "blocked: collision"),
+    ({"kind": "ground", "id": "ground"}, {"kind": "world", "x": 0, "y": 0}, "only slotted items"),
+    ({"kind": "pocket"}, {"kind": "unit", "slot": 0}, "bad source kind"),
+    ({"kind": "entity", "slot": 0}, {"kind": "moon"}, "bad destination kind"),
+])
+def test_rejected_moves_change_nothing(app, player, chest, ground_item, src, dst, error):
+    pid, unit = player
+    # refs name the fixture they point at ("id" defaults to the ref's own kind)
+    ids = {"unit": unit["id"], "entity": chest["id"], "ground": ground_item["id"]}
+    for ref in (src, dst):
+        ref["id"] = ids.get(ref.get("id", ref.get("kind")), ref.get("id"))
+    before = world_state(app, unit, chest)
+    with pytest.raises(app.InventoryError, match=error):
+        app.inventory_move(pid, src, dst, max_distance=app.PICKUP_DISTANCE, collision_pad=8)
+    assert world_state(app, unit, chest) == before
+
+
+def test_occupied_destination_is_rejected(app, player, chest):
+    pid, unit = player
+    unit["itemSlots"][2] = {"id": "sword-1", "name": "sword"}
+    before = world_state(app, unit, chest)
+    with pytest.raises(app.InventoryError, match="unit slot occupied"):
+        app.inventory_move(pid, {"kind": "entity", "id": chest["id"], "slot": 0},
+                           {"kind": "unit", "id": unit["id"], "slot": 2})
+    with pytest.raises(app.InventoryError, match="entity slot already occupied"):
+        app.inventory_move(pid, {"kind": "unit", "id": unit["id"], "slot": 2},
+                           {"kind": "entity", "id": chest["id"], "slot": 0})
+    assert world_state(app, unit, chest) == before
+
+
+def test_other_players_units_are_off_limits(app, player, chest):
+    pid, unit = player
+    with pytest.raises(app.InventoryError, match="unit not owned by you"):
+        app.inventory_move("someone-else", {"kind": "entity", "id": chest["id"], "slot": 0},
+                           {"kind": "unit", "id": unit["id"], "slot": 0})
+
+
+def test_pickup_out_of_reach_is_rejected(app, player, ground_item):
+    pid, unit = player
+    ground_item["x"] = FAR + app.PICKUP_DISTANCE * 2
+    with pytest.raises(app.InventoryError, match="item out of reach"):
+        app.inventory_move(pid, {"kind": "ground", "id": ground_item["id"]},
+                           {"kind": "unit", "id": unit["id"], "slot": 0}, max_distance=app.PICKUP_DISTANCE)
+    assert ground_item["id"] in app.world.ground_index
+    assert unit["itemSlots"][0] is None
+
+
+def test_pickup_moves_the_item_into_the_slot(app, player, ground_item):
+    pid, unit = player
+    changes = app.inventory_move(pid, {"kind": "ground", "id": ground_item["id"]},
+                                 {"kind": "unit", "id": unit["id"], "slot": 0}, max_distance=app.PICKUP_DISTANCE)
+    assert ground_item["id"] not in app.world.ground_index
+    assert unit["itemSlots"][0]["name"] == "Axe" and unit["itemSlots"][0]["attack"] == 3
+    assert changes["ground"]["remove"] == [ground_item["id"]]
+    assert changes["slots"] == [{"kind": "unit", "id": unit["id"], "slot": 0, "item": unit["itemSlots"][0],
+                                 "owner": pid}]
+    assert changes["units"] == [unit]
+
+
+def test_entity_to_unit_and_drop_to_world(app, player, chest):
+    pid, unit = player
+    app.inventory_move(pid, {"kind": "entity", "id": chest["id"], "slot": 0},
+                       {"kind": "unit", "id": unit["id"], "slot": 4})
+    assert chest["itemSlots"][0] is None
+    assert unit["itemSlots"][4]["name"] == "shield"
+    changes = app.inventory_move(pid, {"kind": "unit", "id": unit["id"], "slot": 4},
+                                 {"kind": "world", "x": FAR - 300, "y": FAR}, collision_pad=8)
+    assert unit["itemSlots"][4] is None
+    [dropped] = changes["ground"]["add"]
+    try:
+        assert app.world.ground_index[dropped["id"]]["name"] == "shield"
+        assert (dropped["x"], dropped["y"]) == (FAR - 300, FAR)
+    finally:
+        with app.world.ground_lock:
+            app.remove_ground_item(dropped["id"])
@@ -0,0 +1,93 @@
+import glob
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def journal(app, tmp_path):
+    journals = []
+
+    def open_journal():
+        j = app.WorldJournal(str(tmp_path / "world.journal"))
+        journals.append(j)
+        return j
+
+    yield open_journal
+    for j in journals:
+        j.file.close()
+
+
+def append(j, *recs):
+    j.file.write(b"".join(j.record(rec) for rec in recs))
+    j.file.flush()
+
+
+def test_replay_is_latest_wins(journal):
+    j = journal()
+    append(j,
+           {"c": "resources", "i": "r1", "v": {"id": "r1", "amount": 1}},
+           {"c": "resources", "i": "r2", "v": {"id": "r2", "amount": 5}},
+           {"c": "resources", "i": "r1", "v": {"id": "r1", "amount": 2}},
+           {"c": "resources", "i": "r3", "v": None})
+    base = [{"id": "r1", "amount": 0}, {"id": "r3", "amount": 9}, {"id": "r4", "amount": 4}]
+    rows = journal().replay("resources", base)
+    assert sorted(rows, key=lambda r: r["id"]) == [
+        {"id": "r1", "amount": 2}, {"id": "r2", "amount": 5}, {"id": "r4", "amount": 4}]
+
+
+def test_replay_map_takes_the_last_archetype_table(journal):
+    j = journal()
+    append(j,
+           {"c": "archetypes", "v": {"tree": {"w": 1}}},
+           {"c": "map_objects", "i": "m1", "v": {"id": "m1", "kind": "tree"}},
+           {"c": "archetypes", "v": {"tree": {"w": 2}}})
+    raw = journal().replay_map({"schema": 3, "archetypes": {"rock": {}}, "objects": []})
+    assert raw == {"schema": 3, "archetypes": {"tree": {"w": 2}}, "objects": [{"id": "m1", "kind": "tree"}]}
+
+
+@pytest.mark.parametrize("damage", [
+    lambda line: line[:-1],  # torn final write
+    lambda line: line.replace(b'"amount":3', b'"amount":4'),  # bit rot under the crc
+    lambda line: b"zzzzzzzz" + line[8:],  # unreadable crc
+])
+def test_corrupt_tail_is_backed_up_and_truncated(journal, tmp_path, damage):
+    j = journal()
+    append(j, {"c": "resources", "i": "r1", "v": {"id": "r1", "amount": 1}})
+    good = j.size()
+    j.file.write(damage(j.record({"c": "resources", "i": "r1", "v": {"id": "r1", "amount": 3}})))
+    j.file.flush()
+    j = journal()
+    assert j.tail["resources"] == [("r1", {"id": "r1", "amount": 1})]
+    assert (tmp_path / "world.journal").stat().st_size == good
+    assert glob.glob(str(tmp_path / "world.journal.corrupt.*"))
+
+
+def test_unknown_collection_stops_replay(journal):
+    j = journal()
+    append(j, {"c": "resources", "i": "r1", "v": {"id": "r1"}},
+           {"c": "players", "i": "p", "v": {}},
+           {"c": "resources", "i": "r2", "v": {"id": "r2"}})
+    assert journal().tail["resources"] == [("r1", {"id": "r1"})]
+
+
+def test_flush_writes_changed_rows_once(app, journal):
+    j = journal()
+    gid = str(uuid.uuid4())
+    with app.world.ground_lock:
+        app.add_ground_item({"id": gid, "name": "Sword", "x": 1, "y": 2})
+    try:
+        j.dirty["ground_items"].add(gid)
+        assert j.flush() >= 1  # the row (plus the archetype table on a fresh journal)
+        j.dirty["ground_items"].add(gid)
+        assert j.flush() == 0  # unchanged rows are not rewritten
+        app.world.ground_index[gid]["x"] = 5
+        j.dirty["ground_items"].add(gid)
+        assert j.flush() == 1
+    finally:
+        with app.world.ground_lock:
+            app.remove_ground_item(gid)
+    j.dirty["ground_items"].add(gid)
+    assert j.flush() == 1
+    rows = [row for oid, row in journal().tail["ground_items"] if oid == gid]
+    assert [r and r["x"] for r in rows] == [1, 5, None]
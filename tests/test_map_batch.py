@@ -0,0 +1,85 @@
+import pytest
+
+from conftest import FAR
+
+BOX = {"collides": True, "w": 64, "h": 64}
+
+
+def crate(x, y=FAR, **fields):
+    return {"op": "place", "kind": "crate", "type": "tile", "x": x, "y": y, "meta": dict(BOX), **fields}
+
+
+@pytest.fixture
+def placed(app):
+    """Ids placed during the test; removed afterwards."""
+    ids = []
+    yield ids
+    with app.world.map_lock:
+        for oid in ids:
+            app.remove_map_object(oid)
+    app.invalidate_collision_index()
+
+
+def test_collision_index_candidates(app):
+    index = app.CollisionIndex()
+    wide = {"id": "wide", "x": 0, "y": 0, "meta": {"collides": True, "w": 600, "h": 10}}
+    ghost = {"id": "ghost", "x": 0, "y": 0, "meta": {"collides": False, "w": 64, "h": 64}}
+    far = {"id": "far", "x": 5000, "y": 5000, "meta": {"collides": True, "w": 64, "h": 64}}
+    index.rebuild([wide, ghost, far])
+    assert [o["id"] for o in index.candidates(0, 0, pad=300)] == ["wide"]  # once, although in 3+ cells
+    assert [o["id"] for o in index.candidates(290, 0)] == ["wide"]
+    assert index.candidates(2500, 2500) == []
+    assert app.first_collision(index.candidates(290, 0), 290, 0)["id"] == "wide"
+    assert app.first_collision(index.candidates(310, 0), 310, 0) is None
+    assert app.first_collision(index.candidates(310, 0, pad=16), 310, 0, pad=16)["id"] == "wide"
+    assert app.first_collision(index.candidates(0, 0), 0, 0, ignore=("wide",)) is None
+
+
+def test_overlapping_places_reject_the_whole_batch(app, placed):
+    before = (len(app.world.map_objects), app.world.map_feed.seq, dict(app.world.map_feed.pending))
+    with pytest.raises(app.MapBatchError) as err:
+        app.apply_map_batch([crate(FAR), crate(FAR + 1000), crate(FAR + 20)], "builder")
+    assert err.value.index == 2
+    assert (len(app.world.map_objects), app.world.map_feed.seq, dict(app.world.map_feed.pending)) == before
+
+
+def test_batch_sees_its_own_moves_and_deletes(app, placed):
+    result = app.apply_map_batch([
+        crate(FAR, id="c1"),
+        {"op": "update", "id": "c1", "x": FAR + 500, "y": FAR},  # moves out of the way...
+        crate(FAR + 10, id="c2"),  # ...so its old spot is free
+        {"op": "delete", "id": "c2"},
+        crate(FAR + 5, id="c3"),
+    ], "builder")
+    placed.extend(["c1", "c2", "c3"])
+    assert result == {"placed": ["c1", "c2", "c3"], "updated": 1, "deleted": 1}
+    assert "c2" not in app.world.map_index
+    assert app.world.map_index["c1"]["x"] == FAR + 500
+    assert app.find_world_collision(FAR + 500, FAR)["id"] == "c1"
+
+
+def test_batch_is_blocked_by_the_live_map(app, placed):
+    app.apply_map_batch([crate(FAR, id="c1")], "builder")
+    placed.append("c1")
+    with pytest.raises(app.MapBatchError, match="blocked by crate c1") as err:
+        app.apply_map_batch([crate(FAR + 2000), crate(FAR + 30)], "builder")
+    assert err.value.index == 1
+    # moving the blocker away in the same batch frees the spot
+    app.apply_map_batch([{"op": "update", "id": "c1", "x": FAR + 900, "y": FAR}, crate(FAR + 30, id="c2")], "builder")
+    placed.append("c2")
+
+
+@pytest.mark.parametrize("ops, index, error", [
+    ([], -1, "non-empty list"),
+    ([{"op": "place", "kind": "mine", "x": 0, "y": 0}], 0, "costs resources"),
+    ([{"op": "place", "kind": "crate", "x": "nan", "y": 0}], 0, "finite"),
+    ([{"op": "update", "id": "no-such-object"}], 0, "unknown id"),
+    ([{"op": "place", "kind": "crate", "x": FAR, "y": FAR, "id": "dup"},
+      {"op": "place", "kind": "crate", "x": FAR + 800, "y": FAR, "id": "dup"}], 1, "already exists"),
+    ([{"op": "teleport"}], 0, "unknown op"),
+])
+def test_invalid_ops(app, ops, index, error):
+    with pytest.raises(app.MapBatchError, match=error) as err:
+        app.apply_map_batch(ops, "builder")
+    assert err.value.index == index
+    assert "dup" not in app.world.map_index
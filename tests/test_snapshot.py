@@ -0,0 +1,63 @@
+import pytest
+
+ROWS = {
+    "map_objects": [
+        {"id": "m1", "kind": "tree", "type": "tile", "x": 10, "y": -4.5, "meta": {"w": 64}},
+        {"id": "m2", "kind": "mine", "owner": "bob", "x": 2 ** 60, "y": "bad", "meta": {"mine": {"resource": "red"}}},
+        {"id": "m3", "kind": "npc", "owner": None, "type": 7, "hp": 12, "meta": {"title": "Zoë ✓"}},
+        {"id": 42, "kind": "tree", "type": -1, "x": 0.25, "y": 0},
+    ],
+    "ground_items": [{"id": "g1", "name": "Sword", "x": 1, "y": 2, "bonus": 1.5}],
+    "resources": [],
+}
+
+
+@pytest.fixture
+def snapshot(app, tmp_path):
+    path = str(tmp_path / "world.snap")
+    app.pack_world_snapshot(path, {"tree": {"w": 64}}, ROWS, schema=5)
+    snap = app.WorldSnapshot(path)
+    yield snap
+    snap.close()
+
+
+def test_round_trip(snapshot):
+    assert snapshot.archetypes == {"tree": {"w": 64}}
+    assert snapshot.meta == {"schema": 5}
+    for name, rows in ROWS.items():
+        assert list(snapshot.collections[name]) == rows
+
+
+def test_columns_keep_int_and_float_types(snapshot):
+    rows = list(snapshot.collections["map_objects"])
+    assert type(rows[0]["x"]) is int and type(rows[0]["y"]) is float
+    assert type(rows[3]["y"]) is int and rows[3]["id"] == 42
+    assert rows[1]["x"] == 2 ** 60  # past float precision: kept in the blob
+
+
+def test_random_access_matches_iteration(snapshot):
+    coll = snapshot.collections["map_objects"]
+    assert len(coll) == len(ROWS["map_objects"])
+    assert [coll[i] for i in range(len(coll))] == list(coll)
+    assert coll[-1] == ROWS["map_objects"][-1]
+    with pytest.raises(IndexError):
+        coll[len(coll)]
+
+
+def test_rows_are_fresh_objects(snapshot):
+    coll = snapshot.collections["ground_items"]
+    coll[0]["name"] = "changed"
+    assert coll[0]["name"] == "Sword"
+
+
+@pytest.mark.parametrize("damage", [
+    lambda raw: b"NOTASNAP" + raw[8:],
+    lambda raw: raw[:8] + b"\x09\x00" + raw[10:],  # unknown version
+    lambda raw: raw[:len(raw) - 7],  # truncated
+])
+def test_damaged_files_are_rejected(app, tmp_path, damage):
+    path = tmp_path / "world.snap"
+    app.pack_world_snapshot(str(path), {}, ROWS)
+    path.write_bytes(damage(path.read_bytes()))
+    with pytest.raises(ValueError):
+        app.WorldSnapshot(str(path))
@@ -0,0 +1,145 @@
+import json
+import struct
+import uuid
+
+
+class Reader:
+    """Python twin of the client's bin1 reader, enough to check the frames."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def unpack(self, fmt):
+        values = struct.unpack_from("<" + fmt, self.data, self.pos)
+        self.pos += struct.calcsize("<" + fmt)
+        return values
+
+    def text(self):
+        (n,) = self.unpack("B")
+        raw = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return raw.decode("utf-8")
+
+    def ident(self):
+        if self.data[self.pos] == 0:
+            self.pos += 1
+            raw = self.data[self.pos:self.pos + 16]
+            self.pos += 16
+            return str(uuid.UUID(bytes=raw))
+        return self.text()
+
+    def coord(self, scale):
+        return self.unpack("i")[0] / scale
+
+    def enum(self, table):
+        (code,) = self.unpack("B")
+        return self.text() if code == 255 else table[code]
+
+    def json_tail(self):
+        (n,) = self.unpack("I")
+        raw = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return json.loads(raw)
+
+
+def read_patch(app, r):
+    p = {"id": r.ident()}
+    (mask,) = r.unpack("B")
+    meta = {}
+    if mask & 1:
+        p["x"] = r.coord(app.COORD_SCALE)
+        p["y"] = r.coord(app.COORD_SCALE)
+    if mask & 2:
+        meta["targetWaypoint"] = {"x": r.coord(app.COORD_SCALE), "y": r.coord(app.COORD_SCALE)}
+    if mask & 4:
+        meta["currentWaypointIndex"] = r.unpack("H")[0]
+    if mask & 8:
+        meta["anim"] = r.enum(app.ANIM_CODES)
+    if mask & 16:
+        meta["dir"] = r.enum(app.DIR_CODES)
+    if mask & 32:
+        meta["chasing"] = bool(mask & 64)
+    if meta:
+        p["meta"] = meta
+    return p
+
+
+def test_text_is_cut_on_a_character_boundary(app):
+    w = app.WireWriter()
+    w.text("é" * 200)
+    data = w.getvalue()
+    assert data[0] == 254
+    assert Reader(data).text() == "é" * 127
+
+
+def test_ident_packs_uuids_and_keeps_other_ids_as_text(app):
+    oid = str(uuid.uuid4())
+    w = app.WireWriter()
+    w.ident(oid)
+    w.ident("spider-7")
+    w.ident(oid.upper())  # not canonical: would not round-trip as raw bytes
+    data = w.getvalue()
+    assert len(data) == 17 + 1 + len("spider-7") + 1 + len(oid)
+    r = Reader(data)
+    assert [r.ident(), r.ident(), r.ident()] == [oid, "spider-7", oid.upper()]
+
+
+def test_motion_frame_round_trip(app):
+    patches = [
+        {"id": str(uuid.uuid4()), "x": 10.5, "y": -3.25,
+         "meta": {"targetWaypoint": {"x": 100, "y": 200}, "currentWaypointIndex": 3,
+                  "anim": "walk", "dir": "045", "chasing": True}},
+        {"id": "spider-1", "meta": {"anim": "dance", "chasing": False}},
+    ]
+    data = app.encode_motion_bin({"patch": patches})
+    r = Reader(data)
+    assert r.unpack("BH") == (app.FRAME_MOTION, 2)
+    decoded = [read_patch(app, r) for _ in range(2)]
+    assert r.pos == len(data)
+    assert decoded == patches
+
+
+def test_motion_frame_falls_back_to_json_for_unpackable_patches(app):
+    payload = {"patch": [{"id": "a", "x": 1, "y": 2, "hp": 5}]}
+    assert app.encode_motion_bin(payload) is None
+    assert app.encode_frame("bin1", "map_objects_motion", payload) == ("map_objects_motion", payload)
+
+
+def test_map_delta_packs_npc_patches_and_keeps_the_rest_as_json(app):
+    npc = {"id": "n1", "x": 4, "y": 8}
+    other = {"id": "o1", "hp": 3}
+    delta = {"seq": 12, "base": 10, "upsert": [{"id": "u1", "kind": "tree"}], "patch": [npc, other],
+             "remove": ["r1"]}
+    event, data = app.encode_frame("bin1", "map_objects_delta", delta)
+    assert event == "bin"
+    r = Reader(data)
+    assert r.unpack("BIIH") == (app.FRAME_MAP_DELTA, 10, 12, 1)
+    assert read_patch(app, r) == npc
+    assert r.json_tail() == {"upsert": delta["upsert"], "patch": [other], "remove": ["r1"]}
+    assert r.pos == len(data)
+
+
+def test_units_frame_round_trip(app):
+    unit = {"id": str(uuid.uuid4()), "x": 1.5, "y": 2, "tx": 30, "ty": 40, "hp": 7, "maxHp": 10,
+            "anim": "attack", "dir": 90}
+    data = app.encode_units_bin({"sid": "abc", "units": [unit, "junk", {"x": 1}]})
+    r = Reader(data)
+    assert r.unpack("B") == (app.FRAME_UNITS,)
+    assert r.text() == "abc"
+    assert r.unpack("H") == (1,)
+    assert r.ident() == unit["id"]
+    assert [r.coord(app.COORD_SCALE) for _ in range(4)] == [1.5, 2, 30, 40]
+    assert r.unpack("ff") == (7.0, 10.0)
+    assert r.enum(app.ANIM_CODES) == "attack"
+    assert r.enum(app.DIR_CODES) == "090"
+    assert r.pos == len(data)
+
+
+def test_negotiate_codec(app):
+    assert app.negotiate_codec("sid-a", ["json", "bin1"]) == "bin1"
+    assert app.sid_codecs["sid-a"] == "bin1"
+    assert app.negotiate_codec("sid-a", "bin1") == "json"
+    assert "sid-a" not in app.sid_codecs
+    assert app.encode_frame(app.sid_codecs.get("sid-a"), "update_units", {"units": []}) == \
+        ("update_units", {"units": []})